@@ -23,7 +23,7 @@ rates_summary = None
 
 
 def add_stats(df, groupby_field, prefix=""):
-    gb = df.groupby([groupby_field])
+    gb = df.groupby([groupby_field], observed=True)
     counts = gb.size().to_frame(name=f"{prefix}counts")
     ndf = (
         counts.join(gb.agg({"stars": "sum"}).rename(columns={"stars": f"{prefix}total_stars"}))
@@ -130,13 +130,15 @@ def get_war_id_df(df):
     return ndf
 
 
-def do_league(warleague, season):
+def do_league(warleague, season, resolver=None):
     from models.model_controler import ModelControler
-    from models.models import LeagueGroup, LeaguePlayer, LeagueSeason, Player, WarLeague
+    from models.models import LeagueGroup, LeagueSeason, SeasonClanResolver, WarLeague
 
     mc = ModelControler(None)
 
     league = mc.get_league(season)
+    if resolver is None:
+        resolver = SeasonClanResolver(league.id)
     out_dir = f"{OUT_DIR}/{league.season}"
     os.makedirs(out_dir, exist_ok=True)
 
@@ -195,9 +197,10 @@ def do_league(warleague, season):
         inplace=True,
     )
 
-    ndf.insert(0, "clan_tag", LeaguePlayer.get_clan_tags(ndf["attacker_tag"]))
-    ndf.insert(0, "clan", LeaguePlayer.get_clan_names(ndf["attacker_tag"]))
-    ndf.insert(0, "name", Player._get_names(ndf["attacker_tag"]))
+    resolved = resolver.resolve(ndf["attacker_tag"])
+    ndf.insert(0, "clan_tag", [r[1] for r in resolved])
+    ndf.insert(0, "clan", [r[2] or r[1] for r in resolved])
+    ndf.insert(0, "name", [r[0] for r in resolved])
     ndf.insert(0, 'league_id', value=warleague)
     ndf.insert(0, 'season', value=season)
 
@@ -207,7 +210,7 @@ def do_league(warleague, season):
 def run(season):
 
     from models.model_controler import ModelControler
-    from models.models import LeagueGroup, LeagueSeason, Player, WarLeague
+    from models.models import LeagueGroup, LeagueSeason, SeasonClanResolver, WarLeague
     t = Timer()
     import models.req as req
     req.OFFLINE = OFFLINE
@@ -218,10 +221,12 @@ def run(season):
     db.init_db()
     t.reset()
 
+    ## players are looked up once for the whole season
+    resolver = SeasonClanResolver(mc.get_league(season).id)
     for warleague in WarLeague:
         # if not (warleague == WarLeague.champ3 or warleague == WarLeague.master1):
         #     continue
-        do_league(warleague, season)
+        do_league(warleague, season, resolver)
         t.ellapsed_print("warleague", warleague)
 
     print("total time = ", t.totalellapsed())
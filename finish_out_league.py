@@ -1,5 +1,6 @@
 import argparse
 import collections
+import itertools
 import json
 import math
 import os
@@ -20,6 +21,8 @@ OFFLINE = False
 
 req.OFFLINE = OFFLINE
 req.USE_FILES_FOR_REQS = OFFLINE
+## crawls only get the budget live war tracking leaves
+req.DEFAULT_PRIORITY = req.Priority.BULK
 
 cocreq = COCRequest()
 
@@ -62,15 +65,14 @@ def run(
         season = datetime.today().replace(day=1).date().strftime("%Y-%m")
 
     season = LeagueSeason.get_season(season)
-    groups = season.groups[start:] if not end else season.groups[start:end]
-    print(f"season={season}, ngroups={len(groups)}")
-    # print(groups[0], season.season, type(season.season))
-    # sys.exit(1)
-    # print("clan", clans)
+    ## finished groups are skipped by the query, start/end count unfinished groups
+    groups = itertools.islice(season.iter_unfinished_groups(), start, end)
+    print(f"season={season}")
     for count, group in enumerate(groups):
         try:
             print(" - ", start + count, end=" ")
-            if group.finished():
+            if group.update_status():
+                db.session.commit()
                 print(" ", group, count, "#")
                 continue
             mc.get_league_group(
@@ -0,0 +1,101 @@
+## Copies a database with string tags into a new one with integer tag columns
+## (models.db.INT_TAGS). The schema is created from the models, then every table is
+## copied in foreign key order with its tags encoded on the way in. The latest tables
+## aren't copied, the history triggers fill them (on mysql with binary logging the new
+## db's user needs SUPER or log_bin_trust_function_creators=1 to create them).
+##
+##   DB_INT_TAGS=1 SQLALCHEMY_DATABASE_URI=<new db> python migrate_int_tags.py <old db uri> [batch_size]
+##
+## The old db is checked first. If any tag can't be encoded nothing is copied, the bad
+## tags are listed by table and column so those rows (and the history, war players and
+## attacks that point at them) can be fixed or deleted before running it again.
+import sys
+
+from sqlalchemy import String, create_engine, inspect, select, type_coerce
+
+import models.db as db
+from models.exceptions import InvalidTagException
+from models.models import _latest_tables
+from models.timer import Timer
+from models.utils import tag_to_int
+
+
+def encode_rows(rows, tag_columns):
+    out = []
+    for r in rows:
+        d = dict(r)
+        for c in tag_columns:
+            if d.get(c) is not None:
+                d[c] = tag_to_int(d[c])
+        out.append(d)
+    return out
+
+
+def _tag_columns(table):
+    return [c.name for c in table.columns if isinstance(c.type, db.Tag)]
+
+
+def find_bad_tags(src, tables):
+    """{(table name, column name): tags that can't be encoded} over the old db"""
+    bad = {}
+    for table in tables:
+        have = {c["name"] for c in inspect(src).get_columns(table.name)}
+        for name in _tag_columns(table):
+            if name not in have:
+                continue
+            col = type_coerce(table.c[name], String(12))
+            result = src.execution_options(stream_results=True).execute(select([col]).where(col.isnot(None)).distinct())
+            for (tag,) in result:
+                try:
+                    tag_to_int(tag)
+                except InvalidTagException:
+                    bad.setdefault((table.name, name), []).append(tag)
+    return bad
+
+
+def copy_table(src, dst, table, batch_size):
+    tag_columns = _tag_columns(table)
+    ## read with the models' types, except tags which are still strings in the old db.
+    ## Columns the old db doesn't have yet are left to their defaults
+    have = {c["name"] for c in inspect(src).get_columns(table.name)}
+    cols = [
+        type_coerce(c, String(12)).label(c.name) if c.name in tag_columns else c
+        for c in table.columns
+        if c.name in have
+    ]
+    ## league_season is seeded when the table is created
+    dst.execute(table.delete())
+    result = src.execution_options(stream_results=True).execute(select(cols))
+    copied = 0
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        dst.execute(table.insert(), encode_rows(rows, tag_columns))
+        copied += len(rows)
+    return copied
+
+
+def run(src_uri, batch_size=10000):
+    if not db.INT_TAGS:
+        sys.exit("Set DB_INT_TAGS=1, the new database is the one in SQLALCHEMY_DATABASE_URI")
+    src = create_engine(src_uri)
+    skip = {t.__table__ for t in _latest_tables.values()}
+    tables = [table for table in db.Base.metadata.sorted_tables if table not in skip]
+    ## a row left out would orphan everything referencing it, so stop before copying any
+    bad = find_bad_tags(src, tables)
+    if bad:
+        for (table, column), tags in bad.items():
+            print(f"{table}.{column}: {len(tags)} bad tags: {', '.join(map(repr, tags))}")
+        sys.exit("Tags that can't be encoded, nothing was copied")
+    db.init_db()
+    t = Timer()
+    for table in tables:
+        copied = copy_table(src, db.engine, table, batch_size)
+        t.ellapsed_print(f"{table.name} copied {copied}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("python migrate_int_tags.py <old db uri> [batch_size]")
+    run(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
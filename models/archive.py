@@ -0,0 +1,360 @@
+"""Append only archive of recorded API responses.
+
+Responses are stored as compressed JSON lines in numbered segment files. Each record
+is compressed on its own, so a record can be read back with a single pread and a
+segment is still a valid .jsonl.gz (or .jsonl.zst) stream.
+
+Lookups go through a compact index of fixed size (sha1(url), segment, offset, length)
+records: a sorted file that is memory-mapped and binary searched, plus a small
+append-only log of the entries written since the last compaction.
+
+Writes append the record, then its index entry. On open, index entries that point
+past the end of their segment are dropped and the active segment is truncated back
+to the end of its last indexed record, so a crash never leaves a half written record
+behind.
+
+Migrate an existing REQ_SAVE_DIR/requests tree with
+    python -m models.archive migrate <requests_dir> <archive_dir>
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from models.utils import json_loads
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_BASE_URL = "https://api.clashofclans.com/v1"
+SEGMENT_SIZE = 256 * 1024 * 1024
+COMPACT_AFTER = 100000  # log entries
+
+_ENTRY = struct.Struct("<20sIQI")  # sha1(url), segment, offset, length
+_segment_pattern = re.compile(r"seg-(\d+)\.jsonl\.(gz|zst)$")
+
+
+def _digest(url):
+    return hashlib.sha1(url.encode()).digest()
+
+
+def _compress(data, ext):
+    if ext == "zst":
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _decompress(data, ext):
+    if ext == "zst":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class ResponseArchive:
+    def __init__(self, path, compression=None, segment_size=SEGMENT_SIZE, sync=False):
+        """
+        Args:
+            path (str): Directory holding the segments and index
+            compression (str): "zst" or "gz" for new segments. Defaults to zst when
+                zstandard is installed
+            segment_size (int): Start a new segment once the current one is this big
+            sync (bool): fsync every record and index entry
+        """
+        self.path = path
+        self.ext = compression or ("zst" if zstandard else "gz")
+        if self.ext == "zst" and not zstandard:
+            raise ImportError("zstandard is needed for zst compression")
+        self.segment_size = segment_size
+        self.sync = sync
+        self._lock = threading.Lock()
+        self._fds = {}
+        self._log = {}  # digest -> (segment, offset, length)
+        self._log_size = 0  # bytes of the log read so far
+        self._index = None
+        self._index_len = 0
+        self._index_stamp = None  # (inode, mtime) of the index file that is mapped
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, "index.bin")
+        self._log_path = os.path.join(path, "index.log")
+        self._meta_path = os.path.join(path, "index.meta")
+        self._lock_path = os.path.join(path, "lock")
+        self.segments = {}  # segment number -> ext
+        self._scan_segments()
+        with self._write_lock():
+            self._recover()
+            self._open_index()
+            if len(self._log) >= COMPACT_AFTER:
+                self._compact()
+
+    def __len__(self):
+        return self._index_len + sum(1 for d in self._log if self._find_sorted(d) is None)
+
+    def __contains__(self, url):
+        digest = _digest(url)
+        return self._find(digest) is not None or (self._refresh() and self._find(digest) is not None)
+
+    def _scan_segments(self):
+        for f in os.listdir(self.path):
+            m = _segment_pattern.match(f)
+            if m:
+                self.segments[int(m.group(1))] = m.group(2)
+
+    def _segment_path(self, seg, ext=None):
+        return os.path.join(self.path, f"seg-{seg:05d}.jsonl.{ext or self.segments[seg]}")
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            if not fcntl:
+                yield
+                return
+            fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _recover(self):
+        """Drop index entries and data left behind by an interrupted write"""
+        ends = {}
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                ends = {int(k): v for k, v in json.load(f)["ends"].items()}
+        if os.path.exists(self._log_path):
+            sizes = {s: os.path.getsize(self._segment_path(s)) for s in self.segments}
+            with open(self._log_path, "rb") as f:
+                data = f.read()
+            kept = []
+            for i in range(0, len(data) - len(data) % _ENTRY.size, _ENTRY.size):
+                digest, seg, off, length = _ENTRY.unpack_from(data, i)
+                if off + length > sizes.get(seg, -1):
+                    continue  ## its record never made it, the entries after it may have
+                self._log[digest] = (seg, off, length)
+                ends[seg] = max(ends.get(seg, 0), off + length)
+                kept.append(data[i : i + _ENTRY.size])
+            kept = b"".join(kept)
+            ## rewritten without them, the space they point at gets reused
+            if kept != data:
+                with open(f"{self._log_path}.tmp", "wb") as f:
+                    f.write(kept)
+                os.replace(f"{self._log_path}.tmp", self._log_path)
+            self._log_size = len(kept)
+        if self.segments:
+            last = max(self.segments)
+            path = self._segment_path(last)
+            if os.path.getsize(path) > ends.get(last, 0):
+                with open(path, "r+b") as f:
+                    f.truncate(ends.get(last, 0))
+
+    def _open_index(self):
+        ## the old map isn't closed, a lookup in another thread may still be using it
+        index = None
+        self._index_stamp = self._stamp(self._index_path)
+        if os.path.exists(self._index_path) and os.path.getsize(self._index_path):
+            with open(self._index_path, "rb") as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index = index
+        self._index_len = len(index) // _ENTRY.size if index is not None else 0
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _changed(self):
+        try:
+            size = os.path.getsize(self._log_path)
+        except FileNotFoundError:
+            size = 0
+        return size != self._log_size or self._stamp(self._index_path) != self._index_stamp
+
+    def _refresh(self):
+        """Pick up what other processes wrote since we last looked. Returns whether
+        there was anything"""
+        if not self._changed():
+            return False
+        with self._lock:
+            self._catch_up()
+        return True
+
+    def _catch_up(self):
+        """Read the log entries appended by other processes, the lock must be held"""
+        if self._stamp(self._index_path) != self._index_stamp:
+            ## someone compacted, the log was merged into a new index and emptied
+            self._open_index()
+            self._log, self._log_size = {}, 0
+        try:
+            with open(self._log_path, "rb") as f:
+                f.seek(self._log_size)
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        data = data[: len(data) - len(data) % _ENTRY.size]  ## the last may be half written
+        for i in range(0, len(data), _ENTRY.size):
+            digest, seg, off, length = _ENTRY.unpack_from(data, i)
+            self._log[digest] = (seg, off, length)
+        self._log_size += len(data)
+        self._scan_segments()
+
+    def _find_sorted(self, digest):
+        index = self._index
+        lo, hi = 0, len(index) // _ENTRY.size if index is not None else 0
+        while lo < hi:
+            mid = (lo + hi) // 2
+            d = index[mid * _ENTRY.size : mid * _ENTRY.size + 20]
+            if d < digest:
+                lo = mid + 1
+            elif d > digest:
+                hi = mid
+            else:
+                return _ENTRY.unpack_from(index, mid * _ENTRY.size)[1:]
+        return None
+
+    def _find(self, digest):
+        e = self._log.get(digest)
+        return e if e is not None else self._find_sorted(digest)
+
+    def _compact(self):
+        """Merge the log into the sorted index"""
+        entries = {}
+        for i in range(self._index_len):
+            digest, seg, off, length = _ENTRY.unpack_from(self._index, i * _ENTRY.size)
+            entries[digest] = (seg, off, length)
+        entries.update(self._log)
+        ends = {}
+        tmp = f"{self._index_path}.tmp"
+        with open(tmp, "wb") as f:
+            for digest in sorted(entries):
+                seg, off, length = entries[digest]
+                ends[seg] = max(ends.get(seg, 0), off + length)
+                f.write(_ENTRY.pack(digest, seg, off, length))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._index_path)
+        with open(f"{self._meta_path}.tmp", "w") as f:
+            json.dump({"ends": ends}, f)
+        os.replace(f"{self._meta_path}.tmp", self._meta_path)
+        with open(self._log_path, "wb"):
+            pass
+        self._log, self._log_size = {}, 0
+        self._open_index()
+
+    def compact(self):
+        with self._write_lock():
+            self._catch_up()
+            self._compact()
+
+    def _fd(self, seg):
+        fd = self._fds.get(seg)
+        if fd is None:
+            with self._lock:  ## reads come from the request threads
+                fd = self._fds.get(seg)
+                if fd is None:
+                    fd = self._fds[seg] = os.open(self._segment_path(seg), os.O_RDONLY)
+        return fd
+
+    def get(self, url):
+        """Returns the parsed body recorded for url, or None"""
+        digest = _digest(url)
+        e = self._find(digest)
+        if e is None and self._refresh():
+            e = self._find(digest)
+        if e is None:
+            return None
+        seg, off, length = e
+        line = json_loads(_decompress(os.pread(self._fd(seg), length, off), self.segments[seg]))
+        return line["body"] if line["url"] == url else None
+
+    def put(self, url, body, timestamp=None):
+        """Append the raw json body recorded for url"""
+        if isinstance(body, str):
+            body = body.encode()
+        if b"\n" in body:  ## keep it one record per line
+            body = json.dumps(json_loads(body)).encode()
+        head = json.dumps({"url": url, "time": timestamp or time.time()})[:-1].encode()
+        record = _compress(head + b', "body": ' + body + b"}\n", self.ext)
+        with self._write_lock():
+            self._catch_up()
+            if os.path.exists(self._log_path) and os.path.getsize(self._log_path) != self._log_size:
+                with open(self._log_path, "r+b") as f:
+                    f.truncate(self._log_size)  ## half an entry from a writer that died
+            seg = max(self.segments) if self.segments else 0
+            path = self._segment_path(seg, self.segments.get(seg, self.ext))
+            if seg in self.segments and (
+                self.segments[seg] != self.ext or os.path.getsize(path) >= self.segment_size
+            ):
+                seg += 1
+                path = self._segment_path(seg, self.ext)
+            self.segments.setdefault(seg, self.ext)
+            with open(path, "ab") as f:
+                off = f.tell()
+                f.write(record)
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+            entry = (seg, off, len(record))
+            with open(self._log_path, "ab") as f:
+                f.write(_ENTRY.pack(_digest(url), *entry))
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+            self._log[_digest(url)] = entry
+            self._log_size += _ENTRY.size
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+
+def migrate(requests_dir, archive_dir, base_url=DEFAULT_BASE_URL, compression=None):
+    """Copy every <requests_dir>/**/*.json file saved by COCRequest into an archive"""
+    archive = ResponseArchive(archive_dir, compression=compression)
+    count = 0
+    for floc in glob.iglob(os.path.join(requests_dir, "**", "*.json"), recursive=True):
+        rel = os.path.relpath(floc, requests_dir)[: -len(".json")].replace(os.sep, "/")
+        with open(floc, "rb") as f:
+            body = f.read()
+        archive.put(f"{base_url}/{rel}", body, timestamp=os.path.getmtime(floc))
+        count += 1
+        if count % 10000 == 0:
+            print(f"migrated {count}", flush=True)
+    archive.compact()
+    archive.close()
+    return count
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Recorded API response archive")
+    sp = ap.add_subparsers(dest="cmd", required=True)
+    mp = sp.add_parser("migrate", help="Import a REQ_SAVE_DIR/requests tree")
+    mp.add_argument("requests_dir")
+    mp.add_argument("archive_dir")
+    mp.add_argument("--base-url", default=DEFAULT_BASE_URL)
+    mp.add_argument("--compression", choices=["gz", "zst"], default=None)
+    args = ap.parse_args()
+    if args.cmd == "migrate":
+        n = migrate(args.requests_dir, args.archive_dir, args.base_url, args.compression)
+        print(f"migrated {n} responses into {args.archive_dir}")
@@ -0,0 +1,108 @@
+import collections
+import hashlib
+import os
+import re
+import threading
+import time
+
+_max_age_pattern = re.compile(r"max-age=(\d+)")
+## player bodies run to tens of KB, this keeps the memory tier around 10-20MB.
+## REQ_CACHE_SIZE raises it, REQ_CACHE_DIR adds a tier on disk
+DEFAULT_MAXSIZE = 500
+
+
+def max_age(headers):
+    """Seconds a response may be reused for according to its Cache-Control header"""
+    cc = headers.get("Cache-Control", "") if headers else ""
+    if "no-store" in cc or "no-cache" in cc:
+        return 0
+    m = _max_age_pattern.search(cc)
+    return int(m.group(1)) if m else 0
+
+
+class ResponseCache:
+    """Two tier cache of raw API responses keyed by url.
+
+    Fresh entries are kept in an in memory LRU of at most maxsize entries and, if
+    cache_dir is given, in one file per url whose mtime is the expiry time. The disk
+    tier survives restarts and is shared between processes.
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._mem = collections.OrderedDict()  # url -> (expires, body)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._mem)
+
+    def _path(self, url):
+        h = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, h[:2], h)
+
+    def _put_mem(self, url, expires, body):
+        with self._lock:
+            self._mem[url] = (expires, body)
+            self._mem.move_to_end(url)
+            while len(self._mem) > self.maxsize:
+                self._mem.popitem(last=False)
+
+    def get(self, url):
+        """Returns the cached body for url or None if there isn't a fresh one"""
+        now = time.time()
+        with self._lock:
+            e = self._mem.get(url)
+            if e and e[0] > now:
+                self._mem.move_to_end(url)
+                self.hits += 1
+                return e[1]
+            if e:
+                del self._mem[url]
+        if self.cache_dir:
+            path = self._path(url)
+            try:
+                expires = os.stat(path).st_mtime
+                if expires > now:
+                    with open(path, "rb") as f:
+                        body = f.read()
+                    self._put_mem(url, expires, body)
+                    with self._lock:
+                        self.disk_hits += 1
+                    return body
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, url, body, max_age):
+        if max_age <= 0:
+            return
+        expires = time.time() + max_age
+        self._put_mem(url, expires, body)
+        if self.cache_dir:
+            path = self._path(url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "wb") as f:
+                f.write(body)
+            os.utime(tmp, (expires, expires))
+            os.replace(tmp, path)
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+            "size": len(self),
+        }
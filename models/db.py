@@ -2,12 +2,15 @@ import os
 from enum import IntEnum
 
 # from flask.cli import with_appcontext
-from sqlalchemy import create_engine
+from sqlalchemy import BigInteger, String, create_engine
 from sqlalchemy.exc import DatabaseError, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.types import TypeDecorator
+
+from models.utils import env_istrue, int_to_tag, tag_to_int
 
 # import gsite.logger as log
 x = os.getenv("SQLALCHEMY_DATABASE_URI")
@@ -32,6 +35,33 @@ class Driver(IntEnum):
 
 driver = Driver.from_drivername(session.bind.url.drivername)
 
+## store player and clan tags as BIGINTs instead of strings. The whole schema has to be
+## created, or copied with `python migrate_int_tags.py` from the repo root, with it set
+INT_TAGS = env_istrue("DB_INT_TAGS", False)
+
+
+class Tag(TypeDecorator):
+    """A player or clan tag column, String(12) or a BigInteger when INT_TAGS is set.
+    Either way python only sees "#..." strings, ints are passed through as already encoded"""
+
+    impl = String(12)
+
+    def load_dialect_impl(self, dialect):
+        return dialect.type_descriptor(BigInteger() if INT_TAGS else String(12))
+
+    def process_bind_param(self, value, dialect):
+        if not INT_TAGS or value is None or isinstance(value, int):
+            return value
+        return tag_to_int(value)
+
+    def process_literal_param(self, value, dialect):
+        return self.process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if not INT_TAGS or value is None:
+            return value
+        return int_to_tag(value)
+
 
 def get_one_or_create(session, model, create_method="", create_method_kwargs=None, **kwargs):
     try:
@@ -1,10 +1,128 @@
+import asyncio
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # windows, buckets can only be shared inside one process
+    fcntl = None
+
+_STATE = struct.Struct("dd")  # tokens, time of last refill
 
 
 class RateLimiter:
-    def __init__(self, rate :float, capacity: int):
-        """[summary]
+    def __init__(self, rate: float, capacity: int, path: str = None):
+        """Token bucket that can be shared by every process on a host.
+
+        The bucket state lives in the file at path and is guarded with flock, so every
+        limiter opened on the same path draws from one budget. Usable from sync code
+        (acquire, with) and async code (acquire_async, async with).
 
         Args:
             rate (float): Number of tokens per second to add to the bucket
             capacity (int): Maximum tokens bucket can hold
-        """
\ No newline at end of file
+            path (str): File holding the bucket state. None keeps the bucket in this process
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.path = path if fcntl else None
+        self._lock = threading.Lock()
+        self._state = (float(capacity), time.time())
+        self._fd = None
+        self._pid = None
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+    def __str__(self):
+        return f"(RateLimiter rate={self.rate} capacity={self.capacity} path={self.path})"
+
+    def __repr__(self):
+        return str(self)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if not self.path:
+                yield None
+                return
+            ## flock is per open file, so a forked child needs its own
+            if self._fd is None or self._pid != os.getpid():
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield self._fd
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read(self, fd):
+        if fd is None:
+            return self._state
+        data = os.pread(fd, _STATE.size, 0)
+        if len(data) < _STATE.size:
+            return float(self.capacity), time.time()
+        return _STATE.unpack(data)
+
+    def _write(self, fd, tokens, now):
+        if fd is None:
+            self._state = (tokens, now)
+        else:
+            os.pwrite(fd, _STATE.pack(tokens, now), 0)
+
+    def _refill(self, tokens, last, now):
+        return min(self.capacity, tokens + max(0.0, now - last) * self.rate)
+
+    def _take(self, amount=1, reserve=0):
+        """Take amount tokens if there will still be reserve tokens left afterwards.
+        Returns 0 on success, otherwise the seconds until there will be enough"""
+        with self._locked() as fd:
+            now = time.time()
+            tokens = self._refill(*self._read(fd), now)
+            if tokens >= amount + reserve:
+                tokens -= amount
+                wait = 0
+            else:
+                wait = (amount + reserve - tokens) / self.rate
+            self._write(fd, tokens, now)
+        return wait
+
+    def available(self):
+        """Tokens that can be taken right now"""
+        with self._locked() as fd:
+            return self._refill(*self._read(fd), time.time())
+
+    def try_acquire(self, amount=1, reserve=0):
+        return self._take(amount, reserve) == 0
+
+    def acquire(self, amount=1, reserve=0):
+        """Wait for amount tokens. reserve tokens are left in the bucket for callers
+        that ask with a smaller reserve, so they get served first"""
+        while True:
+            wait = self._take(amount, reserve)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, amount=1, reserve=0):
+        while True:
+            wait = self._take(amount, reserve)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
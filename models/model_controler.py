@@ -6,8 +6,10 @@ import sys
 from datetime import datetime
 from functools import lru_cache
 
-from sqlalchemy import and_, func, not_, or_, tuple_
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_, bindparam, func, not_, or_, tuple_
+from sqlalchemy.exc import DatabaseError, IntegrityError
+from sqlalchemy.orm import lazyload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import FlushError, MultipleResultsFound, NoResultFound
 from sqlalchemy.sql import exists, func
 
@@ -21,12 +23,16 @@ from models.models import (
     EntryType,
     LeagueClan,
     LeagueGroup,
+    LeagueRound,
     LeagueSeason,
     Player,
     PlayerHistory,
+    PlayerLatest,
     PlayerNameHistory,
     War,
     WarState,
+    WarTag,
+    _insert_detached,
     fmt_tag,
 )
 from models.req import COCRequest
@@ -36,6 +42,7 @@ from models.utils import chunks
 found = 0
 
 CLAN_CHUNK_SIZE = 20  ## number of clans to update at once
+TAG_CHUNK_SIZE = 1000  ## tags per IN (...) query
 MIN_TIME_TO_UPDATE = 10  # in seconds
 
 sentinel = object()
@@ -87,17 +94,13 @@ class DBControler:
     def get_player(self, tag):
         return Player.query.filter(Player.tag == tag).one_or_none()
 
-    def get_clan(self, tag):
-        return Clan.query.filter(Clan.tag == tag).one_or_none()
+    def get_clan(self, tag, load="summary"):
+        return Clan.get(tag, load=load)
 
     def get_last_history(self, tag):
         if isinstance(tag, (Player, PlayerHistory)):
             tag = tag.tag
-        return (
-            PlayerHistory.query.filter(PlayerHistory.tag == tag)
-            .order_by(PlayerHistory.last_check.desc())
-            .first()
-        )
+        return PlayerLatest.get_history(tag)
 
     def _get_name_changed(self, obs, ocls):
         if not obs:
@@ -256,15 +259,12 @@ class ModelControler:
         res = []
         warlogs = []
         d_clan_tags = {}
-        for clan_tag in clan_tags:
-            # print("clan_tag", clan_tag)
-            try:
-                wl = self.req.get_war_log(clan_tag)
-                warlogs.append(wl)
-            except WarLogPrivateException:
-                pass
-            except FileNotFoundError:
-                pass
+        for clan_tag, wl in self.req.get_war_logs_many(clan_tags, return_exceptions=True).items():
+            if isinstance(wl, (WarLogPrivateException, FileNotFoundError)):
+                continue
+            if isinstance(wl, Exception):
+                raise wl
+            warlogs.append(wl)
 
         # t.ellapsed_print(f" get_war_log append {len(warlogs)}")
         rm = {}
@@ -332,7 +332,15 @@ class ModelControler:
         # print("lgid=", lgid)
         if not lgid:
             return None
-        lg = LeagueGroup.query.filter(LeagueGroup.id == lgid).one_or_none()
+        lg = (
+            LeagueGroup.query.options(
+                ## a round's wars are only loaded if they are used
+                selectinload(LeagueGroup.rounds).lazyload(LeagueRound.wars),
+                selectinload(LeagueGroup.rounds).selectinload(LeagueRound.war_tags),
+            )
+            .filter(LeagueGroup.id == lgid)
+            .one_or_none()
+        )
         # print("lg = ", lg)
         if lg is None:
             return None
@@ -340,54 +348,75 @@ class ModelControler:
         # t.ellapsed_print("  got league")
 
         if lg and get_wars:
-            # t.ellapsed_print("  lg")
-            # print(" ", len(lg.rounds))
-            for nround, r in enumerate(lg.rounds):
-                # t.ellapsed_print("    r", nround)
-                # print("  r", r)
-                for wt in r.war_tags:
-                    dbw = self.dbcont.get_war_from_war_tag(wt.war_tag)
-                    if not dbw:
-                        # t.ellapsed_print(f" new war-")
-                        ## New War
-                        try:
-                            w = self.get_war_from_war_tag(wt.war_tag, r.id)
-                        except NotInWarException:
-                            continue
-                        r.wars.append(w)
-                        db.session.add(w)
-                        db.session.flush()
-                        wt.war_id = w.id
-                        needs_commit = True
-                    elif dbw.war_status == WarState.war_ended:
-                        # t.ellapsed_print(f" ended war-, {dbw.clan1_tag}, {dbw.clan2_tag}, war_id={wt.war_id}, lr={wt.league_round_id}")
-                        ## We have an ended war, just update the id if needed
-                        if wt.war_id is None:
-                            wt.war_id = dbw.id
-                            db.session.merge(wt)
-                            needs_commit = True
-                        elif dbw.league_round_id is None: ### the league round id is not being set correctly for ended wars.. is this the reason???
-                            w = self.get_war_from_war_tag(wt.war_tag, r.id)
-                            w._copy_ids_from(dbw)
-                            r._replace_insert_war(w)
-                            db.session.merge(w)
-                            needs_commit = True
-                        # else:
-                            # print("get to skip ", dbw.league_round_id, dbw.clan1_tag, dbw.clan2_tag)
+            ## one query for the state of every war tag, finished wars aren't loaded at all
+            todo = [(r, wt) for r in lg.rounds for wt in r.war_tags if not WarTag.is_ended(wt.war_tag)]
+            states = WarTag.get_states([wt.war_tag for r, wt in todo])
+            todo = [(r, wt, states.get(wt.war_tag)) for r, wt in todo if not WarTag.is_ended(wt.war_tag)]
+
+            def stored(st):
+                return st is not None and st.stored_war_id is not None
+
+            def needs_war(wt, st):
+                return (
+                    not stored(st)
+                    or st.war_status != WarState.war_ended
+                    or (wt.war_id is not None and st.stored_round_id is None)
+                )
 
-                    else:
-                        # t.ellapsed_print(f" old fwar- {dbw.clan1_tag}, {dbw.clan2_tag}")
-                        ## Old war that hasn't ended. Merge data
-                        w = self.get_war_from_war_tag(wt.war_tag, r.id)
-                        w._copy_ids_from(dbw)
+            ## only the stored wars that still change are loaded
+            ids = [st.stored_war_id for r, wt, st in todo if stored(st) and needs_war(wt, st)]
+            dbws = {w.id: w for w in War.query.filter(War.id.in_(ids))} if ids else {}
+            ## fetch every war we are going to need concurrently
+            wdicts = self.req.get_league_wars_many(
+                [wt.war_tag for r, wt, st in todo if needs_war(wt, st)],
+                return_exceptions=True,
+            )
+            new_wars = []
+            for r, wt, st in todo:
+                if not stored(st):
+                    ## New War, inserted with the rest of them below
+                    try:
+                        w = self.get_war_from_war_tag(wt.war_tag, r.id, wdict=wdicts[wt.war_tag])
+                    except NotInWarException:
+                        continue
+                    if w is not None:
+                        new_wars.append((r, wt, w))
+                elif st.war_status == WarState.war_ended:
+                    ## We have an ended war, just update the id if needed
+                    if wt.war_id is None:
+                        wt.war_id = st.stored_war_id
+                        db.session.merge(wt)
+                        needs_commit = True
+                    elif st.stored_round_id is None: ### the league round id is not being set correctly for ended wars.. is this the reason???
+                        w = self.get_war_from_war_tag(wt.war_tag, r.id, wdict=wdicts[wt.war_tag])
+                        w._copy_ids_from(dbws[st.stored_war_id])
                         r._replace_insert_war(w)
                         db.session.merge(w)
+                        needs_commit = True
+                else:
+                    ## Old war that hasn't ended. Write whatever changed since the last poll
+                    dbw = dbws[st.stored_war_id]
+                    w = self.get_war_from_war_tag(wt.war_tag, r.id, wdict=wdicts[wt.war_tag])
+                    sd = dbw._update_from(w)
+                    if sd is not None:
+                        for c, lo in sd.items():
+                            for o in lo:
+                                db.session.delete(o)
+                        needs_commit = True
 
-                        if wt.war_id is None:
-                            wt.war_id = w.id
-                            db.session.merge(wt)
-
+                    if wt.war_id is None:
+                        wt.war_id = dbw.id
+                        db.session.merge(wt)
                         needs_commit = True
+            War._bulk_insert([w for r, wt, w in new_wars])
+            for r, wt, w in new_wars:
+                ## stored with its league_round_id, an unloaded round picks it up when read
+                if "wars" in r.__dict__:
+                    r.wars.append(w)
+                wt.war_id = w.id
+                needs_commit = True
+            if lg.update_status():
+                needs_commit = True
             if needs_commit:
                 db.session.commit()
         return lg
@@ -426,8 +455,11 @@ class ModelControler:
                 lg.league_id = ob.league_id
             if not lg.league_id:
                 # t.ellapsed_print("6")
+                stored = WarTag.get_states([wt.war_tag for r in lg.rounds for wt in r.war_tags])
                 for r in lg.rounds:
-                    r.war_tags[:] = [wt for wt in r.war_tags if not wt.exists()]
+                    r.war_tags[:] = [
+                        wt for wt in r.war_tags if wt.war_tag not in stored and not WarTag.is_ended(wt.war_tag)
+                    ]
                 clan = self.get_clan(clan_tag, save_to_db=save_to_db)
                 lg.league_id = clan.war_league
             if ob:
@@ -470,8 +502,11 @@ class ModelControler:
         # players = []
         return lg.id
 
-    def get_war_from_war_tag(self, war_tag, round_id, save_to_db=False):
-        wdict = self.req.get_league_war(war_tag)
+    def get_war_from_war_tag(self, war_tag, round_id, save_to_db=False, wdict=None):
+        if isinstance(wdict, Exception):
+            raise wdict
+        if wdict is None:
+            wdict = self.req.get_league_war(war_tag)
         # print("3333", wdict)
         wdict["league_round_id"] = round_id
         wdict["war_tag"] = war_tag
@@ -507,27 +542,23 @@ class ModelControler:
         if save_to_db:
             ## if we have an old war and it wasn't already inserted(war ended)
             ## put in the new info
-            if obs:
-                dobs = {x._eq_key_(): x for x in obs}
-                not_found = {x._eq_key_(): x for x in wars if x._eq_key_() not in dobs}
-                # t.ellapsed_print(" have obs", len(obs))
-                # print(obs)
-                # print("have old war!!", ob)
-                for ob in dobs.values():
-                    if ob.state != WarState.war_ended:
-                        sd = war._copy_ids_from(ob)
-                        for c, lo in sd.items():
-                            for o in lo:
-                                db.session.delete(o)
-                        db.session.merge(war)
-                        # t.ellapsed_print("     merged", len(obs))
-                db.session.add_all(not_found.values())
-                db.session.commit()
-            else:
-                # t.ellapsed_print(" adding")
-                db.session.add_all(wars)
-                db.session.commit()
-                # t.ellapsed_print(" committed")
+            dobs = {x._eq_key_(): x for x in obs}
+            ## both clans of a war can be in the same batch of war logs
+            dwars = {x._eq_key_(): x for x in wars}
+            for key, ob in dobs.items():
+                war = dwars.get(key)
+                if war is not None and ob.state != WarState.war_ended:
+                    sd = ob._update_from(war)
+                    for c, lo in (sd or {}).items():
+                        for o in lo:
+                            db.session.delete(o)
+                    # t.ellapsed_print("     merged", len(obs))
+            War._bulk_insert([w for key, w in dwars.items() if key not in dobs])
+            db.session.commit()
+            # t.ellapsed_print(" committed")
+            ## the stored or just inserted war for every occurrence, a war in both clans'
+            ## logs was only inserted once
+            wars = [dobs.get(k) or dwars[k] for k in (w._eq_key_() for w in wars)]
 
         return wars
 
@@ -547,12 +578,13 @@ class ModelControler:
             if ob:
                 # print("have old war!!", ob)
                 if ob.state != WarState.war_ended:
-                    sd = war._copy_ids_from(ob)
-                    for c, lo in sd.items():
-                        for o in lo:
-                            db.session.delete(o)
-                    db.session.merge(war)
-                    db.session.commit()
+                    sd = ob._update_from(war)
+                    if sd is not None:
+                        for c, lo in sd.items():
+                            for o in lo:
+                                db.session.delete(o)
+                        db.session.commit()
+                    war = ob
             else:
                 db.session.add(war)
                 db.session.commit()
@@ -567,34 +599,33 @@ class ModelControler:
             clandict = self.req.get_clan_members(tag)
             clan_dicts[tag] = clandict
             for pdict in clandict["items"]:
-                players[pdict["tag"]] = Player.odict_from_dict(pdict)
+                players[pdict["tag"]] = Player._odict_from_dict(pdict)
         if save_to_db:
-            self.dbcont.insert_players(players)
+            self.dbcont._insert_players_or_clans(players, Player, PlayerNameHistory)
 
-        temp = Player.get_last_histories(list(players.keys()))
+        temp = Player._get_last_histories(list(players.keys()))
         dict_hists = {e.tag: e for e in temp}
         # temp = self.dbcont.get_last_names(PlayerHistory, list(players.keys()))
         # dict_names = {e.tag: e for e in temp}
         now = datetime.utcnow()
         new_entries = []
+        touched = []
 
         ###
         for tag in tags:
             clandict = clan_dicts[tag]
             for pdict in clandict["items"]:
                 ph = PlayerHistory(**pdict)
+                ph.entry_type = EntryType.from_clan_members
                 lh = dict_hists.get(ph.tag, None)
-                if lh:
-                    lh.entry_type = EntryType.from_clan_members
                 if not lh or lh != ph:
                     new_entries.append(ph)
-                elif (lh.last_check - now).total_seconds() >= MIN_TIME_TO_UPDATE:
-                    lh.last_check = now
-                    if save_to_db:
-                        lh.update()  ## update the check time
-        # print("new and update=", len(new_entries), len(updates))
+                elif (now - lh.last_check).total_seconds() >= MIN_TIME_TO_UPDATE:
+                    touched.append(lh.id)  ## update the check time
+        # print("new and touched=", len(new_entries), len(touched))
         if save_to_db:
             db.session.bulk_save_objects(new_entries)
+            Player._touch_last_histories(touched, now)
             db.session.commit()
         return players
 
@@ -671,6 +702,159 @@ class ModelControler:
         # print(" -------- _get_player_or_clan")
         return p
 
+    def _get_players_or_clans(
+        self,
+        pdicts,
+        main_cls,
+        hist_cls,
+        name_hist_cls,
+        desc_cls=None,
+        entry_type=None,
+        save_to_db=False,
+    ):
+        """_get_player_or_clan for many at once. Existence, known names, known
+        descriptions and last histories are each one query per TAG_CHUNK_SIZE tags, and
+        everything is written in a single commit. Returns {tag: player or clan}.
+
+        With save_to_db the returned objects are loaded from the db after the commit, with
+        history holding just the last history and names/descriptions what was inserted"""
+        obs = {}
+        for pdict in pdicts:
+            if entry_type:
+                pdict["entry_type"] = entry_type.value
+            p = main_cls(**pdict)
+            dh = None if not desc_cls else desc_cls(**pdict)
+            obs[p.tag] = (p, hist_cls(**pdict), name_hist_cls(**pdict), dh)
+        if not save_to_db or not obs:
+            for p, ph, nh, dh in obs.values():
+                if dh:
+                    ph._description = dh.description
+                    ph._description_obj = dh
+                    p.descriptions.append(dh)
+                p.names.append(nh)
+                p.history.append(ph)
+            return {tag: o[0] for tag, o in obs.items()}
+
+        now = datetime.utcnow()
+        renamed = []
+        stored = {}  ## tag: (last history, [inserted names], [inserted descriptions])
+        for c in chunks(list(obs.values()), TAG_CHUNK_SIZE):
+            tags = [p.tag for p, ph, nh, dh in c]
+            existing = {r[0] for r in db.session.query(main_cls.tag).filter(main_cls.tag.in_(tags))}
+            names = set(
+                db.session.query(name_hist_cls.tag, name_hist_cls.name).filter(
+                    name_hist_cls.tag.in_(tags), name_hist_cls.name.in_({nh.name for p, ph, nh, dh in c})
+                )
+            )
+            descs = {}
+            if desc_cls:
+                q = db.session.query(desc_cls.tag, desc_cls.description, desc_cls.id).filter(
+                    desc_cls.tag.in_(tags), desc_cls.description.in_({dh.description for p, ph, nh, dh in c})
+                )
+                descs = {(t, d): i for t, d, i in q}
+            last = {lh.tag: lh for lh in main_cls._get_last_histories(tags)}
+
+            ## new mains are bulk inserted, descriptions are flushed for their ids and
+            ## names and histories inserted with theirs
+            new_mains, new_names, new_descs, new_hists = [], [], [], []
+            for p, ph, nh, dh in c:
+                if p.tag not in existing:
+                    new_mains.append(p)
+                    new_names.append(nh)
+                    if dh:
+                        new_descs.append((ph, dh))
+                    continue
+                if dh:
+                    if (dh.tag, dh.description) in descs:
+                        ph.description_id = descs[(dh.tag, dh.description)]
+                    else:
+                        new_descs.append((ph, dh))
+                if (nh.tag, nh.name) not in names:
+                    new_names.append(nh)
+                    renamed.append({"_tag": p.tag, "name": nh.name})
+            db.session.bulk_save_objects(new_mains)
+            _insert_detached(new_names, now)
+            db.session.add_all([dh for ph, dh in new_descs])
+            db.session.flush()
+            for ph, dh in new_descs:
+                ph.description_id = dh.id
+
+            touched = []
+            inserted = {id(o) for o in new_names + [dh for ph, dh in new_descs]}
+            for p, ph, nh, dh in c:
+                lh = last.get(p.tag) if p.tag in existing else None
+                if lh is None or lh != ph:
+                    new_hists.append(ph)
+                    lh = ph
+                elif (now - lh.last_check).total_seconds() >= MIN_TIME_TO_UPDATE:
+                    touched.append(lh.id)  ## update the check time
+                stored[p.tag] = (lh, [nh] if id(nh) in inserted else [], [dh] if id(dh) in inserted else [])
+            _insert_detached(new_hists, now)
+            main_cls._touch_last_histories(touched, now)
+        if renamed:
+            t = main_cls.__table__
+            db.session.execute(t.update().where(t.c.tag == bindparam("_tag")).values(name=bindparam("name")), renamed)
+        db.session.commit()
+
+        ## the stored rows, with what was just inserted put back into the session
+        r = {}
+        for c in chunks(list(obs), TAG_CHUNK_SIZE):
+            r.update((p.tag, p) for p in db.session.query(main_cls).filter(main_cls.tag.in_(c)))
+        for tag, (p, ph, nh, dh) in obs.items():
+            lh, nhs, dhs = stored[tag]
+            for o in [lh] + nhs + dhs:
+                db.session.add(o)
+            if dh:
+                lh._description = dh.description
+            p = r[tag]
+            set_committed_value(p, "history", [lh])
+            set_committed_value(p, "names", nhs)
+            if desc_cls:
+                set_committed_value(p, "descriptions", dhs)
+        return r
+
+    def _get_many(self, ds, return_exceptions, *args, **kwargs):
+        """_get_players_or_clans over the dicts fetched into ds. If the batch write fails,
+        e.g. another crawler inserted one of the new tags meanwhile, it is rolled back and
+        each tag is saved on its own with _get_player_or_clan"""
+        pdicts = [d for d in ds.values() if not isinstance(d, Exception)]
+        try:
+            r = self._get_players_or_clans(pdicts, *args, **kwargs)
+        except DatabaseError as e:
+            db.session.rollback()
+            print(f"batch of {len(pdicts)} failed, saving one at a time: {e}")
+            r = {}
+            for d in pdicts:
+                try:
+                    r[d["tag"]] = self._get_player_or_clan(d, *args, **kwargs)
+                except DatabaseError as e:
+                    db.session.rollback()
+                    if not return_exceptions:
+                        raise
+                    r[d["tag"]] = e
+        return {tag: d if isinstance(d, Exception) else r[d["tag"]] for tag, d in ds.items()}
+
+    def get_players(self, tags, save_to_db=False, return_exceptions=False):
+        """get_player for many tags, fetched concurrently and written in one commit.
+        Returns {tag: Player}, or the exception for a tag if return_exceptions is set"""
+        ds = self.req.get_players_many(tags, return_exceptions=return_exceptions)
+        return self._get_many(ds, return_exceptions, Player, PlayerHistory, PlayerNameHistory, save_to_db=save_to_db)
+
+    def get_clans(self, tags, save_to_db=False, return_exceptions=False):
+        """get_clan for many tags, fetched concurrently and written in one commit.
+        Returns {tag: Clan}, or the exception for a tag if return_exceptions is set"""
+        ds = self.req.get_clans_many(tags, return_exceptions=return_exceptions)
+        return self._get_many(
+            ds,
+            return_exceptions,
+            Clan,
+            ClanHistory,
+            ClanNameHistory,
+            ClanDescriptionHistory,
+            entry_type=EntryType.from_clan,
+            save_to_db=save_to_db,
+        )
+
     def get_player(self, tag, save_to_db=False):
         d = self.req.get_player(tag)
         return self._get_player_or_clan(
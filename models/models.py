@@ -1,9 +1,12 @@
 import collections
+import hashlib
 import re
 from datetime import date, datetime, timedelta
 from enum import IntEnum
+from functools import lru_cache
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 from sqlalchemy import (
     DDL,
     Boolean,
@@ -12,23 +15,32 @@ from sqlalchemy import (
     DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     and_,
     or_,
+    select,
 )
 from sqlalchemy.event import listen
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy.orm import backref, make_transient_to_detached, relationship, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.schema import Table
 from sqlalchemy.sql import func
 
 from models.db import Base as DBBase
+from models.db import Tag
 from models.db import driver
 from models.db import session as dbsession
 from models.exceptions import NotInWarException, TagNotFoundException
 from models.timer import timeit
 from models.utils import chunks, fmt_tag
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 _camel2snake_pattern = re.compile(r"(?<!^)(?=[A-Z])")
 # "20200729T194845.000Z"
 _DATE_STR_FORMAT_ = "%Y%m%dT%H%M%S.%fZ"
@@ -39,22 +51,163 @@ _IN_TAG_CHUNK_SIZE_ = 1000
 _clans_players_association_table = Table(
     "association",
     DBBase.metadata,
-    Column("clan_tag", String(12), ForeignKey("clan.tag")),
-    Column("player_tag", String(12), ForeignKey("player.tag")),
+    Column("clan_tag", Tag(), ForeignKey("clan.tag")),
+    Column("player_tag", Tag(), ForeignKey("player.tag")),
 )
 
 _clans_wars_association_table = Table(
     "clans_2_wars",
     DBBase.metadata,
-    Column("clan_tag", String(12), ForeignKey("clan.tag")),
+    Column("clan_tag", Tag(), ForeignKey("clan.tag")),
     Column("war_id", Integer, ForeignKey("war.id")),
 )
 
+_camel2snake = {}  # the api only ever sends a few hundred distinct keys
+
+
 def camel_to_snake(name):
-    return _camel2snake_pattern.sub("_", name).lower()
+    s = _camel2snake.get(name)
+    if s is None:
+        s = _camel2snake[name] = _camel2snake_pattern.sub("_", name).lower()
+    return s
+
+
+def _parse_api_time(value):
+    """Parse an api timestamp, "20200729T194845.000Z", by position instead of strptime"""
+    if len(value) == 20 and value[8] == "T" and value[15] == ".":
+        return datetime(
+            int(value[0:4]),
+            int(value[4:6]),
+            int(value[6:8]),
+            int(value[9:11]),
+            int(value[11:13]),
+            int(value[13:15]),
+            int(value[16:19]) * 1000,
+        )
+    return datetime.strptime(value, _DATE_STR_FORMAT_)
+
+
+_api_field_maps = {}  # model class -> {api key: (attribute, converter)}
+
+
+def _api_field(cls, key):
+    overrides = getattr(cls, "__api_fields__", {})
+    if key in overrides:
+        f = overrides[key]
+        if f is None:  ## skipped, or handled by the constructor itself
+            return (None, None)
+        return (f, None) if isinstance(f, str) else f
+    if key.endswith("Time"):
+        return (camel_to_snake(key), _parse_api_time)
+    return (camel_to_snake(key), None)
+
+
+def _set_from_api(obj, kwargs):
+    """Set obj's attributes from an api dict.
+
+    Each key's attribute and converter is worked out once per class: the class's
+    __api_fields__ maps a key to an attribute name, an (attribute, converter) pair or
+    None to skip it. Other keys become their snake_case name, keys ending in Time are
+    parsed as api timestamps.
+    """
+    cls = type(obj)
+    fields = _api_field_maps.get(cls)
+    if fields is None:
+        fields = _api_field_maps[cls] = {}
+    for key, value in kwargs.items():
+        f = fields.get(key)
+        if f is None:
+            f = fields[key] = _api_field(cls, key)
+        attr, convert = f
+        if attr is not None:
+            setattr(obj, attr, value if convert is None else convert(value))
+
+
+def _columns(obj):
+    """Column values of a new obj as a row dict, keyed by column name"""
+    d = obj.__dict__  ## skips the instrumented getters, unset columns are None
+    return {c.name: d.get(k) for k, c in _column_keys(type(obj))}
+
+
+@lru_cache(maxsize=None)
+def _column_keys(cls):
+    return [(p.key, p.columns[0]) for p in cls.__mapper__.column_attrs]
+
+
+def _copy_columns(to, frm, skip=("id",)):
+    """Set the columns of a stored object to the values of a new one, leaving out skip
+    and values the new one doesn't have. Unchanged values aren't touched"""
+    d = frm.__dict__
+    for k, _ in _column_keys(type(frm)):
+        v = d.get(k)
+        if v is not None and k not in skip and getattr(to, k) != v:
+            setattr(to, k, v)
+
+
+def _content_hash(*parts):
+    """Stable digest of the api values that can change while a war is running"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def _insert_rows(table, rows):
+    """Insert rows into table with one executemany, returns their generated ids in order.
+
+    On sqlite the transaction holds the write lock from the first row on, so the rows
+    get consecutive rowids ending at last_insert_rowid(). On mysql the ids are
+    allocated up front from the locked MAX(id).
+    """
+    if not rows:
+        return []
+    conn = dbsession.connection()
+    if driver.is_sqlite():
+        conn.execute(table.insert(), rows)
+        last = conn.execute("SELECT last_insert_rowid()").scalar()
+        return list(range(last - len(rows) + 1, last + 1))
+    ## FOR UPDATE holds the end of the index so nobody else can take these ids
+    q = select([func.coalesce(func.max(table.c.id), 0)]).with_for_update()
+    start = conn.execute(q).scalar() + 1
+    ids = list(range(start, start + len(rows)))
+    for row, i in zip(rows, ids):
+        row["id"] = i
+    for chunk in chunks(rows, _IN_TAG_CHUNK_SIZE_):
+        conn.execute(table.insert(), chunk)
+    return ids
+
+
+def _insert_detached(objs, now):
+    """Insert new objects of one class with _insert_rows. Server defaulted datetimes they
+    don't have are set to now, so like everything else they are in the row. They get
+    their ids and are detached as if loaded from the db, so adding them to a session
+    later can't insert them again"""
+    if not objs:
+        return objs
+    keys = _column_keys(type(objs[0]))
+    for o in objs:
+        for k, c in keys:
+            if c.server_default is not None and isinstance(c.type, DateTime) and o.__dict__.get(k) is None:
+                setattr(o, k, now)
+    rows = [_columns(o) for o in objs]
+    for r in rows:
+        r.pop("id")
+    for o, i in zip(objs, _insert_rows(type(objs[0]).__table__, rows)):
+        o.id = i
+        ## columns that were never set are NULL in the row, not expired
+        for k, c in keys:
+            if k not in o.__dict__:
+                set_committed_value(o, k, None)
+        make_transient_to_detached(o)
+    return objs
 
 
 def _get_last(hcls, tags):
+    latest = _latest_tables.get(hcls)
+    if latest is not None:
+        return (
+            dbsession.query(hcls)
+            .join(latest, hcls.id == latest.history_id)
+            .filter(latest.tag.in_(tags))
+            .all()
+        )
     subq = (
         dbsession.query(hcls.id, func.max(hcls.last_check).label("most_recent"))
         .filter(hcls.tag.in_(tags))
@@ -65,6 +218,14 @@ def _get_last(hcls, tags):
     return q
 
 
+def _touch_last_check(hcls, ids, now):
+    """Set last_check of the history rows with these ids, one UPDATE per chunk. The latest
+    table triggers see it like any other update"""
+    t = hcls.__table__
+    for chunk in chunks(list(ids), _IN_TAG_CHUNK_SIZE_):
+        dbsession.execute(t.update().where(t.c.id.in_(chunk)).values(last_check=now))
+
+
 class WarResult(IntEnum):
     tie = 0
     clan1_win = 1
@@ -186,6 +347,13 @@ class WarState(IntEnum):
             raise
 
 
+class GroupStatus(IntEnum):
+    """Ours, not the api's state: whether every war of a league group has ended"""
+
+    open = 0
+    finished = 1
+
+
 class WarType(IntEnum):
     normal = 0
     friendly = 1
@@ -195,6 +363,21 @@ class WarType(IntEnum):
         return self.name
 
 
+@lru_cache(maxsize=None)
+def _war_state(label):
+    return WarState.from_str(label).value
+
+
+@lru_cache(maxsize=None)
+def _war_frequency(label):
+    return WarFrequency.from_str(label).value
+
+
+@lru_cache(maxsize=None)
+def _clan_entry_type(label):
+    return ClanEntryType.from_str(label).value
+
+
 class WarAttack(DBBase):
     __tablename__ = "war_attack"
     __table_args__ = {"extend_existing": True}
@@ -204,15 +387,14 @@ class WarAttack(DBBase):
     war_player = relationship("WarPlayer", back_populates="attacks")
     war_id = Column(Integer, ForeignKey("war.id"), index=True)
     war_player_id = Column(Integer, ForeignKey("war_player.id"), index=True)
-    attacker_tag = Column(String(12), ForeignKey("player.tag"), nullable=False, index=True)
-    defender_tag = Column(String(12), ForeignKey("player.tag"), nullable=False, index=True)
+    attacker_tag = Column(Tag(), ForeignKey("player.tag"), nullable=False, index=True)
+    defender_tag = Column(Tag(), ForeignKey("player.tag"), nullable=False, index=True)
     stars = Column(Integer)
     destruction_percentage = Column(Integer)
     order = Column(Integer)
 
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
 
     def __str__(self):
         return f"({self.attacker_tag} -> {self.defender_tag} ({self.destruction_percentage}%) {self.stars} star(s))"
@@ -222,11 +404,12 @@ class WarAttack(DBBase):
 
     @property
     def attacker_th(self):
-        return self.war_members.town_hall_level
+        return self.war_player.town_hall_level
 
     @property
     def defender_th(self):
-        p = self.war.get_player(self.defender_tag)
+        war = self.war or self.war_player.parent.parent
+        p = war.get_player(self.defender_tag)
         return p.town_hall_level if p else None
 
     def _copy_ids_from(self, from_other, recursive=True):
@@ -243,11 +426,18 @@ class WarPlayer(DBBase):
     id = Column(Integer, primary_key=True, autoincrement=True)
     war_clan_id = Column(Integer, ForeignKey("war_clan.id"), index=True)
     parent = relationship("WarClan", back_populates="members")
-    tag = Column("tag", String(12), ForeignKey("player.tag"), nullable=False, index=True)
+    tag = Column("tag", Tag(), ForeignKey("player.tag"), nullable=False, index=True)
     town_hall_level = Column(Integer)
     map_position = Column(Integer)
     attacks = relationship("WarAttack", lazy="joined", back_populates="war_player")
 
+    __api_fields__ = {
+        "bestOpponentAttack": None,
+        "attacks": None,
+        "townHallLevel": "town_hall_level",
+        "townhallLevel": "town_hall_level",  # this is sometimes mispelled from api
+    }
+
     def _copy_ids_from(self, from_other, recursive=True):
         if not isinstance(from_other, WarPlayer):
             raise NotImplemented
@@ -266,16 +456,9 @@ class WarPlayer(DBBase):
         return should_delete
 
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            if attr == "bestOpponentAttack":
-                continue
-            if attr.lower() == "townhalllevel":  # this is sometimes mispelled from api
-                setattr(self, "town_hall_level", value)
-            elif attr == "attacks":
-                for a in kwargs["attacks"]:
-                    self.attacks.append(WarAttack(**a))
-            else:
-                setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
+        for a in kwargs.get("attacks", []):
+            self.attacks.append(WarAttack(**a))
 
     @property
     def best_opponent_attack(self):
@@ -305,18 +488,17 @@ class LeaguePlayer(DBBase):
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    tag = Column("tag", String(12), ForeignKey("player.tag"), nullable=False, index=True)
+    tag = Column("tag", Tag(), ForeignKey("player.tag"), nullable=False, index=True)
     town_hall_level = Column(Integer)
     league_clan_id = Column("league_clan_id", Integer, ForeignKey("league_clan.id"), index=True)
     parent = relationship("LeagueClan", back_populates="members")
     league_season_id = Column("league_season_id", Integer, ForeignKey("league_season.id"), index=True)
     in_league = Column(Boolean, default=True)
 
+    __api_fields__ = {"townhallLevel": "town_hall_level"}  # this is sometimes mispelled from api
+
     def __init__(self, league_season_id, **kwargs):
-        for attr, value in kwargs.items():
-            if attr == "townhallLevel":  # this is sometimes mispelled from api
-                attr = "townHallLevel"
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
         self.league_season_id = league_season_id
 
     @staticmethod
@@ -333,70 +515,64 @@ class LeaguePlayer(DBBase):
             return "unknown"
 
     @staticmethod
-    def get_clan_names(player_tags):
-        # print("######@@@@@@@@@@@@@@@@@@@@@@##\n", type(player_tag), "####00000000000#####\n")
-        r = []
-        for c in chunks(player_tags, _IN_TAG_CHUNK_SIZE_):
-            # print(len(c))
-            myl = list(c)
-            d = collections.OrderedDict([(x, None) for x in myl])
-            # print("stenwentes", len(d), len(myl))
-            clan_ids = (
-                dbsession.query(LeaguePlayer.tag, LeaguePlayer.league_clan_id)
-                .filter(LeaguePlayer.tag.in_(myl))
-                .all()
-            )
-            dclan_ids = {x[0]: x[1] for x in clan_ids}
-            for pt in d:
-                d[pt] = dclan_ids.get(pt, None)
-            # print(len(d), len([x for x in d.values() if x is not None]))
-            ids = [x[1] for x in clan_ids]
-            clan_tags = (
-                dbsession.query(LeagueClan.id, LeagueClan.tag).filter(LeagueClan.id.in_(ids)).all()
-            )
-            dclan_tags = {x[0]: x[1] for x in clan_tags}
-            for pt, clan_id in d.items():
-                d[pt] = dclan_tags.get(clan_id, None)
-            # print(len(d), len([x for x in d.values() if x is not None]))
-            cnames = (
-                dbsession.query(Clan.tag, Clan.name).filter(Clan.tag.in_(dclan_tags.values())).all()
-            )
-            dcnames = {x[0]: x[1] for x in cnames}
-            for pt, clan_tag in d.items():
-                if clan_tag and clan_tag in dcnames:
-                    d[pt] = dcnames[clan_tag]
-            # print(len(d), len([x for x in d.values() if x is not None]))
-            r.extend([d.get(x, None) for x in myl])
-        return r
+    def get_clan_names(player_tags, league_season_id=None):
+        """Name of each player's league clan, its tag if the clan isn't stored"""
+        return [r[2] or r[1] for r in SeasonClanResolver(league_season_id).resolve(player_tags)]
 
     @staticmethod
-    def get_clan_tags(player_tags):
-        # print("######@@@@@@@@@@@@@@@@@@@@@@##\n", type(player_tag), "####00000000000#####\n")
-        r = []
-        for c in chunks(player_tags, _IN_TAG_CHUNK_SIZE_):
-            # print(len(c))
+    def get_clan_tags(player_tags, league_season_id=None):
+        return [r[1] for r in SeasonClanResolver(league_season_id).resolve(player_tags)]
+
+
+class SeasonClanResolver:
+    """Resolves player tags to (name, clan_tag, clan_name) of the clan they played
+    league wars for, one joined query per chunk of tags. Answers are kept, so one
+    resolver can be shared by every league of a season.
+
+    Args:
+        league_season_id: The season to look in. None for the latest season each
+            player played in
+    """
+
+    def __init__(self, league_season_id=None):
+        self.league_season_id = league_season_id
+        self._resolved = {}
+
+    def resolve(self, player_tags):
+        player_tags = list(player_tags)
+        todo = list(dict.fromkeys(t for t in player_tags if t not in self._resolved))
+        for c in chunks(todo, _IN_TAG_CHUNK_SIZE_):
             myl = list(c)
-            d = collections.OrderedDict([(x, None) for x in myl])
-            # print("stenwentes", len(d), len(myl))
-            clan_ids = (
-                dbsession.query(LeaguePlayer.tag, LeaguePlayer.league_clan_id)
-                .filter(LeaguePlayer.tag.in_(myl))
-                .all()
+            on = LeaguePlayer.tag == Player.tag
+            if self.league_season_id is not None:
+                on = and_(on, LeaguePlayer.league_season_id == self.league_season_id)
+            q = (
+                dbsession.query(Player.tag, Player.name, LeagueClan.tag, Clan.name)
+                .select_from(Player)
+                .outerjoin(LeaguePlayer, on)
+                .outerjoin(LeagueClan, LeagueClan.id == LeaguePlayer.league_clan_id)
+                .outerjoin(Clan, Clan.tag == LeagueClan.tag)
+                .filter(Player.tag.in_(myl))
+                .order_by(LeaguePlayer.league_season_id, LeaguePlayer.id)  ## latest wins
             )
-            dclan_ids = {x[0]: x[1] for x in clan_ids}
-            for pt in d:
-                d[pt] = dclan_ids.get(pt, None)
-            # print(len(d), len([x for x in d.values() if x is not None]))
-            ids = [x[1] for x in clan_ids]
-            clan_tags = (
-                dbsession.query(LeagueClan.id, LeagueClan.tag).filter(LeagueClan.id.in_(ids)).all()
-            )
-            dclan_tags = {x[0]: x[1] for x in clan_tags}
-            for pt, clan_id in d.items():
-                d[pt] = dclan_tags.get(clan_id, None)
-            # print(len(d), len([x for x in d.values() if x is not None]))
-            r.extend([d.get(x, None) for x in myl])
-        return r
+            for tag, name, clan_tag, clan_name in q.all():
+                self._resolved[tag] = (name, clan_tag, clan_name)
+            missing = [t for t in myl if t not in self._resolved]
+            if missing:  ## league players we never stored as players
+                q = (
+                    dbsession.query(LeaguePlayer.tag, LeagueClan.tag, Clan.name)
+                    .join(LeagueClan, LeagueClan.id == LeaguePlayer.league_clan_id)
+                    .outerjoin(Clan, Clan.tag == LeagueClan.tag)
+                    .filter(LeaguePlayer.tag.in_(missing))
+                    .order_by(LeaguePlayer.league_season_id, LeaguePlayer.id)
+                )
+                if self.league_season_id is not None:
+                    q = q.filter(LeaguePlayer.league_season_id == self.league_season_id)
+                for tag, clan_tag, clan_name in q.all():
+                    self._resolved[tag] = (None, clan_tag, clan_name)
+            for tag in myl:
+                self._resolved.setdefault(tag, (None, None, None))
+        return [self._resolved[t] for t in player_tags]
 
 
 class LeagueClan(DBBase):
@@ -404,19 +580,18 @@ class LeagueClan(DBBase):
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    tag = Column("tag", String(12), ForeignKey("clan.tag"), nullable=False)
+    tag = Column("tag", Tag(), ForeignKey("clan.tag"), nullable=False)
     league_group_id = Column("league_group_id", Integer, ForeignKey("league_group.id"), index=True)
     league_season_id = Column("league_season_id", Integer, ForeignKey("league_season.id"), index=True)
     members = relationship("LeaguePlayer", lazy="joined", back_populates="parent")
     in_league = Column(Boolean, default=True)
     parent = relationship("LeagueGroup", back_populates="clans")
 
+    __api_fields__ = {"members": None}
+
     def __init__(self, league_season_id, **kwargs):
         self.league_season_id = league_season_id
-        for attr, value in kwargs.items():
-            if attr == "members":
-                continue
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
         if "members" in kwargs:
             for m in kwargs["members"]:
                 self.members.append(LeaguePlayer(league_season_id, **m))
@@ -437,7 +612,7 @@ class WarClan(DBBase):
     id = Column(Integer, primary_key=True, autoincrement=True)
     war_id = Column("war_id", Integer, ForeignKey("war.id"), index=True)
     parent = relationship("War", back_populates="clans")
-    tag = Column("tag", String(12), ForeignKey("clan.tag"), index=True)
+    tag = Column("tag", Tag(), ForeignKey("clan.tag"), index=True)
     clan_level = Column(Integer)
     attacks = Column(Integer)
     stars = Column(Integer)
@@ -445,14 +620,31 @@ class WarClan(DBBase):
     exp_earned = Column(Integer)
 
     members = relationship("WarPlayer", lazy="joined", back_populates="parent")
+    content_hash = Column(String(40))
+
+    __api_fields__ = {"members": None}
 
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            if attr == "members":
-                continue
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
+        ## war log entries have no members, they say nothing about who is in the war
+        self._has_members = "members" in kwargs
         for m in kwargs.get("members", []):
             self.members.append(WarPlayer(**m))
+        self.content_hash = _content_hash(
+            kwargs.get("stars"),
+            kwargs.get("destructionPercentage"),
+            kwargs.get("attacks"),
+            kwargs.get("expEarned"),
+            sorted(
+                (
+                    m["tag"],
+                    m.get("townhallLevel", m.get("townHallLevel")),
+                    m.get("mapPosition"),
+                    [(a["defenderTag"], a["stars"], a["destructionPercentage"], a.get("order")) for a in m.get("attacks", [])],
+                )
+                for m in kwargs.get("members", [])
+            ),
+        )
 
     def __str__(self):
         return f"(WarClan {self.name} #atks={self.attacks} stars={self.stars} d%={self.destruction_percentage}"
@@ -475,6 +667,66 @@ class WarClan(DBBase):
                 should_delete[WarPlayer].append(p)
         return should_delete
 
+    def _update_from(self, new, war, should_delete):
+        """Bring this stored side up to date with new, moving over the members and
+        attacks it doesn't have yet and adding the ones it no longer has to should_delete.
+        A side without members (a war log entry) only updates the clan's own columns"""
+        if not getattr(new, "_has_members", True):
+            _copy_columns(self, new, ("id", "war_id", "content_hash"))
+            return
+        _copy_columns(self, new, ("id", "war_id"))
+        mine = {p.tag: p for p in self.members}
+        for p in list(new.members):
+            op = mine.pop(p.tag, None)
+            if op is None:
+                self.members.append(p)
+                for a in p.attacks:
+                    a.war = war
+                continue
+            _copy_columns(op, p, ("id", "war_clan_id"))
+            ma = {f"{a.attacker_tag}:{a.defender_tag}": a for a in op.attacks}
+            for a in list(p.attacks):
+                oa = ma.pop(f"{a.attacker_tag}:{a.defender_tag}", None)
+                if oa is None:
+                    op.attacks.append(a)
+                    a.war = war
+                else:
+                    _copy_columns(oa, a, ("id", "war_id", "war_player_id"))
+            should_delete[WarAttack].extend(ma.values())
+        for op in mine.values():
+            should_delete[WarAttack].extend(op.attacks)
+            should_delete[WarPlayer].append(op)
+
+
+def _war_status(start_time, end_time):
+    now = datetime.now()
+    if end_time < now:
+        return WarState.war_ended
+    elif start_time < now:
+        return WarState.in_war
+    else:
+        return WarState.preparation
+
+
+class WarTagState(
+    collections.namedtuple(
+        "WarTagState", "war_tag war_id league_round_id stored_war_id stored_round_id start_time end_time"
+    )
+):
+    """A league war tag and the stored war it points to (stored_* are None if there
+    isn't one yet), from WarTag.get_states"""
+
+    __slots__ = ()
+
+    @property
+    def war_status(self):
+        return _war_status(self.start_time, self.end_time)
+
+
+## war tags whose war has ended and is stored with its round and id. Nothing is left
+## to fetch for them, so they are skipped for the rest of the process
+_ended_war_tags = set()
+
 
 class WarTag(DBBase):
     __tablename__ = "war_tag"
@@ -504,6 +756,36 @@ class WarTag(DBBase):
     def exists(self):
         return dbsession.query(WarTag.war_tag).filter(WarTag.war_tag == self.war_tag).scalar()
 
+    @staticmethod
+    def get_states(war_tags):
+        """{war_tag: WarTagState} for the war tags in the db, with the stored war (if
+        any) outer joined, one query per _IN_TAG_CHUNK_SIZE_ tags.
+
+        Tags already known to be ended aren't looked up again, see WarTag.is_ended.
+        Tags found ended, with their round and war id stored, are added to that set
+        """
+        wt, w = WarTag.__table__, War.__table__
+        states = {}
+        todo = [t for t in set(war_tags) if t not in _ended_war_tags]
+        for c in chunks(todo, _IN_TAG_CHUNK_SIZE_):
+            q = (
+                select(
+                    [wt.c.war_tag, wt.c.war_id, wt.c.league_round_id]
+                    + [w.c.id, w.c.league_round_id, w.c.start_time, w.c.end_time]
+                )
+                .select_from(wt.outerjoin(w, w.c.war_tag == wt.c.war_tag))
+                .where(wt.c.war_tag.in_(c))
+            )
+            for r in dbsession.execute(q).fetchall():
+                st = states[r[0]] = WarTagState(*r)
+                if st.war_id is not None and st.stored_round_id is not None and st.war_status == WarState.war_ended:
+                    _ended_war_tags.add(st.war_tag)
+        return states
+
+    @staticmethod
+    def is_ended(war_tag):
+        return war_tag in _ended_war_tags
+
 class LeagueRound(DBBase):
     __tablename__ = "league_round"
     __table_args__ = {"extend_existing": True}
@@ -582,25 +864,27 @@ class LeagueRound(DBBase):
 class LeagueGroup(DBBase):
     ### TODO state doesn't really mean much in group as it doesn't always reflect db status
     __tablename__ = "league_group"
-    __table_args__ = {"extend_existing": True}
+    __table_args__ = (
+        Index("ix_league_group_season_id_status", "season_id", "status", "id"),
+        {"extend_existing": True},
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     state = Column(Integer)
     league_id = Column(Integer)
     league_season_id = Column("season_id", Integer, ForeignKey("league_season.id"), index=True)
+    ## GroupStatus, set by update_status once the last round has ended
+    status = Column(Integer, nullable=False, default=GroupStatus.open.value)
+    finished_at = Column(DateTime)
     clans = relationship("LeagueClan")
     rounds = relationship("LeagueRound", back_populates="parent")
     parent = relationship("LeagueSeason", back_populates="groups")
 
+    __api_fields__ = {"season": None, "clans": None, "rounds": None, "state": ("state", _war_state)}
+
     def __init__(self, league_season_id, **kwargs):
         self.league_season_id = league_season_id
-        for attr, value in kwargs.items():
-            if attr in ("season", "clans", "rounds"):
-                pass
-            elif attr == "state":
-                setattr(self, attr, WarState.from_str(value).value)
-            else:
-                setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
 
         for c in kwargs["clans"]:
             self.clans.append(LeagueClan(league_season_id, **c))
@@ -619,15 +903,33 @@ class LeagueGroup(DBBase):
         return c == 28  # 7 rounds, 4 war_tags per round
 
     def finished(self):
+        if self.status == GroupStatus.finished:
+            return True
+        return self._all_wars_ended()
+
+    def _all_wars_ended(self):
         if not self.has_all_war_tags():
             return False
         if len(self.rounds) < 7:
             return False
-        for w in self.rounds[-1].wars:
+        last = max(self.rounds, key=lambda r: r.round)
+        ## a war that isn't stored yet hasn't ended as far as we know
+        if len(last.wars) < len(last.war_tags):
+            return False
+        for w in last.wars:
             if w.state != WarState.war_ended:
                 return False
         return True
 
+    def update_status(self):
+        """Mark the group finished if all of its wars have ended. Returns True if
+        the status changed, the caller commits"""
+        if self.status == GroupStatus.finished or not self._all_wars_ended():
+            return False
+        self.status = GroupStatus.finished.value
+        self.finished_at = datetime.utcnow()
+        return True
+
     def _copy_from(self, other, recursive=True):
         if not isinstance(other, LeagueGroup):
             raise NotImplemented
@@ -706,92 +1008,132 @@ class LeagueSeason(DBBase):
     def clans(self):
         return LeagueClan.query.filter(LeagueClan.league_season_id == self.id).all()
 
-    def to_attack_df(self, query_filter=None, limit=None):
-        from models.timer import Timer
-        t = Timer()
+    def iter_unfinished_groups(self, batch_size=100):
+        """Yields the season's groups that aren't finished, reading batch_size at a
+        time in id order. Safe to commit between groups"""
+        last = 0
+        while True:
+            groups = (
+                dbsession.query(LeagueGroup)
+                .filter(
+                    LeagueGroup.league_season_id == self.id,
+                    LeagueGroup.status == GroupStatus.open.value,
+                    LeagueGroup.id > last,
+                )
+                .order_by(LeagueGroup.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not groups:
+                return
+            last = groups[-1].id
+            yield from groups
+            if len(groups) < batch_size:
+                return
+
+    def to_attack_df(self, query_filter=None, limit=None, chunksize=100000, arrow=False):
+        """One row per attack of the season's league wars, with the town hall level of
+        both players in that war.
+
+        A single join streamed chunksize rows at a time, each chunk converted to the
+        compact dtypes in _ATTACK_DF_DTYPES before the next is read. Town halls
+        missing from the db are -1.
+
+        Args:
+            query_filter: Extra filter, eg LeagueGroup.league_id == warleague.value
+            limit (int): Only the attacks of the first limit wars
+            arrow (bool): Return a pyarrow Table instead of a DataFrame
+        """
         if query_filter is None:
             query_filter = LeagueGroup.league_season_id == self.id
         else:
             query_filter = and_(query_filter, LeagueGroup.league_season_id == self.id)
-        r = (
-            dbsession.query(War.id, War.team_size, LeagueRound.round, LeagueGroup.id)
-            .join(LeagueRound, War.league_round_id == LeagueRound.id)
-            .join(LeagueGroup, LeagueRound.league_group_id == LeagueGroup.id)
-            .filter(query_filter)
-        )
+        at, wt = WarAttack.__table__, War.__table__
+        rt, gt = LeagueRound.__table__, LeagueGroup.__table__
+        ap, dp, dc = WarPlayer.__table__.alias("ap"), WarPlayer.__table__.alias("dp"), WarClan.__table__.alias("dc")
+        attacks = at
         if limit:
-            r = r.limit(limit)
-        lwars = r.all()
-        # print(len(lwars))
-        t.ellapsed_print(f"lwars {len(lwars)}")
-        natks = []
-
-        # print(wars)
-        # print(wars[0:10])
-        ID = 0
-        WAR_ID = 1
-        WAR_PLAYER_ID = 2
-        ATTACKER_TAG = 3
-        DEFENDER_TAG = 4
-        for c in chunks(lwars, _IN_TAG_CHUNK_SIZE_):
-            wars = {x[0]: x[1:] for x in c}
-
-            # t.ellapsed_print("wars")
-            # print("----", len(wars))
-            r = dbsession.query(
-                WarAttack.id,
-                WarAttack.war_id,
-                WarAttack.war_player_id,
-                WarAttack.attacker_tag,
-                WarAttack.defender_tag,
-                WarAttack.stars,
-                WarAttack.destruction_percentage,
-                WarAttack.order,
-            ).filter(WarAttack.war_id.in_(wars.keys()))
-            atks = r.all()
-            # t.ellapsed_print(f"atks {len(atks)}")
-            r = dbsession.query(WarPlayer.tag, WarPlayer.town_hall_level).filter(
-                WarPlayer.id.in_([x[WAR_PLAYER_ID] for x in atks])
-            )
-            th_levels = {x[0]: x[1] for x in r.all()}
-            # t.ellapsed_print("a tag")
-
-            r = dbsession.query(WarPlayer.tag, WarPlayer.town_hall_level).filter(
-                WarPlayer.tag.in_([x[DEFENDER_TAG] for x in atks])
+            ## joined as a derived table, mysql has no LIMIT in IN (SELECT ...)
+            wars = (
+                select([wt.c.id])
+                .select_from(wt.join(rt, wt.c.league_round_id == rt.c.id).join(gt, rt.c.league_group_id == gt.c.id))
+                .where(query_filter)
+                .limit(limit)
+                .alias("lw")
             )
-            # print(r, [x[DEFENDER_TAG] for x in atks])
-            th_levels.update({x[0]: x[1] for x in r.all()})
-            # t.ellapsed_print("d tag")
-
-            # print(atks)
-            for a in atks:
-                ar = wars.get(a[WAR_ID], -1)
-                # print("a=", ar)
-                v = list(a)[1:] + [
-                    th_levels.get(a[ATTACKER_TAG], -1),
-                    th_levels.get(a[DEFENDER_TAG], -1),
-                    *ar
+            attacks = at.join(wars, at.c.war_id == wars.c.id)
+        q = (
+            select(
+                [
+                    at.c.war_id,
+                    at.c.war_player_id,
+                    at.c.attacker_tag,
+                    at.c.defender_tag,
+                    at.c.stars,
+                    at.c.destruction_percentage,
+                    at.c.order,
+                    func.coalesce(ap.c.town_hall_level, -1),
+                    func.coalesce(dp.c.town_hall_level, -1),
+                    wt.c.team_size,
+                    rt.c.round,
+                    gt.c.id,
                 ]
-                # print(" v =", v)
-                natks.append(v)
-            # t.ellapsed_print("append")
-            # print(natks)
-
-        a = [
-            "war_id",
-            "war_player_id",
-            "attacker_tag",
-            "defender_tag",
-            "stars",
-            "destruction_percentage",
-            "order",
-            "attacker_th",
-            "defender_th",
-            "team_size",
-            "round_id",
-            "group_id"
-        ]
-        return pd.DataFrame(data=natks, columns=a,)
+            )
+            .select_from(
+                attacks.join(wt, at.c.war_id == wt.c.id)
+                .join(rt, wt.c.league_round_id == rt.c.id)
+                .join(gt, rt.c.league_group_id == gt.c.id)
+                .outerjoin(ap, ap.c.id == at.c.war_player_id)
+                ## the defender is in the attacker's opponent clan of the same war
+                .outerjoin(dc, and_(dc.c.war_id == at.c.war_id, dc.c.id != ap.c.war_clan_id))
+                .outerjoin(dp, and_(dp.c.war_clan_id == dc.c.id, dp.c.tag == at.c.defender_tag))
+            )
+            .where(query_filter)
+        )
+        columns = list(_ATTACK_DF_DTYPES)
+        frames = []
+        result = dbsession.execute(q)
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+            frames.append(_typed_attack_df(pd.DataFrame.from_records(rows, columns=columns)))
+        if not frames:
+            frames.append(_typed_attack_df(pd.DataFrame(columns=columns)))
+        ## the chunks' categories differ, concat would turn the tags back into objects
+        tags = {c: union_categoricals([f[c] for f in frames]) for c in _ATTACK_DF_TAGS}
+        df = pd.concat([f.drop(columns=list(tags)) for f in frames], ignore_index=True)
+        for c, v in tags.items():
+            df[c] = v
+        df = df[columns]
+        if arrow:
+            if not pyarrow:
+                raise ImportError("pyarrow is needed for arrow=True")
+            return pyarrow.Table.from_pandas(df, preserve_index=False)
+        return df
+
+
+## tags are categories from the first chunk on. Columns that can be NULL in the db use
+## the nullable integer dtypes
+_ATTACK_DF_TAGS = ("attacker_tag", "defender_tag")
+_ATTACK_DF_DTYPES = {
+    "war_id": "int32",
+    "war_player_id": "Int32",
+    "attacker_tag": "category",
+    "defender_tag": "category",
+    "stars": "Int8",
+    "destruction_percentage": "Int8",
+    "order": "Int16",
+    "attacker_th": "Int8",
+    "defender_th": "Int8",
+    "team_size": "Int8",
+    "round_id": "Int8",
+    "group_id": "int32",
+}
+
+
+def _typed_attack_df(df):
+    return df.astype(_ATTACK_DF_DTYPES)
 
 
 class Tournament(DBBase):
@@ -807,16 +1149,65 @@ class Tournament(DBBase):
     wars = relationship("War", lazy="joined", back_populates="tournament")
 
 
+## read only records yielded by War.iter_snapshots, built from plain rows so nothing
+## ends up in the session
+WarSnapshot = collections.namedtuple(
+    "WarSnapshot",
+    "id war_tag war_type state team_size preparation_start_time start_time end_time "
+    "destruction_percentage league_round_id clan1_tag clan2_tag result clan1 clan2 attacks",
+)
+WarClanSnapshot = collections.namedtuple(
+    "WarClanSnapshot", "tag clan_level attacks stars destruction_percentage exp_earned"
+)
+AttackSnapshot = collections.namedtuple(
+    "AttackSnapshot",
+    "attacker_tag defender_tag attacker_th defender_th stars destruction_percentage order",
+)
+
+
+def _war_result(stars1, stars2, destruction1, destruction2):
+    sd = stars1 - stars2
+    if sd == 0:
+        pd = destruction1 - destruction2
+        if pd == 0:
+            return WarResult.tie.value
+        return WarResult.clan1_win.value if pd > 0 else WarResult.clan2_win.value
+    return WarResult.clan1_win.value if sd > 0 else WarResult.clan2_win.value
+
+
+class _WarTagIndex:
+    """Members and attacks of a war by tag. Built on first lookup and dropped whenever
+    the war's clans, members or attacks change, or the war is expired or refreshed"""
+
+    __slots__ = ("players", "sides", "attacks", "defenses")
+
+    def __init__(self, war):
+        self.players = {}  # tag -> WarPlayer
+        self.sides = {}  # tag -> (WarClan, opponent WarClan)
+        self.attacks = {}  # attacker tag -> [WarAttack]
+        self.defenses = {}  # defender tag -> [WarAttack]
+        clan1, clan2 = war.clan1, war.clan2
+        for wc, opp in ((clan1, clan2), (clan2, clan1)):
+            if wc is None:
+                continue
+            for p in wc.members:
+                self.players.setdefault(p.tag, p)
+                self.sides.setdefault(p.tag, (wc, opp))
+                for a in p.attacks:
+                    self.attacks.setdefault(a.attacker_tag, []).append(a)
+                    self.defenses.setdefault(a.defender_tag, []).append(a)
+
+
 class War(DBBase):
     __tablename__ = "war"
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer(), primary_key=True, autoincrement=True)
-    clan1_tag = Column("clan1_tag", String(12), ForeignKey("clan.tag"), index=True)
-    clan2_tag = Column("clan2_tag", String(12), ForeignKey("clan.tag"), index=True)
+    clan1_tag = Column("clan1_tag", Tag(), ForeignKey("clan.tag"), index=True)
+    clan2_tag = Column("clan2_tag", Tag(), ForeignKey("clan.tag"), index=True)
     # mysql doesn't like the potential None foreign keys so let's try removing these for a bit
-    # clan1_tag = Column("clan1_tag", String(12), ForeignKey("clan.tag"), index=True)
-    # clan2_tag = Column("clan2_tag", String(12), ForeignKey("clan.tag"), index=True)
+    # clan1_tag = Column("clan1_tag", Tag(), ForeignKey("clan.tag"), index=True)
+    # clan2_tag = Column("clan2_tag", Tag(), ForeignKey("clan.tag"), index=True)
     war_type = Column(Integer)
     state = Column(Integer)
     team_size = Column(Integer)
@@ -826,6 +1217,10 @@ class War(DBBase):
 
     war_result = Column(Integer)
     destruction_percentage = Column(Float)
+    ## of the api response, an ongoing war is only written again when it changes
+    content_hash = Column(String(40))
+    ## clan1_tag|clan2_tag|end_time, see War._make_key
+    war_key = Column(String(44), unique=True)
     clans = relationship("WarClan", back_populates="parent")
     attacks = relationship("WarAttack", back_populates="war")
 
@@ -839,32 +1234,28 @@ class War(DBBase):
     tournament = relationship("Tournament", back_populates="wars")
 
     __equality_attrs__ = set(["clan1_tag", "clan2_tag", "end_time"])
+    __api_fields__ = {"result": None, "state": ("state", _war_state)}
 
     def __init__(self, **kwargs):
         self.war_result = None
         if kwargs["state"] == "notInWar":
             raise NotInWarException(**kwargs)
         home_team = kwargs["clan"]["tag"] <= kwargs["opponent"]["tag"]
-        for attr, value in kwargs.items():
-            if attr.endswith("Time"):
-                setattr(self, camel_to_snake(attr), datetime.strptime(value, _DATE_STR_FORMAT_))
-            elif attr == "result":
-                if value=="tie":
-                    self.war_result = WarResult.tie.value
-                else:
-                    ## home(clan) and win .. clan1_win
-                    ## home(clan) and lose... clan2_win
-                    ## home(opponent) and win... clan2_win
-                    ## home(opponent) and lose ... clan1_win
-                    self.war_result = WarResult.clan1_win.value if (value=="win" and home_team or value=="lose" and not home_team) else WarResult.clan2_win.value
-            elif attr == "state":
-                setattr(self, attr, WarState.from_str(value).value)
-            else:
-                setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
+        value = kwargs.get("result")
+        if value == "tie":
+            self.war_result = WarResult.tie.value
+        elif value is not None:
+            ## home(clan) and win .. clan1_win
+            ## home(clan) and lose... clan2_win
+            ## home(opponent) and win... clan2_win
+            ## home(opponent) and lose ... clan1_win
+            self.war_result = WarResult.clan1_win.value if (value=="win" and home_team or value=="lose" and not home_team) else WarResult.clan2_win.value
         self.clans.append(WarClan(** (kwargs["clan"] if home_team else kwargs["opponent"])))
         self.clans.append(WarClan(** (kwargs["opponent"] if home_team else kwargs["clan"])))
         self.clan1_tag = self.clans[0].tag
         self.clan2_tag = self.clans[1].tag
+        self.war_key = War._make_key(self.clan1_tag, self.clan2_tag, self.end_time)
         self.attacks = self.attacks3
 
         if kwargs.get("isLeague", False):
@@ -875,10 +1266,25 @@ class War(DBBase):
             self.war_type = WarType.friendly.value
         if self.war_result is not None and self.state == WarState.war_ended:
             self._calc_result()
+        self.content_hash = _content_hash(
+            kwargs["state"],
+            kwargs.get("teamSize"),
+            kwargs.get("preparationStartTime"),
+            kwargs.get("startTime"),
+            kwargs.get("endTime"),
+            self.war_result,
+            self.clans[0].content_hash,
+            self.clans[1].content_hash,
+        )
 
 
     def _eq_key_(self):
-        return ":".join([str(getattr(self, k)) for k in self.__equality_attrs__])
+        return War._make_key(self.clan1_tag, self.clan2_tag, self.end_time)
+
+    @staticmethod
+    def _make_key(clan1_tag, clan2_tag, end_time):
+        """The natural key of a war, end_time to the second like the api gives it"""
+        return f"{clan1_tag}|{clan2_tag}|{end_time:%Y%m%dT%H%M%S}"
 
     @property
     def attacks3(self):
@@ -891,27 +1297,131 @@ class War(DBBase):
     def get_all_wars():
         return dbsession.query(War).order_by(War.end_time).all()
 
+    @staticmethod
+    def iter_snapshots(*criterion, batch_size=1000, attacks=False):
+        """Yields a WarSnapshot for every war matching criterion, ordered by end_time.
+
+        Wars are read batch_size at a time with plain queries (paging on end_time, id)
+        so a whole season can be scanned without loading War objects into the session.
+
+        Args:
+            criterion: filters on War columns, eg War.war_type == WarType.league.value
+            attacks (bool): Also load each war's attacks as AttackSnapshots, otherwise
+                attacks is None
+        """
+        wt, ct = War.__table__, WarClan.__table__
+        cols = [wt.c[f] for f in WarSnapshot._fields[: WarSnapshot._fields.index("result")]]
+        last = None
+        while True:
+            q = select(cols + [wt.c.war_result])
+            for c in criterion:
+                q = q.where(c)
+            if last is not None:
+                q = q.where(or_(wt.c.end_time > last[0], and_(wt.c.end_time == last[0], wt.c.id > last[1])))
+            rows = dbsession.execute(q.order_by(wt.c.end_time, wt.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return
+            last = (rows[-1].end_time, rows[-1].id)
+            ids = [r.id for r in rows]
+
+            clans = {}
+            q = select([ct.c.war_id] + [ct.c[f] for f in WarClanSnapshot._fields]).where(ct.c.war_id.in_(ids))
+            for r in dbsession.execute(q).fetchall():
+                clans[(r.war_id, r.tag)] = WarClanSnapshot(*r[1:])
+            atks = War._attack_snapshots(ids) if attacks else {}
+
+            for r in rows:
+                c1, c2 = clans.get((r.id, r.clan1_tag)), clans.get((r.id, r.clan2_tag))
+                result = r.war_result
+                if result is None and r.state == WarState.war_ended and c1 and c2:
+                    result = _war_result(c1.stars, c2.stars, c1.destruction_percentage, c2.destruction_percentage)
+                yield WarSnapshot(*r[:-1], result, c1, c2, atks.get(r.id, []) if attacks else None)
+            if len(rows) < batch_size:
+                return
+
+    @staticmethod
+    def _attack_snapshots(war_ids):
+        """{war_id: [AttackSnapshot]} for the given wars"""
+        at, pt, ct = WarAttack.__table__, WarPlayer.__table__, WarClan.__table__
+        th = {}
+        q = select([ct.c.war_id, pt.c.tag, pt.c.town_hall_level]).select_from(
+            pt.join(ct, pt.c.war_clan_id == ct.c.id)
+        ).where(ct.c.war_id.in_(war_ids))
+        for war_id, tag, thl in dbsession.execute(q).fetchall():
+            th[(war_id, tag)] = thl
+        atks = collections.defaultdict(list)
+        q = select(
+            [at.c.war_id, at.c.attacker_tag, at.c.defender_tag, at.c.stars, at.c.destruction_percentage, at.c.order]
+        ).where(at.c.war_id.in_(war_ids)).order_by(at.c.war_id, at.c.order)
+        for war_id, atag, dtag, stars, dp, order in dbsession.execute(q).fetchall():
+            atks[war_id].append(
+                AttackSnapshot(atag, dtag, th.get((war_id, atag)), th.get((war_id, dtag)), stars, dp, order)
+            )
+        return atks
+
     @staticmethod
     @timeit
-    def _get_wars(wars):
+    def _bulk_insert(wars):
+        """Insert new wars with their clans, players and attacks, a few multi-row
+        INSERTs per table instead of one per object.
+
+        Args:
+            wars: War objects or the api dicts to build them from. They must not be in
+                the db yet
+        Returns:
+            The wars with their ids set, detached as if loaded from the db. Commit the
+            session to keep them
+        """
+        wars = [w if isinstance(w, War) else War(**w) for w in wars]
         if not wars:
-            return []
-        fs = []
-        clans = set()
-        for w in wars:
-            # print(w.end_time, w.clan1_tag, w.clan2_tag, w.state)
-            clans.add(w.clan1_tag)
-            f = func.DATETIME(War.end_time) == func.DATETIME(w.end_time)  if driver.is_sqlite() else War.end_time == w.end_time
-            fs.append(
-                and_(
-                    War.clan1_tag==w.clan1_tag,
-                    War.clan2_tag==w.clan2_tag,
-                    f
-                ))
-
-        q = (dbsession.query(War).filter(War.clan1_tag.in_(clans)).filter(or_(*fs)))
-        ws = q.all()
+            return wars
+        rows = [_columns(w) for w in wars]
+        for w, row in zip(wars, rows):
+            row.pop("id")
+        for w, i in zip(wars, _insert_rows(War.__table__, rows)):
+            w.id = i
+
+        clans = [(w, c) for w in wars for c in w.clans]
+        rows = []
+        for w, c in clans:
+            c.war_id = w.id
+            rows.append(_columns(c))
+            rows[-1].pop("id")
+        for (w, c), i in zip(clans, _insert_rows(WarClan.__table__, rows)):
+            c.id = i
+
+        players = [(w, p) for w, c in clans for p in c.members]
+        rows = []
+        for w, p in players:
+            p.war_clan_id = p.parent.id
+            rows.append(_columns(p))
+            rows[-1].pop("id")
+        for (w, p), i in zip(players, _insert_rows(WarPlayer.__table__, rows)):
+            p.id = i
+
+        attacks = [(w, p, a) for w, p in players for a in p.attacks]
+        rows = []
+        for w, p, a in attacks:
+            a.war_id = w.id
+            a.war_player_id = p.id
+            rows.append(_columns(a))
+            rows[-1].pop("id")
+        for (w, p, a), i in zip(attacks, _insert_rows(WarAttack.__table__, rows)):
+            a.id = i
+
+        ## already in the db, so adding them to a session later can't insert them again
+        for o in [a for w, p, a in attacks] + [p for w, p in players] + [c for w, c in clans] + wars:
+            make_transient_to_detached(o)
+        return wars
 
+    @staticmethod
+    @timeit
+    def _get_wars(wars):
+        """The stored versions of wars, looked up by war_key"""
+        keys = list({w._eq_key_() for w in wars})
+        ws = []
+        for c in chunks(keys, _IN_TAG_CHUNK_SIZE_):
+            ws.extend(dbsession.query(War).filter(War.war_key.in_(c)).all())
         return ws
 
     @staticmethod
@@ -920,22 +1430,11 @@ class War(DBBase):
 
     @staticmethod
     def get_war(clan1_tag, clan2_tag, end_time):
-        f = func.DATETIME(War.end_time) == func.DATETIME(end_time) if driver.is_sqlite() else War.end_time == end_time
-        return (dbsession.query(War).filter(
-            and_(
-                    War.clan1_tag==clan1_tag,
-                    War.clan2_tag==clan2_tag,
-                    f
-            )).one_or_none())
+        return dbsession.query(War).filter(War.war_key == War._make_key(clan1_tag, clan2_tag, end_time)).one_or_none()
 
     @staticmethod
     def war_exists(clan1_tag, clan2_tag, end_time):
-        f = func.DATETIME(War.end_time) == func.DATETIME(w.end_time)  if driver.is_sqlite() else War.end_time == end_time
-        r = (dbsession.query(War.id).filter(and_(
-                War.clan1_tag==clan1_tag,
-                War.clan2_tag==clan2_tag,
-                f
-            )).one_or_none())
+        r = dbsession.query(War.id).filter(War.war_key == War._make_key(clan1_tag, clan2_tag, end_time)).one_or_none()
         return True if r else False
 
     # @property
@@ -961,15 +1460,9 @@ class War(DBBase):
         return self.clans[1] if len(self.clans) > 0 else None
 
     def _calc_result(self):
-        sd = self.clan1.stars - self.clan2.stars
-        if sd == 0:
-            pd = self.clan1.destruction_percentage - self.clan2.destruction_percentage
-            if pd == 0:
-                self.war_result = WarResult.tie.value
-            else:
-                self.war_result = WarResult.clan1_win.value if pd > 0 else WarResult.clan2_win.value
-        else:
-            self.war_result = WarResult.clan1_win.value if sd > 0 else WarResult.clan2_win.value
+        self.war_result = _war_result(
+            self.clan1.stars, self.clan2.stars, self.clan1.destruction_percentage, self.clan2.destruction_percentage
+        )
         return self.war_result
 
     @property
@@ -987,53 +1480,39 @@ class War(DBBase):
     def __str__(self):
         return f"('{self.clan1.tag}' vs '{self.clan2.tag}' {self.result} {self.clan1.stars}:{self.clan2.stars}) "
 
+    def _tag_index(self):
+        idx = self.__dict__.get("_tag_index_")
+        if idx is None:
+            idx = self.__dict__["_tag_index_"] = _WarTagIndex(self)
+        return idx
+
     def get_war_clan_from_player(self, tag, opponent=False):
-        if any(p.tag == tag for p in self.clan1.members):
-            return self.clan1 if not opponent else self.clan2
-        if any(p.tag == tag for p in self.clan2.members):
-            return self.clan2 if not opponent else self.clan1
-        raise TagNotFoundException(tag)
+        sides = self._tag_index().sides.get(tag)
+        if sides is None:
+            raise TagNotFoundException(tag)
+        return sides[1] if opponent else sides[0]
 
     def get_war_clan(self, tag, opponent=False):
-        if any(p.tag == tag for p in self.clan1.members):
-            return self.clan1 if not opponent else self.clan2
-        if any(p.tag == tag for p in self.clan2.members):
-            return self.clan2 if not opponent else self.clan1
-        raise TagNotFoundException(tag)
+        return self.get_war_clan_from_player(tag, opponent)
 
     def get_player(self, tag):
-        pl = next((x for x in self.clan1.members if x.tag == tag), None)
-        if pl:
-            return pl
-        return next((x for x in self.clan2.members if x.tag == tag), None)
+        return self._tag_index().players.get(tag)
 
     def get_attacks(self, tag):
-        wd = self.get_war_clan_from_player(tag)
-        atks = []
-        for p in wd.members:
-            for a in p.attacks:
-                if a.attacker_tag == tag:
-                    atks.append(a)
-        return atks
+        idx = self._tag_index()
+        if tag not in idx.sides:
+            raise TagNotFoundException(tag)
+        return list(idx.attacks.get(tag, ()))
 
     def get_defenses(self, tag):
-        wd = self.get_war_clan_from_player(tag, True)
-        defs = []
-        for p in wd.members:
-            for a in p.attacks:
-                if a.defender_tag == tag:
-                    defs.append(a)
-        return defs
+        idx = self._tag_index()
+        if tag not in idx.sides:
+            raise TagNotFoundException(tag)
+        return list(idx.defenses.get(tag, ()))
 
     @property
     def war_status(self):
-        now = datetime.now()
-        if self.end_time < now:
-            return WarState.war_ended
-        elif self.start_time < now:
-            return WarState.in_war
-        else:
-            return WarState.preparation
+        return _war_status(self.start_time, self.end_time)
 
     def __eq__(self, other):
         if not isinstance(other, War):
@@ -1061,18 +1540,81 @@ class War(DBBase):
                 should_delete[WarClan].append(c)
         return should_delete
 
+    def _update_from(self, new):
+        """Bring this stored war up to date with new, the same war built from a fresh
+        api response. Nothing is touched when their content hashes match, otherwise
+        only the clans whose hash changed are reconciled.
+
+        Returns:
+            None if nothing changed, otherwise {class: [objects to delete]}
+        """
+        if new.content_hash is not None and new.content_hash == self.content_hash:
+            return None
+        should_delete = collections.defaultdict(list)
+        ## a war log entry only brings the war's and the clans' own columns
+        full = all(getattr(c, "_has_members", True) for c in new.clans)
+        with dbsession.no_autoflush:
+            _copy_columns(self, new, ("id",) if full else ("id", "content_hash", "war_type"))
+            mine = {c.tag: c for c in self.clans}
+            for c in list(new.clans):
+                oc = mine.get(c.tag)
+                if oc is None:  # shouldn't happen either
+                    self.clans.append(c)
+                    for p in c.members:
+                        for a in p.attacks:
+                            a.war = self
+                elif c.content_hash is None or c.content_hash != oc.content_hash:
+                    oc._update_from(c, self, should_delete)
+        ## what is left of new can be cascaded into the session along the moved objects
+        left = [new] + list(new.clans)
+        left += [p for c in left[1:] for p in c.members]
+        left += [a for p in left if isinstance(p, WarPlayer) for a in p.attacks]
+        for o in left:
+            if o in dbsession:
+                dbsession.expunge(o)
+        return should_delete
+
+
+def _drop_tag_index(war):
+    if war is not None:
+        war.__dict__.pop("_tag_index_", None)
+
+
+def _war_of(obj):
+    """The war a WarClan, WarPlayer or WarAttack belongs to, if it is already loaded"""
+    while obj is not None and not isinstance(obj, War):
+        obj = obj.__dict__.get("parent") or obj.__dict__.get("war_player")
+    return obj
+
+
+for _attr in (War.clans, WarClan.members, WarPlayer.attacks):
+    listen(_attr, "append", lambda target, value, initiator: _drop_tag_index(_war_of(target)))
+    listen(_attr, "remove", lambda target, value, initiator: _drop_tag_index(_war_of(target)))
+for _attr in (WarPlayer.tag, WarAttack.attacker_tag, WarAttack.defender_tag):
+    listen(_attr, "set", lambda target, value, oldvalue, initiator: _drop_tag_index(_war_of(target)))
+listen(War, "expire", lambda target, attrs: _drop_tag_index(target))
+listen(War, "refresh", lambda target, context, attrs: _drop_tag_index(target))
+
 
 class Clan(DBBase):
     __tablename__ = "clan"
     __table_args__ = {"extend_existing": True}
-    tag = Column(String(12), primary_key=True)
+    tag = Column(Tag(), primary_key=True)
     name = Column(String(32), index=True)
 
-    history = relationship("ClanHistory", lazy="joined")
-    names = relationship("ClanNameHistory", lazy="joined")
-    descriptions = relationship("ClanDescriptionHistory", lazy="joined")
-    members = relationship("Player", lazy="joined", secondary=_clans_players_association_table)
-    wars = relationship("War", lazy="joined", secondary=_clans_wars_association_table)
+    ## loaded on access, or up front by picking a profile in Clan.load_options
+    history = relationship("ClanHistory")
+    names = relationship("ClanNameHistory")
+    descriptions = relationship("ClanDescriptionHistory")
+    members = relationship("Player", secondary=_clans_players_association_table)
+    wars = relationship("War", secondary=_clans_wars_association_table)
+
+    ## summary: just the clan row, its latest history is queried when needed
+    __load_profiles__ = {
+        "summary": (),
+        "with_members": ("members",),
+        "full": ("history", "names", "descriptions", "members", "wars"),
+    }
 
     def __init__(self, **kwargs):
         self.tag = fmt_tag(kwargs["tag"])
@@ -1082,8 +1624,16 @@ class Clan(DBBase):
         return  f"(Clan {self.tag} '{self.name}')"
 
     @staticmethod
-    def get(tag):
-        return dbsession.query(Clan).filter(Clan.tag == tag).one_or_none()
+    def load_options(load="summary"):
+        """Query options for a profile in __load_profiles__. Each relationship is
+        loaded with its own SELECT .. IN query rather than one join of all of them"""
+        if load not in Clan.__load_profiles__:
+            raise ValueError(f"Unknown load profile '{load}', use one of {list(Clan.__load_profiles__)}")
+        return [selectinload(getattr(Clan, r)) for r in Clan.__load_profiles__[load]]
+
+    @staticmethod
+    def get(tag, load="summary"):
+        return dbsession.query(Clan).options(*Clan.load_options(load)).filter(Clan.tag == tag).one_or_none()
 
 
     @staticmethod
@@ -1107,14 +1657,17 @@ class Clan(DBBase):
     def _get_last_histories(tags):
         return _get_last(ClanHistory, tags)
 
+    @staticmethod
+    def _touch_last_histories(ids, now):
+        _touch_last_check(ClanHistory, ids, now)
+
     @staticmethod
     def _get_last_names(tags):
         return _get_last(ClanNameHistory, tags)
 
     @staticmethod
     def _get_name_dict(tags):
-        clans = dbsession.query(Clan).filter(Clan.tag.in_(tags)).all()
-        return {x.tag:x.name for x in clans or []}
+        return dict(dbsession.query(Clan.tag, Clan.name).filter(Clan.tag.in_(tags)).all())
 
     @staticmethod
     def _get_last_descriptions(tags):
@@ -1139,14 +1692,10 @@ class Clan(DBBase):
 
 
     def last_history(self, force_db_load=False):
-        if not force_db_load and self.history:
+        ## only use history if it is already there, loading all of it to get the last is slow
+        if not force_db_load and self.__dict__.get("history"):
             return self.history[-1]
-        lh = (
-            ClanHistory.query.filter(ClanHistory.tag == self.tag)
-            .order_by(ClanHistory.last_check.desc())
-            .first()
-        )
-        return lh
+        return ClanLatest.get_history(self.tag)
 
     def __last_history_attr__(self, attr, default=None, force_db_load=False):
         lh = self.last_history(force_db_load)
@@ -1160,13 +1709,26 @@ class Clan(DBBase):
         fom = datetime.today().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         return lh.war_league if lh.last_check >= fom else None
 
+    @staticmethod
+    def _get_current_leagues(tags):
+        """{tag: war_league} like get_current_league for every tag with a history,
+        from the latest table in one query"""
+        fom = datetime.today().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        leagues = {}
+        for c in chunks(tags, _IN_TAG_CHUNK_SIZE_):
+            q = dbsession.query(ClanLatest.tag, ClanLatest.war_league, ClanLatest.last_check).filter(
+                ClanLatest.tag.in_(c)
+            )
+            leagues.update({t: wl if lc >= fom else None for t, wl, lc in q})
+        return leagues
+
 
 
 
 
     @property
     def description(self):
-        if self.descriptions:
+        if self.__dict__.get("descriptions"):
             return self.descriptions[-1].description
         lh = self.last_history()
         return lh.description
@@ -1204,7 +1766,7 @@ class ClanHistory(DBBase):
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer(), primary_key=True)
-    tag = Column(String(12), ForeignKey("clan.tag"), index=True)
+    tag = Column(Tag(), ForeignKey("clan.tag"), index=True)
     type = Column(Integer)
     description_id = Column(Integer, ForeignKey("clan_description_history.id"), index=True)
     location = Column(Integer)
@@ -1242,20 +1804,18 @@ class ClanHistory(DBBase):
         ]
     )
 
+    __api_fields__ = {
+        "memberList": None,
+        "labels": None,
+        "description": None,
+        "warLeague": ("war_league", lambda v: WarLeague(v["id"]).value),
+        "location": ("location", lambda v: v["id"]),
+        "warFrequency": ("war_frequency", _war_frequency),
+        "type": ("type", _clan_entry_type),
+    }
+
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            if attr in (["memberList", "labels", "description"]):
-                continue
-            # print(" -- ", attr, len(value) if isinstance(value, str) else 0, value)
-            if attr == "warLeague":
-                value = WarLeague(value["id"]).value
-            elif attr == "location":
-                value = value["id"]
-            elif attr == "warFrequency":
-                value = WarFrequency.from_str(value).value
-            elif attr == "type":
-                value = ClanEntryType.from_str(value).value
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
         self.tag = fmt_tag(self.tag)
 
     def __eq__(self, other):
@@ -1283,7 +1843,7 @@ class ClanHistory(DBBase):
 class Player(DBBase):
     __tablename__ = "player"
     __table_args__ = {"extend_existing": True}
-    tag = Column(String(12), primary_key=True)
+    tag = Column(Tag(), primary_key=True)
     name = Column(String(32), index=True)
     history = relationship("PlayerHistory", lazy="joined")
     names = relationship("PlayerNameHistory", lazy="joined")
@@ -1304,6 +1864,10 @@ class Player(DBBase):
     def _get_last_histories(tags):
         return _get_last(PlayerHistory, tags)
 
+    @staticmethod
+    def _touch_last_histories(ids, now):
+        _touch_last_check(PlayerHistory, ids, now)
+
     @staticmethod
     def _get_last_names(tags):
         return _get_last(PlayerNameHistory, tags)
@@ -1323,12 +1887,7 @@ class Player(DBBase):
     def last_history(self, force_db_load=False):
         if not force_db_load and self.history:
             return self.history[-1]
-        lh = (
-            PlayerHistory.query.filter(PlayerHistory.tag == self.tag)
-            .order_by(PlayerHistory.last_check.desc())
-            .first()
-        )
-        return lh
+        return PlayerLatest.get_history(self.tag)
 
     def __last_history_attr__(self, attr, default=None, force_db_load=False):
         lh = self.last_history(force_db_load)
@@ -1385,15 +1944,14 @@ class PlayerNameHistory(DBBase):
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True)
-    tag = Column(String(12), ForeignKey("player.tag"), index=True)
+    tag = Column(Tag(), ForeignKey("player.tag"), index=True)
     name = Column(String(30))
 
     insert_time = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     last_check = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
 
     @staticmethod
     def get_id(tag, name):
@@ -1409,15 +1967,14 @@ class ClanNameHistory(DBBase):
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True)
-    tag = Column(String(12), ForeignKey("clan.tag"), index=True)
+    tag = Column(Tag(), ForeignKey("clan.tag"), index=True)
     name = Column(String(30))
 
     insert_time = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     last_check = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
 
     @staticmethod
     def get_id(tag, name):
@@ -1438,15 +1995,14 @@ class ClanDescriptionHistory(DBBase):
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True)
-    tag = Column(String(12), ForeignKey("clan.tag"), index=True)
+    tag = Column(Tag(), ForeignKey("clan.tag"), index=True)
     description = Column(String(1024), index=True)
 
     insert_time = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     last_check = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
 
     @staticmethod
     def odict_from_dict(d):
@@ -1471,7 +2027,7 @@ class PlayerHistory(DBBase):
     __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True)
-    tag = Column(String(12), ForeignKey("player.tag"), index=True)
+    tag = Column(Tag(), ForeignKey("player.tag"), index=True)
     exp_level = Column(Integer)
     role = Column(Integer)
     league_id = Column(Integer)
@@ -1486,12 +2042,14 @@ class PlayerHistory(DBBase):
     previous_rank = Column(Integer)
     clan_rank = Column(Integer)
     previous_clan_rank = Column(Integer)
-    clan_tag = Column(String(12))
+    clan_tag = Column(Tag())
     entry_type = Column(Integer)
 
     insert_time = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     last_check = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
+    __api_fields__ = {"townhallLevel": "town_hall_level"}  # this is sometimes mispelled from api
+
     __equality_attrs__ = set(
         [
             "tag",
@@ -1510,10 +2068,7 @@ class PlayerHistory(DBBase):
     )
 
     def __init__(self, **kwargs):
-        for attr, value in kwargs.items():
-            if attr == "townhallLevel":  # this is sometimes mispelled from api
-                attr = "townHallLevel"
-            setattr(self, camel_to_snake(attr), value)
+        _set_from_api(self, kwargs)
         self.tag = fmt_tag(self.tag)
         try:
             self.rank = kwargs["legendStatistics"]["currentSeason"]["rank"]
@@ -1568,6 +2123,86 @@ class URL(DBBase):
 
     def __repr__(self):
         return "<URL %r %r>" % (self.id, self.attack)
+class _LatestMixin:
+    """Copy of the hot columns of the most recent history row of each tag.
+
+    Kept up to date by triggers on the history table, so latest state lookups are a
+    primary key join however long the history gets. The table is filled from the
+    existing history when it is created. On mysql with binary logging on, creating
+    the triggers needs SUPER or log_bin_trust_function_creators=1 (see the README).
+    """
+
+    @classmethod
+    def get_history(cls, tag):
+        hcls = cls.__history__
+        return dbsession.query(hcls).join(cls, hcls.id == cls.history_id).filter(cls.tag == tag).one_or_none()
+
+    @classmethod
+    def _ddl(cls):
+        lt, ht = cls.__tablename__, cls.__history__.__tablename__
+        hot = [k for k, _ in _column_keys(cls) if k not in ("tag", "history_id", "last_check")]
+        cols = ", ".join(["tag", "history_id"] + hot + ["last_check"])
+        new = ", ".join(["NEW.tag", "NEW.id"] + [f"NEW.{c}" for c in hot] + ["NEW.last_check"])
+        ## a row replaces the latest unless the latest was checked after it. sqlite
+        ## stores datetimes as text and the orm, bulk inserts and server defaults
+        ## don't all write the same format, so compare them as julian days
+        sqlite = f"""INSERT OR REPLACE INTO {lt} ({cols}) SELECT {new}
+            WHERE NEW.tag IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM {lt} WHERE tag = NEW.tag AND julianday(last_check) > julianday(NEW.last_check));"""
+        newer = "VALUES(last_check) >= last_check"
+        mysql = f"""INSERT INTO {lt} ({cols}) SELECT {new} FROM DUAL WHERE NEW.tag IS NOT NULL ON DUPLICATE KEY UPDATE
+            {", ".join(f"{c} = IF({newer}, VALUES({c}), {c})" for c in ["history_id"] + hot)},
+            last_check = GREATEST(last_check, VALUES(last_check))"""
+        stmts = []
+        for event in ("INSERT", "UPDATE"):
+            name = f"{ht}_latest_{event.lower()}"
+            stmts.append(DDL(f"CREATE TRIGGER {name} AFTER {event} ON {ht} BEGIN {sqlite} END").execute_if(dialect="sqlite"))
+            stmts.append(DDL(f"CREATE TRIGGER {name} AFTER {event} ON {ht} FOR EACH ROW {mysql}").execute_if(dialect="mysql"))
+        h = ", ".join(["h.tag", "h.id"] + [f"h.{c}" for c in hot] + ["h.last_check"])
+        for dialect, last_check in (("sqlite", "julianday(h2.last_check)"), ("mysql", "h2.last_check")):
+            stmts.append(
+                DDL(
+                    f"""INSERT INTO {lt} ({cols}) SELECT {h} FROM {ht} h WHERE h.tag IS NOT NULL AND h.id = (
+                    SELECT h2.id FROM {ht} h2 WHERE h2.tag = h.tag ORDER BY {last_check} DESC, h2.id DESC LIMIT 1)"""
+                ).execute_if(dialect=dialect)
+            )
+        return stmts
+
+
+class PlayerLatest(_LatestMixin, DBBase):
+    __tablename__ = "player_latest"
+    __table_args__ = {"extend_existing": True}
+    __history__ = PlayerHistory
+
+    tag = Column(Tag(), primary_key=True)
+    history_id = Column(Integer, ForeignKey("player_history.id"), nullable=False)
+    trophies = Column(Integer)
+    town_hall_level = Column(Integer)
+    clan_tag = Column(Tag(), index=True)
+    league_id = Column(Integer)
+    last_check = Column(DateTime(timezone=True), nullable=False)
+
+
+class ClanLatest(_LatestMixin, DBBase):
+    __tablename__ = "clan_latest"
+    __table_args__ = {"extend_existing": True}
+    __history__ = ClanHistory
+
+    tag = Column(Tag(), primary_key=True)
+    history_id = Column(Integer, ForeignKey("clan_history.id"), nullable=False)
+    war_league = Column(Integer, index=True)
+    clan_level = Column(Integer)
+    clan_points = Column(Integer)
+    members = Column(Integer)
+    last_check = Column(DateTime(timezone=True), nullable=False)
+
+
+_latest_tables = {PlayerHistory: PlayerLatest, ClanHistory: ClanLatest}
+for _latest in _latest_tables.values():
+    for _ddl in _latest._ddl():
+        listen(_latest.__table__, "after_create", _ddl)
+
+
 mths = ["2020-07", "2020-08", "2020-09", "2020-10", "2020-11", "2020-12"]
 mths.extend([f"{year}-{month:02}" for year in range(2021,2030) for month in range(1,13)])
 v = [f'("{datetime.strptime(month, "%Y-%m").date()}")' for month in mths]
@@ -0,0 +1,248 @@
+"""Local stand in for api.clashofclans.com that replays recorded responses.
+
+Responses come from a saved REQ_SAVE_DIR/requests tree or a ResponseArchive and are
+served at the same paths as the real API, so crawlers can be load tested end to end
+by pointing COCRequest at it:
+
+    python -m models.replay_server requests/ --port 8765 --latency 0.05 --rate 20
+    REQ_API_URL=http://127.0.0.1:8765/v1 REQ_AUTH_TOKEN=replay REQ_SAVE_FILES=0 python runner.py
+
+Besides latency it can inject the failures the crawlers have to handle: 429s when a
+token goes over its rate (or at random), 503 maintenance windows, notFound for league
+groups and accessDenied for war logs. Counters are served as json at /stats.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+from models.archive import DEFAULT_BASE_URL, ResponseArchive
+from models.limiter import RateLimiter
+
+NOT_FOUND = {"reason": "notFound", "message": "Resource was not found."}
+ACCESS_DENIED = {"reason": "accessDenied", "message": "Access denied, clan war log is private."}
+THROTTLED = {"reason": "requestThrottled", "message": "Request was throttled, because amount of requests was above the threshold defined for the used API token."}
+MAINTENANCE = {"reason": "inMaintenance", "message": "API is currently in maintenance, please come back later."}
+
+
+class DirSource:
+    """Responses saved by COCRequest as <requests_dir>/<path>.json"""
+
+    def __init__(self, requests_dir):
+        self.requests_dir = requests_dir
+
+    def get(self, path):
+        floc = os.path.join(self.requests_dir, path.strip("/") + ".json")
+        try:
+            with open(floc, "rb") as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+
+class ArchiveSource:
+    """Responses recorded in a ResponseArchive"""
+
+    def __init__(self, archive_dir, base_url=DEFAULT_BASE_URL):
+        self.archive = ResponseArchive(archive_dir)
+        self.base_url = base_url
+
+    def get(self, path):
+        body = self.archive.get(f"{self.base_url}/{path.strip('/')}")
+        return None if body is None else json.dumps(body).encode()
+
+
+def open_source(loc):
+    """Archive if loc holds archive segments, otherwise a requests tree"""
+    if os.path.exists(os.path.join(loc, "index.log")) or os.path.exists(os.path.join(loc, "index.bin")):
+        return ArchiveSource(loc)
+    return DirSource(loc)
+
+
+def _chance(path, rate):
+    """Deterministic per path, so a clan's war log stays private on every request"""
+    if rate <= 0:
+        return False
+    return int(hashlib.sha1(path.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < rate
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        source,
+        host="127.0.0.1",
+        port=8765,
+        latency=0.0,
+        jitter=0.0,
+        rate=0,
+        throttle_rate=0.0,
+        retry_after=None,
+        maintenance_every=0,
+        maintenance_for=0,
+        not_found_rate=0.0,
+        access_denied_rate=0.0,
+        max_age=0,
+    ):
+        """
+        Args:
+            source: DirSource or ArchiveSource to serve responses from
+            latency (float): Seconds to wait before answering each request
+            jitter (float): Up to this many extra seconds, picked at random
+            rate (float): Requests per second allowed for each auth token before
+                answering 429. 0 for no limit
+            throttle_rate (float): Fraction of requests answered 429 regardless of rate
+            retry_after (int): Retry-After header sent with 429s
+            maintenance_every (float): Start a maintenance window every this many seconds
+            maintenance_for (float): Answer 503 for this many seconds of each window
+            not_found_rate (float): Fraction of clans answered notFound for their league group
+            access_denied_rate (float): Fraction of clans answered accessDenied for their
+                war log and current war
+            max_age (int): Cache-Control max-age sent with each response
+        """
+        super().__init__((host, port), ReplayHandler)
+        self.source = source
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.maintenance_every = maintenance_every
+        self.maintenance_for = maintenance_for
+        self.not_found_rate = not_found_rate
+        self.access_denied_rate = access_denied_rate
+        self.max_age = max_age
+        self.started = time.time()
+        self.limiters = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def in_maintenance(self):
+        if self.maintenance_every <= 0:
+            return False
+        return (time.time() - self.started) % self.maintenance_every < self.maintenance_for
+
+    def throttled(self, token):
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            return True
+        if not self.rate:
+            return False
+        with self._lock:
+            if token not in self.limiters:
+                self.limiters[token] = RateLimiter(self.rate, self.rate)
+            limiter = self.limiters[token]
+        return not limiter.try_acquire()
+
+    def respond(self, path, token):
+        """Returns (status, body) for a request to path"""
+        if self.in_maintenance():
+            return 503, MAINTENANCE
+        if self.throttled(token):
+            return 429, THROTTLED
+        parts = path.strip("/").split("/")
+        if parts[0] == "clans" and len(parts) > 1:
+            clan = f"clans/{parts[1]}"
+            if parts[-1] == "leaguegroup" and _chance(clan, self.not_found_rate):
+                return 404, NOT_FOUND
+            if parts[-1] in ("warlog", "currentwar") and _chance(clan, self.access_denied_rate):
+                return 403, ACCESS_DENIED
+        body = self.source.get(path)
+        if body is None:
+            return 404, NOT_FOUND
+        return 200, body
+
+    def start(self):
+        """Serve from a daemon thread, returns the thread"""
+        t = threading.Thread(target=self.serve_forever, name="replay-server", daemon=True)
+        t.start()
+        return t
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        path = unquote(urlsplit(self.path).path)
+        if path == "/stats":
+            self._send(200, dict(server.counts, uptime=time.time() - server.started))
+            return
+        if not path.startswith("/v1/"):
+            self._send(404, NOT_FOUND)
+            return
+        delay = server.latency + (random.uniform(0, server.jitter) if server.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        status, body = server.respond(path[len("/v1") :], self.headers.get("authorization"))
+        server.count(status)
+        headers = {}
+        if status == 429 and server.retry_after is not None:
+            headers["Retry-After"] = str(server.retry_after)
+        if status == 200 and server.max_age:
+            headers["Cache-Control"] = f"public max-age={server.max_age}"
+        self._send(status, body, headers)
+
+    def _send(self, status, body, headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Replay recorded Clash of Clans API responses")
+    ap.add_argument("source", help="REQ_SAVE_DIR/requests directory or archive directory")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    ap.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds")
+    ap.add_argument("--rate", type=float, default=0, help="requests/s per token before 429s")
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of random 429s")
+    ap.add_argument("--retry-after", type=int, default=None)
+    ap.add_argument("--maintenance-every", type=float, default=0, help="seconds between 503 windows")
+    ap.add_argument("--maintenance-for", type=float, default=0, help="length of each 503 window")
+    ap.add_argument("--not-found-rate", type=float, default=0.0, help="fraction of clans not in a league group")
+    ap.add_argument("--access-denied-rate", type=float, default=0.0, help="fraction of clans with a private war log")
+    ap.add_argument("--max-age", type=int, default=0, help="Cache-Control max-age to send")
+    args = ap.parse_args()
+    server = ReplayServer(
+        open_source(args.source),
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        rate=args.rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        maintenance_every=args.maintenance_every,
+        maintenance_for=args.maintenance_for,
+        not_found_rate=args.not_found_rate,
+        access_denied_rate=args.access_denied_rate,
+        max_age=args.max_age,
+    )
+    print(f"Replaying {args.source} at {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.counts))
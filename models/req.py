@@ -1,28 +1,50 @@
 import asyncio
+import atexit
+import concurrent.futures
 import configparser
-import json
 import os
 import sys
+import threading
 import time
+from functools import partial, wraps
 from multiprocessing import Value
 
 import requests
-from aiolimiter import AsyncLimiter
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
+from models.archive import DEFAULT_BASE_URL, ResponseArchive
+from models.cache import DEFAULT_MAXSIZE, ResponseCache, max_age
 from models.exceptions import NotInWarException, WarLogPrivateException
-from models.utils import env_istrue, fmt_tag
+from models.telemetry import Telemetry
+from models.token_pool import Priority, TokenPool, TokenSlot
+from models.utils import env_istrue, fmt_tag, json_loads
 
-API_URL = "https://api.clashofclans.com/v1"
+## point at a models.replay_server to crawl recorded responses instead of the real API
+API_URL = os.getenv("REQ_API_URL", DEFAULT_BASE_URL).rstrip("/")
 
 req_counter = Value("i", 0)
 called_counter = Value("i", 0)
+coalesced_counter = Value("i", 0)  # requests saved by joining one already in flight
+## per endpoint counts, latencies, status codes and limiter waits for this process
+telemetry = Telemetry()
 DEBUG = env_istrue("REQ_DEBUG", False)
 OFFLINE = env_istrue("REQ_OFFLINE", False)
 USE_FILES_FOR_REQS = env_istrue("REQ_USE_FILES", False)
 SAVE_REQUESTS = env_istrue("REQ_SAVE_FILES", True)
+ARCHIVE_DIR = os.getenv("REQ_ARCHIVE_DIR")  # saved requests go to an archive instead of one file per url
+USE_CACHE = env_istrue("REQ_CACHE", True)
+COALESCE = env_istrue("REQ_COALESCE", True)
+MAX_CONCURRENCY = int(os.getenv("REQ_MAX_CONCURRENCY", 20))
+TOKEN_RATE = float(os.getenv("REQ_TOKEN_RATE", 20))  # requests per second for each key
+## realtime, interactive or bulk. Used by every COCRequest not given its own priority
+DEFAULT_PRIORITY = Priority[os.getenv("REQ_PRIORITY", "interactive").upper()]
+TELEMETRY_FILE = os.getenv("REQ_TELEMETRY_FILE")  # written on exit, .json or .prom
 start_time = time.time()
-rate_limit = AsyncLimiter(20, 1)
+## honours the Cache-Control max-age the API sends, see response_cache.stats() for hit rates
+response_cache = ResponseCache(
+    maxsize=int(os.getenv("REQ_CACHE_SIZE", DEFAULT_MAXSIZE)), cache_dir=os.getenv("REQ_CACHE_DIR")
+)
 
 _cwd = os.path.dirname(os.path.abspath(__file__))
 
@@ -36,24 +58,162 @@ def _fmt_url_(url):
     return url.replace("#", "%23")
 
 
+## One keep-alive session and one event loop per process. Every COCRequest shares
+## them so connections are reused and batch calls can run concurrently.
+_session = None
+_executor = None
+_loop = None
+_loop_lock = threading.Lock()
+_token_pools = {}  # keyed by ip or auth token, so every COCRequest shares a key's budget
+_archive = None
+_inflight = {}  # url -> (future, priority) of the request every concurrent caller awaits
+
+
+def _reset_after_fork():
+    global _session, _executor, _loop, _loop_lock, _token_pools, _archive, _inflight
+    _session = _executor = _loop = _archive = None
+    _loop_lock = threading.Lock()
+    _token_pools = {}
+    _inflight = {}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+if TELEMETRY_FILE:
+    atexit.register(lambda: telemetry.dump(TELEMETRY_FILE))
+
+
+def _timed(fn, *args, **kwargs):
+    """Returns fn's result and how long it took, measured in the thread that ran it"""
+    t = time.perf_counter()
+    r = fn(*args, **kwargs)
+    return r, time.perf_counter() - t
+
+
+def _get_session():
+    global _session, _executor
+    with _loop_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENCY)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_CONCURRENCY, thread_name_prefix="cocreq"
+            )
+    return _session
+
+
+async def _blocking(fn, *args):
+    """Run fn(*args) on the request threads. Used for file IO, which on the loop would
+    hold up every other request of a batch"""
+    _get_session()  ## starts the executor
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(fn, *args))
+
+
+def _get_archive():
+    global _archive
+    with _loop_lock:
+        if _archive is None:
+            _archive = ResponseArchive(ARCHIVE_DIR)
+    return _archive
+
+
+def _get_loop():
+    """Event loop running in a daemon thread that owns the rate limiter
+    and all in flight requests"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="cocreq-loop", daemon=True).start()
+    return _loop
+
+
+def _submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def _run(coro):
+    return _submit(coro).result()
+
+
+def _on_request_loop(coro_fn):
+    """Run the wrapped coroutine on the shared request loop, whichever loop awaits it"""
+
+    @wraps(coro_fn)
+    async def wrapper(*args, **kwargs):
+        loop = _get_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coro_fn(*args, **kwargs)
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro_fn(*args, **kwargs), loop)
+        )
+
+    return wrapper
+
+
 class COCRequest:
-    def __init__(self, auth_token=None):
+    def __init__(self, auth_token=None, priority=None):
+        """
+        Args:
+            auth_token (str): Key to use instead of the ones in auth_tokens.ini
+            priority (Priority): Request class, higher classes get rate limit tokens
+                first. Defaults to REQ_PRIORITY
+        """
+        self.priority = DEFAULT_PRIORITY if priority is None else Priority(priority)
         self.headers = {}
         self.ip = None
+        self.pool = None
         if OFFLINE:
             return
-        if not auth_token:
-            auth_token = self._find_token()
-            self.headers = {"Accept": "application/json", "authorization": "Bearer " + auth_token}
-        assert auth_token
+        auth_token = auth_token or os.getenv("REQ_AUTH_TOKEN")
+        if auth_token:
+            if auth_token not in _token_pools:
+                _token_pools[auth_token] = TokenPool(
+                    [TokenSlot("auth_token", auth_token, rate=TOKEN_RATE)]
+                )
+            self.pool = _token_pools[auth_token]
+        else:
+            self.pool = self._find_tokens()
 
     @staticmethod
     def _url_to_json_path(url):
         save_dir = f"{os.getenv('REQ_SAVE_DIR','.')}/requests"
         return os.path.join(save_dir, url.replace(API_URL, "").strip("/") + ".json")
 
+    @staticmethod
+    def _archive_key(url):
+        """Recordings are keyed by the real API url whichever server they came from"""
+        return DEFAULT_BASE_URL + url[len(API_URL) :] if url.startswith(API_URL) else url
+
+    @staticmethod
+    def _load_saved(url):
+        if ARCHIVE_DIR:
+            return _get_archive().get(COCRequest._archive_key(url))
+        floc = COCRequest._url_to_json_path(url)
+        if os.path.exists(floc):
+            if DEBUG:
+                print(f"req.py opening '{floc}'")
+            with open(floc, "rb") as f:
+                return json_loads(f.read())
+        return None
+
+    @staticmethod
+    def _save(url, body):
+        """Write the raw response body, no need to serialise it again"""
+        if ARCHIVE_DIR:
+            _get_archive().put(COCRequest._archive_key(url), body)
+            return
+        floc = COCRequest._url_to_json_path(url)
+        d = os.path.dirname(floc)
+        os.makedirs(d, exist_ok=True)
+        with open(floc, "wb") as f:
+            f.write(body)
 
-    def _find_token(self):
+
+    def _find_tokens(self):
         r = requests.get("https://api.ipify.org")
         try:
             r.raise_for_status()
@@ -65,127 +225,253 @@ class COCRequest:
                 raise
         if DEBUG:
             print("My IP=", self.ip, flush=True)
-        return self._load_token(self.ip)
-
-    def _load_token(self, ip):
-        _tokens = {k: v for k, v in _config.items("tokens")}
-        _ips = {k.strip('"'): _tokens[v].strip('"') for k, v in _config.items("ips")}
+        return self._load_tokens(self.ip)
 
+    def _load_tokens(self, ip):
+        """Every key in auth_tokens.ini that can be used from this host"""
+        if ip in _token_pools:
+            return _token_pools[ip]
         WAIT_FOR_IP = os.environ.get("WAIT_FOR_IP", 0)
-        if int(WAIT_FOR_IP) > 0 and self.ip not in __ips:
-            import time
-
-            print(f"'{self.ip}' Was not found. Waiting {WAIT_FOR_IP} (s) for IP")
+        if int(WAIT_FOR_IP) > 0 and ip not in TokenPool.read_config(_config):
+            print(f"'{ip}' Was not found. Waiting {WAIT_FOR_IP} (s) for IP")
             time.sleep(int(WAIT_FOR_IP))
-            _config.read(__configfile)
-
-            _tokens = {k: v for k, v in _config.items("tokens")}
-            _ips = {k.strip('"'): _tokens[v].strip('"') for k, v in _config.items("ips")}
-        if not self.ip in _ips:
-            raise Exception(f"{self.ip} was not found in auth_tokens.ini")
-        auth_token = _ips[self.ip]
-
-        return auth_token
-
-    async def __get_raise(self, url, **kwargs):
-        async with rate_limit:
-            return await self.__get_raise__(url, **kwargs)
+            _config.read(_configfile)
+        try:
+            pool = TokenPool.from_config(_config, ip, rate=TOKEN_RATE)
+        except ValueError as e:
+            raise Exception(str(e))
+        if DEBUG:
+            print(f"Using {len(pool)} token(s) {pool.slots}", flush=True)
+        _token_pools[ip] = pool
+        return pool
 
     async def __get_raise__(self, url, **kwargs):
         with called_counter.get_lock():
             called_counter.value += 1
+        telemetry.request(url)
 
         if DEBUG or req_counter.value % 100 == 0:
             print(
                 f"{url}, {req_counter.value}, {called_counter.value}, {time.time() - start_time:.2f}, {(time.time() - start_time) / called_counter.value} avg"
             )
+        if USE_CACHE:
+            ## only the disk tier does IO, memory hits stay on the loop
+            if response_cache.cache_dir:
+                body = await _blocking(response_cache.get, url)
+            else:
+                body = response_cache.get(url)
+            if body is not None:
+                telemetry.source(url, "cache")
+                return json_loads(body)
         if USE_FILES_FOR_REQS:
-            floc = COCRequest._url_to_json_path(url)
-            if os.path.exists(floc):
-                if DEBUG:
-                    print(f"req.py opening '{floc}'")
-                with open(floc) as f:
-                    return json.load(f)
+            data = await _blocking(COCRequest._load_saved, url)
+            if data is not None:
+                telemetry.source(url, "recorded")
+                return data
         if OFFLINE:
-            raise FileNotFoundError(floc)
-
-        r = requests.get(_fmt_url_(url), timeout=2, **kwargs)
-        with req_counter.get_lock():
-            req_counter.value += 1
+            raise FileNotFoundError(COCRequest._url_to_json_path(url))
+
+        default_session = _get_session()
+        loop = asyncio.get_running_loop()
+        attempts = len(self.pool) + 2
+        for attempt in range(attempts):
+            t = time.perf_counter()
+            slot = await self.pool.acquire(self.priority)
+            telemetry.waited(url, time.perf_counter() - t)
+            session = slot.get_session(default_session, MAX_CONCURRENCY)
+            headers = {**self.headers, **slot.headers}
+            r, elapsed = await loop.run_in_executor(
+                _executor,
+                partial(_timed, session.get, _fmt_url_(url), timeout=2, headers=headers, **kwargs),
+            )
+            telemetry.response(url, r.status_code, elapsed)
+            with req_counter.get_lock():
+                req_counter.value += 1
+            if r.status_code != 429:
+                slot.succeeded()
+                break
+            if attempt < attempts - 1:
+                wait = slot.throttled(r.headers.get("Retry-After"))
+                if DEBUG:
+                    print(f"{slot} throttled, backing off {wait:.1f} (s)")
+        telemetry.source(url, "network")
+        ## parse the body once, it's used for the result and error reasons alike
+        body = r.content
+        try:
+            data = json_loads(body)
+        except ValueError:
+            if r.ok:
+                raise
+            data = {}  ## error pages from a proxy aren't json
         try:
             r.raise_for_status()
         except Exception as e:
-            # print(e)
-            # print(r)
-            # print(r.json())
-            e.json = r.json()
+            e.json = data
             raise e
 
+        if USE_CACHE:
+            if response_cache.cache_dir:
+                await _blocking(response_cache.put, url, body, max_age(r.headers))
+            else:
+                response_cache.put(url, body, max_age(r.headers))
         if SAVE_REQUESTS:
-            floc = COCRequest._url_to_json_path(url)
-            d = os.path.dirname(floc)
-            os.makedirs(d, exist_ok=True)
-            with open(floc, "w") as f:
-                json.dump(r.json(), f)
-        return r.json()
+            await _blocking(COCRequest._save, url, body)
+        return data
+
+    def iter_many(self, fetch, keys, return_exceptions=False):
+        """Fan out fetch(key) for every key and yield (key, result) as each one completes.
+        If return_exceptions is set failures are yielded in place of the result"""
+
+        async def _one(key):
+            return key, await fetch(key)
+
+        futs = {_submit(_one(k)): k for k in dict.fromkeys(keys)}
+        try:
+            for fut in concurrent.futures.as_completed(futs):
+                try:
+                    yield fut.result()
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    yield futs[fut], e
+        finally:
+            for fut in futs:
+                fut.cancel()
+
+    def _many(self, fetch, keys, return_exceptions=False):
+        return dict(self.iter_many(fetch, keys, return_exceptions=return_exceptions))
+
+    async def _get(self, url, errors=None):
+        """errors maps an api error reason to the exception raised for it instead.
+        Exceptions are counted here, once for every caller they reach, coalesced
+        callers included"""
+        try:
+            return await self._get_shared(url)
+        except Exception as e:
+            reason = (getattr(e, "json", None) or {}).get("reason") if isinstance(e, HTTPError) else None
+            if not errors or reason not in errors:
+                telemetry.exception(url, e)
+                raise
+            err = errors[reason](**e.json)
+            telemetry.exception(url, err)
+            raise err
+
+    @_on_request_loop
+    async def _get_shared(self, url):
+        """Callers asking for a url that is already in flight share its result
+        instead of each spending a request"""
+        if not COALESCE:
+            return await self.__get_raise__(url)
+        fut, priority = _inflight.get(url, (None, None))
+        ## a bulk request for the url may still be queued, don't wait behind it
+        if fut is not None and priority <= self.priority:
+            with coalesced_counter.get_lock():
+                coalesced_counter.value += 1
+            telemetry.request(url)
+            telemetry.source(url, "coalesced")
+            return await asyncio.shield(fut)
+        fut = asyncio.ensure_future(self.__get_raise__(url))
+        _inflight[url] = (fut, self.priority)
+
+        def _done(f):
+            if _inflight.get(url, (None,))[0] is f:
+                del _inflight[url]
+            if not f.cancelled():
+                f.exception()  # retrieved by whoever awaited it, don't warn
+
+        fut.add_done_callback(_done)
+        ## shielded so one caller giving up doesn't cancel it for the others
+        return await asyncio.shield(fut)
+
+    async def get_locations_async(self):
+        return await self._get(f"{API_URL}/locations")
+
+    async def get_war_leagues_async(self):
+        return await self._get(f"{API_URL}/warleagues")
+
+    async def get_top_players_country_async(self, country_id):
+        return await self._get(f"{API_URL}/locations/{country_id}/rankings/players")
+
+    async def get_top_clans_country_async(self, country_id):
+        return await self._get(f"{API_URL}/locations/{country_id}/rankings/clans")
+
+    async def get_league_group_async(self, clan_tag):
+        url = f"{API_URL}/clans/{fmt_tag(clan_tag)}/currentwar/leaguegroup"
+        return await self._get(url, errors={"notFound": NotInWarException})
+
+    async def get_current_war_async(self, clan_tag):
+        url = f"{API_URL}/clans/{fmt_tag(clan_tag)}/currentwar"
+        return await self._get(url, errors={"accessDenied": WarLogPrivateException})
+
+    async def get_league_war_async(self, war_tag):
+        url = f"{API_URL}/clanwarleagues/wars/{war_tag}"
+        res = await self._get(url)
+        if "state" in res and res["state"] == "notInWar":
+            e = NotInWarException(**res)
+            telemetry.exception(url, e)
+            raise e
+        return res
+
+    async def get_clan_async(self, tag):
+        return await self._get(f"{API_URL}/clans/{fmt_tag(tag)}")
+
+    async def get_clan_members_async(self, tag):
+        return await self._get(f"{API_URL}/clans/{fmt_tag(tag)}/members")
+
+    async def get_player_async(self, tag):
+        return await self._get(f"{API_URL}/players/{fmt_tag(tag)}")
+
+    async def get_war_log_async(self, tag):
+        url = f"{API_URL}/clans/{fmt_tag(tag)}/warlog"
+        return await self._get(url, errors={"accessDenied": WarLogPrivateException})
 
     def get_locations(self):
-        url = f"{API_URL}/locations"
-        return asyncio.run(self.__get_raise(url, headers=self.headers))
+        return _run(self.get_locations_async())
 
     def get_war_leagues(self):
-        url = f"{API_URL}/warleagues"
-        return asyncio.run(self.__get_raise(url, headers=self.headers))
+        return _run(self.get_war_leagues_async())
 
     def get_top_players_country(self, country_id):
-        url = f"{API_URL}/locations/{country_id}/rankings/players"
-        return asyncio.run(self.__get_raise(url, headers=self.headers))
+        return _run(self.get_top_players_country_async(country_id))
 
     def get_top_clans_country(self, country_id):
-        url = f"{API_URL}/locations/{country_id}/rankings/clans"
-        return asyncio.run(self.__get_raise(url, headers=self.headers))
+        return _run(self.get_top_clans_country_async(country_id))
 
     def get_league_group(self, clan_tag):
-        url = f"{API_URL}/clans/{fmt_tag(clan_tag)}/currentwar/leaguegroup"
-        try:
-            return asyncio.run(self.__get_raise(url, headers=self.headers))
-        except HTTPError as e:
-            if "reason" in e.json and e.json["reason"] == "notFound":
-                raise NotInWarException(**e.json)
-            raise
+        return _run(self.get_league_group_async(clan_tag))
 
     def get_current_war(self, clan_tag):
-        url = f"{API_URL}/clans/{fmt_tag(clan_tag)}/currentwar"
-        try:
-            return asyncio.run(self.__get_raise(url, headers=self.headers))
-        except HTTPError as e:
-            if "reason" in e.json and e.json["reason"] == "accessDenied":
-                raise WarLogPrivateException(**e.json)
+        return _run(self.get_current_war_async(clan_tag))
 
     def get_league_war(self, war_tag):
-        url = f"{API_URL}/clanwarleagues/wars/{war_tag}"
-        res = asyncio.run(self.__get_raise(url, headers=self.headers))
-        # print(res)
-        if "state" in res and res["state"] == "notInWar":
-            raise NotInWarException(**res)
-        return res
+        return _run(self.get_league_war_async(war_tag))
 
     def get_clan(self, tag):
-        url = f"{API_URL}/clans/{fmt_tag(tag)}"
-        return asyncio.run(self.__get_raise(url, headers=self.headers))
+        return _run(self.get_clan_async(tag))
 
     def get_clan_members(self, tag):
-        url = f"{API_URL}/clans/{fmt_tag(tag)}/members"
-        return asyncio.run(self.__get_raise(url, headers=self.headers))
+        return _run(self.get_clan_members_async(tag))
 
     def get_player(self, tag):
-        url = f"{API_URL}/players/{fmt_tag(tag)}"
-        return asyncio.run(self.__get_raise(url, headers=self.headers))
+        return _run(self.get_player_async(tag))
 
     def get_war_log(self, tag):
-        url = f"{API_URL}/clans/{fmt_tag(tag)}/warlog"
-        try:
-            return asyncio.run(self.__get_raise(url, headers=self.headers))
-        except HTTPError as e:
-            if "reason" in e.json and e.json["reason"] == "accessDenied":
-                raise WarLogPrivateException(**e.json)
+        return _run(self.get_war_log_async(tag))
+
+    def get_clans_many(self, tags, return_exceptions=False):
+        return self._many(self.get_clan_async, tags, return_exceptions)
+
+    def get_players_many(self, tags, return_exceptions=False):
+        return self._many(self.get_player_async, tags, return_exceptions)
+
+    def get_clan_members_many(self, tags, return_exceptions=False):
+        return self._many(self.get_clan_members_async, tags, return_exceptions)
+
+    def get_league_groups_many(self, clan_tags, return_exceptions=False):
+        return self._many(self.get_league_group_async, clan_tags, return_exceptions)
+
+    def get_league_wars_many(self, war_tags, return_exceptions=False):
+        return self._many(self.get_league_war_async, war_tags, return_exceptions)
+
+    def get_war_logs_many(self, tags, return_exceptions=False):
+        return self._many(self.get_war_log_async, tags, return_exceptions)
@@ -0,0 +1,206 @@
+"""Request telemetry: per endpoint counts, latency histograms, status codes, exceptions,
+where responses came from and time spent waiting on the rate limiter.
+
+Everything is kept per process. Dump it with to_json()/to_prometheus(), or set
+REQ_TELEMETRY_FILE (.json or .prom) to have models.req write it on exit.
+"""
+import bisect
+import json
+import re
+import threading
+
+## upper bounds in seconds, the last bucket is everything above
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_endpoints = [
+    (re.compile(r"/clans/[^/]+/members$"), "members"),
+    (re.compile(r"/clans/[^/]+/warlog$"), "warlog"),
+    (re.compile(r"/clans/[^/]+/currentwar/leaguegroup$"), "leaguegroup"),
+    (re.compile(r"/clans/[^/]+/currentwar$"), "currentwar"),
+    (re.compile(r"/clans/[^/]+$"), "clan"),
+    (re.compile(r"/clanwarleagues/wars/[^/]+$"), "leaguewar"),
+    (re.compile(r"/players/[^/]+$"), "player"),
+    (re.compile(r"/locations/[^/]+/rankings/"), "rankings"),
+    (re.compile(r"/locations$"), "locations"),
+    (re.compile(r"/warleagues$"), "warleagues"),
+]
+
+
+def endpoint_of(url):
+    for pattern, name in _endpoints:
+        if pattern.search(url):
+            return name
+    return "other"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+        self.max = max(self.max, v)
+
+    def quantile(self, q):
+        """Estimated by interpolating inside the bucket the quantile falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lo = self.buckets[i - 1] if i > 0 else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lo + (hi - lo) * (rank - seen) / c, self.max)
+            seen += c
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+        }
+
+
+class Telemetry:
+    """
+    Per endpoint:
+        requests      calls made through COCRequest
+        sources       where each answer came from: network, cache, recorded (saved
+                      files or archive) or coalesced (joined an identical request)
+        statuses      http status codes of network responses, 429s included
+        exceptions    exception class names raised to the caller, once per caller
+                      (coalesced callers each count the error they share)
+        latency       seconds per network round trip
+        limiter_wait  seconds spent waiting for a rate limit token
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.sources = {}
+            self.statuses = {}
+            self.exceptions = {}
+            self.latency = {}
+            self.limiter_wait = {}
+
+    @staticmethod
+    def _inc(d, key, n=1):
+        d[key] = d.get(key, 0) + n
+
+    def request(self, url):
+        with self._lock:
+            self._inc(self.requests, endpoint_of(url))
+
+    def source(self, url, source):
+        with self._lock:
+            self._inc(self.sources, (endpoint_of(url), source))
+
+    def response(self, url, status, seconds):
+        ep = endpoint_of(url)
+        with self._lock:
+            self._inc(self.statuses, (ep, status))
+            self.latency.setdefault(ep, Histogram()).observe(seconds)
+
+    def waited(self, url, seconds):
+        with self._lock:
+            self.limiter_wait.setdefault(endpoint_of(url), Histogram()).observe(seconds)
+
+    def exception(self, url, e):
+        with self._lock:
+            self._inc(self.exceptions, (endpoint_of(url), type(e).__name__))
+
+    def to_dict(self):
+        with self._lock:
+            endpoints = {}
+
+            def ep_dict(ep):
+                if ep not in endpoints:
+                    endpoints[ep] = {
+                        "requests": self.requests.get(ep, 0),
+                        "sources": {},
+                        "statuses": {},
+                        "exceptions": {},
+                    }
+                return endpoints[ep]
+
+            for ep in self.requests:
+                ep_dict(ep)
+            for (ep, s), n in self.sources.items():
+                ep_dict(ep)["sources"][s] = n
+            for (ep, s), n in self.statuses.items():
+                ep_dict(ep)["statuses"][str(s)] = n
+            for (ep, s), n in self.exceptions.items():
+                ep_dict(ep)["exceptions"][s] = n
+            for ep, h in self.latency.items():
+                ep_dict(ep)["latency"] = h.to_dict()
+            for ep, h in self.limiter_wait.items():
+                ep_dict(ep)["limiter_wait"] = h.to_dict()
+            for d in endpoints.values():
+                served = sum(d["sources"].values())
+                hits = served - d["sources"].get("network", 0)
+                d["hit_rate"] = hits / served if served else 0.0
+            return {
+                "requests": sum(self.requests.values()),
+                "network_seconds": sum(h.sum for h in self.latency.values()),
+                "limiter_wait_seconds": sum(h.sum for h in self.limiter_wait.values()),
+                "endpoints": endpoints,
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix="coc"):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+        def histogram(name, hists):
+            for ep, h in sorted(hists.items()):
+                cumulative = 0
+                for le, c in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cumulative += c
+                    lines.append(f'{prefix}_{name}_bucket{{endpoint="{ep}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_{name}_sum{{endpoint="{ep}"}} {h.sum}')
+                lines.append(f'{prefix}_{name}_count{{endpoint="{ep}"}} {h.count}')
+
+        with self._lock:
+            metric("requests_total", "counter", "Calls made through COCRequest")
+            for ep, n in sorted(self.requests.items()):
+                lines.append(f'{prefix}_requests_total{{endpoint="{ep}"}} {n}')
+            metric("responses_total", "counter", "Answers by where they came from")
+            for (ep, s), n in sorted(self.sources.items()):
+                lines.append(f'{prefix}_responses_total{{endpoint="{ep}",source="{s}"}} {n}')
+            metric("http_responses_total", "counter", "Network responses by status code")
+            for (ep, s), n in sorted(self.statuses.items()):
+                lines.append(f'{prefix}_http_responses_total{{endpoint="{ep}",status="{s}"}} {n}')
+            metric("exceptions_total", "counter", "Exceptions raised to the caller")
+            for (ep, s), n in sorted(self.exceptions.items()):
+                lines.append(f'{prefix}_exceptions_total{{endpoint="{ep}",exception="{s}"}} {n}')
+            metric("request_seconds", "histogram", "Network round trip time")
+            histogram("request_seconds", self.latency)
+            metric("limiter_wait_seconds", "histogram", "Time spent waiting for a rate limit token")
+            histogram("limiter_wait_seconds", self.limiter_wait)
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Write to path, in prometheus text format if it ends with .prom otherwise json"""
+        with open(path, "w") as f:
+            f.write(self.to_prometheus() if path.endswith(".prom") else self.to_json(indent=2))
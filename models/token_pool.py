@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import os
+import socket
+import tempfile
+import time
+from enum import IntEnum
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from models.limiter import RateLimiter
+
+MAX_BACKOFF = 60  # in seconds
+## every process on the host shares a key's bucket through a file in here
+LIMITER_DIR = os.getenv("REQ_LIMITER_DIR", os.path.join(tempfile.gettempdir(), "coc_rate_limits"))
+
+
+class Priority(IntEnum):
+    """Request classes, a lower value always gets the next token first"""
+
+    REALTIME = 0  # live war tracking, a war that just ended
+    INTERACTIVE = 1  # someone is waiting on the answer
+    BULK = 2  # crawls, gets whatever budget is left
+
+
+## fraction of a key's bucket each class must leave for the classes above it. Shared
+## through the bucket file, so it holds across processes: a bulk crawl keeps its full
+## throughput but never drains the burst a realtime request needs
+RESERVE = {Priority.REALTIME: 0, Priority.INTERACTIVE: 0.1, Priority.BULK: 0.25}
+
+
+class SourceAddressAdapter(HTTPAdapter):
+    """HTTPAdapter that sends from a specific local address"""
+
+    def __init__(self, source_ip, **kwargs):
+        self.source_ip = source_ip
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["source_address"] = (self.source_ip, 0)
+        super().init_poolmanager(*args, **kwargs)
+
+
+def is_local_ip(ip):
+    """Whether this host can send from ip (ie one of our interfaces owns it)"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((ip, 0))
+        return True
+    except OSError:
+        return False
+
+
+class TokenSlot:
+    """A developer key, the IP it is registered to and its own request budget"""
+
+    def __init__(self, name, token, ip=None, bind_ip=False, rate=20, period=1):
+        self.name = name
+        self.token = token
+        self.ip = ip
+        self.bind_ip = bind_ip
+        bucket = hashlib.sha1(token.encode()).hexdigest()[:16]
+        self.limiter = RateLimiter(rate / period, rate, os.path.join(LIMITER_DIR, f"{bucket}.bucket"))
+        self.headers = {"Accept": "application/json", "authorization": "Bearer " + token}
+        self.backoff = 0
+        self.backoff_until = 0
+        self.session = None
+
+    def __str__(self):
+        return f"(TokenSlot {self.name} ip={self.ip} bind={self.bind_ip})"
+
+    def __repr__(self):
+        return str(self)
+
+    def backing_off(self, now=None):
+        return (now or time.time()) < self.backoff_until
+
+    def headroom(self):
+        """Number of requests that can be made right now without waiting"""
+        if self.backing_off():
+            return 0
+        return self.limiter.available()
+
+    def get_session(self, default_session, pool_maxsize=10):
+        if not self.bind_ip:
+            return default_session
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = SourceAddressAdapter(self.ip, pool_connections=4, pool_maxsize=pool_maxsize)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+        return self.session
+
+    def throttled(self, retry_after=None):
+        """The API answered 429, stop using this key for a while"""
+        self.backoff = min(max(1, self.backoff * 2), MAX_BACKOFF)
+        try:
+            wait = float(retry_after)
+        except (TypeError, ValueError):
+            wait = self.backoff
+        self.backoff_until = time.time() + wait
+        return wait
+
+    def succeeded(self):
+        self.backoff = 0
+
+
+class TokenPool:
+    """Routes each request to the key with the most headroom.
+
+    Each key keeps its own token bucket, shared with every other process on this host.
+    A key that gets throttled backs off on its own and the remaining keys keep serving
+    requests.
+    """
+
+    def __init__(self, slots):
+        if not slots:
+            raise ValueError("TokenPool needs at least one token")
+        self.slots = slots
+        self._waiting = {p: 0 for p in Priority}
+        self._changed = None  # asyncio.Event set when a waiter leaves
+
+    def __len__(self):
+        return len(self.slots)
+
+    @staticmethod
+    def read_config(config):
+        """Returns {ip: (token_name, token)} for every ip in the [ips] section"""
+        tokens = {k: v.strip('"') for k, v in config.items("tokens")}
+        return {k.strip('"'): (v, tokens[v]) for k, v in config.items("ips")}
+
+    @staticmethod
+    def from_config(config, public_ip, rate=20, period=1):
+        """Creates a slot for every key usable from this host.
+
+        A key is usable if it is registered to our public ip, or to an ip one of our
+        interfaces owns (in which case its requests are sent from that address).
+        """
+        slots = {}
+        for ip, (name, token) in TokenPool.read_config(config).items():
+            if name in slots:
+                continue
+            if ip == public_ip:
+                slots[name] = TokenSlot(name, token, ip, rate=rate, period=period)
+            elif is_local_ip(ip):
+                slots[name] = TokenSlot(name, token, ip, bind_ip=True, rate=rate, period=period)
+        if not slots:
+            raise ValueError(f"{public_ip} was not found in auth_tokens.ini")
+        return TokenPool(list(slots.values()))
+
+    def _outranked(self, priority):
+        return any(n for p, n in self._waiting.items() if p < priority)
+
+    async def acquire(self, priority=Priority.INTERACTIVE):
+        """Wait for a request token and return the slot it was taken from.
+        Nothing is handed to a class while a higher one is waiting in this process"""
+        self._waiting[priority] += 1
+        try:
+            while self._outranked(priority):
+                if self._changed is None:
+                    self._changed = asyncio.Event()
+                await self._changed.wait()
+            while True:
+                now = time.time()
+                ready = [s for s in self.slots if not s.backing_off(now)]
+                if not ready:
+                    await asyncio.sleep(min(s.backoff_until for s in self.slots) - now)
+                    continue
+                slot = max(ready, key=lambda s: s.headroom())
+                await slot.limiter.acquire_async(reserve=RESERVE[priority] * slot.limiter.capacity)
+                if not slot.backing_off():
+                    return slot
+        finally:
+            self._waiting[priority] -= 1
+            if self._changed is not None:
+                self._changed.set()
+                self._changed = None
@@ -1,11 +1,19 @@
 import configparser
+import json
 import os
 import re
 from functools import partial
 
 from models.exceptions import InvalidTagException
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __TAG_REGEX__ = re.compile("#[PYLQGRJCUV0289]+")
+__TAG_ALPHABET__ = "0289PYLQGRJCUV"
+_TAG_DIGITS = {c: i + 1 for i, c in enumerate(__TAG_ALPHABET__)}
 
 def env_istrue(env_var, default=None):
     v = os.getenv(env_var, default)
@@ -17,6 +25,26 @@ def fmt_tag(tag, verify = True):
         raise InvalidTagException(f"{tag} is not a valid Tag")
     return tag
 
+def tag_to_int(tag):
+    """A tag as an integer, in bijective base 14 so a leading 0 isn't lost"""
+    n = 0
+    for c in fmt_tag(tag)[1:]:
+        n = n * 14 + _TAG_DIGITS[c]
+    return n
+
+def int_to_tag(n):
+    chars = []
+    while n:
+        n, r = divmod(n - 1, 14)
+        chars.append(__TAG_ALPHABET__[r])
+    return "#" + "".join(reversed(chars))
+
+def json_loads(data):
+    """Parse json from bytes or str, with orjson when it is installed"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
 ## ^#[PYLQGRJCUV0289]+$ < regex for clan/player tag
 def chunks(lst, n):
     """
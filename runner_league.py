@@ -23,6 +23,8 @@ OFFLINE = False
 
 req.OFFLINE = OFFLINE
 req.USE_FILES_FOR_REQS = OFFLINE
+## crawls only get the budget live war tracking leaves
+req.DEFAULT_PRIORITY = req.Priority.BULK
 
 cocreq = COCRequest()
 
@@ -32,6 +34,7 @@ jcount = 0
 
 USE_REQ = False
 DATA_DIR = "data2"
+CLANS_PER_BATCH = 20  # clans per update_league call, batch i starts at clan i * CLANS_PER_BATCH
 players = {}
 league_groups = {}
 leagues = {}
@@ -126,7 +129,7 @@ def run(auth_token, start, end, suffix="", league_counts={}):
     print("nclans = ", len(clans))
     from models.utils import chunks
 
-    list_clans = chunks(clans, 20)
+    list_clans = chunks(clans, CLANS_PER_BATCH)
 
     cpus = 10
     from models.db import driver
@@ -136,9 +139,9 @@ def run(auth_token, start, end, suffix="", league_counts={}):
 
     mc = ModelControler()
 
-    for i, c in enumerate(clans):
+    for i, c in enumerate(list_clans):
         try:
-            update_league(c, i, start, suffix, league_counts, mc)
+            update_league(c, i * CLANS_PER_BATCH, start, suffix, league_counts, mc)
         except Exception as e:
             print(e)
             traceback.print_exc()
@@ -163,7 +166,7 @@ def should_skip(league, counts):
 
 
 def update_league(clans, j, start, suffix="", league_counts={}, mc=None):
-    from models.models import WarLeague
+    from models.models import Clan, WarLeague
 
     clans = clans if isinstance(clans, list) else [clans]
     found = {}
@@ -175,20 +178,26 @@ def update_league(clans, j, start, suffix="", league_counts={}, mc=None):
         from models.model_controler import ModelControler
 
         mc = ModelControler()
-    for count, ctag in enumerate(clans):
+    ## skip what the db already says is over the league's count, then fetch and save
+    ## the rest in one batch
+    current = Clan._get_current_leagues(clans)
+    todo = []
+    for ctag in clans:
+        if ctag in found:
+            continue
+        cl = current.get(ctag)
+        if cl and should_skip(cl, league_counts):
+            print(f"db skipping {ctag},{cl}, count={league_counts[cl]}")
+            continue
+        todo.append(ctag)
+    fetched = mc.get_clans(todo, save_to_db=True, return_exceptions=True) if todo else {}
+
+    for count, ctag in enumerate(todo):
         try:
             print(" - ", start + j, count, end="")
-            if ctag in found:
-                print()
-                continue
-            clan = mc.dbcont.get_clan(ctag)
-            if clan:
-                cl = clan.get_current_league()
-                if cl and should_skip(cl, league_counts):
-                    print(f"db skipping {ctag},{cl}, count={league_counts[cl]}")
-                    continue
-
-            clan = mc.get_clan(ctag, save_to_db=True)
+            clan = fetched[ctag]
+            if isinstance(clan, Exception):
+                raise clan
 
             if should_skip(clan.war_league, league_counts):
                 print(f"skipping {ctag},{clan.war_league}, count={league_counts[clan.war_league]}")
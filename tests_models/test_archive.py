@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+import unittest
+
+from models.archive import ResponseArchive, migrate
+
+URL = "https://api.clashofclans.com/v1/clans/#8ULL0ULU"
+
+
+class AllTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "archive")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_put_get(self):
+        a = ResponseArchive(self.path, compression="gz", segment_size=200)
+        for i in range(10):
+            a.put(f"{URL}/{i}", json.dumps({"i": i}))
+        a.put(f"{URL}/3", b'{"i": 33}')
+        self.assertEqual(a.get(f"{URL}/3"), {"i": 33})
+        self.assertIsNone(a.get(URL))
+        a.compact()
+        a.put(URL, b"{}")
+        self.assertEqual(a.get(f"{URL}/9"), {"i": 9})
+        self.assertEqual(len(a), 11)
+        a.close()
+
+        a = ResponseArchive(self.path)
+        self.assertEqual(a.get(URL), {})
+        self.assertEqual(a.get(f"{URL}/3"), {"i": 33})
+        a.close()
+
+    def test_recover(self):
+        a = ResponseArchive(self.path, compression="gz")
+        a.put(URL, b'{"ok": 1}')
+        a.close()
+        with open(os.path.join(self.path, "seg-00000.jsonl.gz"), "ab") as f:
+            f.write(b"half a record")
+        with open(os.path.join(self.path, "index.log"), "ab") as f:
+            f.write(b"half")
+
+        a = ResponseArchive(self.path, compression="gz")
+        self.assertEqual(a.get(URL), {"ok": 1})
+        a.put(f"{URL}/warlog", b'{"items": []}')
+        self.assertEqual(a.get(f"{URL}/warlog"), {"items": []})
+        a.close()
+
+    def test_recover_skips_bad_entries(self):
+        a = ResponseArchive(self.path, compression="gz")
+        for i in range(3):
+            a.put(f"{URL}/{i}", json.dumps({"i": i}))
+        a.close()
+        log = os.path.join(self.path, "index.log")
+        with open(log, "rb") as f:
+            data = f.read()
+        n = len(data) // 3
+        ## an entry for a segment that doesn't exist, between two good ones
+        bad = bytes(20) + (7).to_bytes(4, "little") + bytes(n - 24)
+        with open(log, "wb") as f:
+            f.write(data[:n] + bad + data[n:])
+
+        a = ResponseArchive(self.path, compression="gz")
+        self.assertEqual([a.get(f"{URL}/{i}") for i in range(3)], [{"i": i} for i in range(3)])
+        self.assertEqual(os.path.getsize(log), len(data))
+        a.close()
+
+    def test_other_writer(self):
+        a = ResponseArchive(self.path, compression="gz")
+        b = ResponseArchive(self.path, compression="gz")
+        a.put(URL, b'{"a": 1}')
+        self.assertIn(URL, b)
+        self.assertEqual(b.get(URL), {"a": 1})
+        b.put(f"{URL}/b", b'{"b": 1}')
+        a.compact()
+        a.put(f"{URL}/a", b'{"a": 2}')
+        self.assertEqual([b.get(URL), b.get(f"{URL}/a")], [{"a": 1}, {"a": 2}])
+        self.assertEqual(len(b), 3)
+        a.close()
+        b.close()
+
+    def test_migrate(self):
+        rdir = os.path.join(self.tmpdir.name, "requests")
+        os.makedirs(os.path.join(rdir, "clans", "#8ULL0ULU"))
+        with open(os.path.join(rdir, "clans", "#8ULL0ULU.json"), "w") as f:
+            json.dump({"tag": "#8ULL0ULU"}, f, indent=2)
+        with open(os.path.join(rdir, "clans", "#8ULL0ULU", "warlog.json"), "w") as f:
+            json.dump({"items": []}, f)
+        self.assertEqual(migrate(rdir, self.path), 2)
+        a = ResponseArchive(self.path)
+        self.assertEqual(a.get(URL), {"tag": "#8ULL0ULU"})
+        self.assertEqual(a.get(f"{URL}/warlog"), {"items": []})
+        a.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import tempfile
+import time
+import unittest
+
+from models.cache import ResponseCache, max_age
+
+URL = "https://api.clashofclans.com/v1/clans/#2R9LQRLY"
+
+
+class AllTests(unittest.TestCase):
+    def test_max_age(self):
+        self.assertEqual(max_age({"Cache-Control": "public max-age=120"}), 120)
+        self.assertEqual(max_age({"Cache-Control": "no-cache"}), 0)
+        self.assertEqual(max_age({}), 0)
+
+    def test_memory(self):
+        c = ResponseCache(maxsize=2)
+        self.assertIsNone(c.get(URL))
+        c.put(URL, b"{}", 60)
+        self.assertEqual(c.get(URL), b"{}")
+        c.put("a", b"1", 60)
+        c.put("b", b"2", 60)
+        self.assertIsNone(c.get(URL))  ## evicted
+        self.assertEqual(c.stats()["hits"], 1)
+        self.assertEqual(c.stats()["misses"], 2)
+
+    def test_expired(self):
+        c = ResponseCache()
+        c.put(URL, b"{}", 0.05)
+        time.sleep(0.1)
+        self.assertIsNone(c.get(URL))
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as d:
+            ResponseCache(cache_dir=d).put(URL, b"{}", 60)
+            c = ResponseCache(cache_dir=d)
+            self.assertEqual(c.get(URL), b"{}")
+            self.assertEqual(c.stats()["disk_hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,84 @@
-import configparser
-import logging
+import asyncio
 import os
-import sys
+import tempfile
+import time
 import unittest
+from multiprocessing import Pool
+
+from models.limiter import RateLimiter
+
+RATE = 20
+CAPACITY = 5
+DURATION = 2
+NPROCS = 4
+
+
+def _drain(path):
+    """Take as many tokens as the shared bucket allows for DURATION seconds"""
+    rl = RateLimiter(RATE, CAPACITY, path)
+    count = 0
+    end = time.time() + DURATION
+    while time.time() < end:
+        rl.acquire()
+        count += 1
+    return count
+
+
+class AllTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "test.bucket")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_capacity(self):
+        rl = RateLimiter(RATE, CAPACITY)
+        for i in range(CAPACITY):
+            self.assertTrue(rl.try_acquire())
+        self.assertFalse(rl.try_acquire())
+        time.sleep(2.0 / RATE)
+        self.assertTrue(rl.try_acquire())
+
+    def test_shared_file(self):
+        rl1 = RateLimiter(RATE, CAPACITY, self.path)
+        rl2 = RateLimiter(RATE, CAPACITY, self.path)
+        for i in range(CAPACITY):
+            self.assertTrue(rl1.try_acquire())
+        self.assertFalse(rl2.try_acquire())
+        self.assertLess(rl2.available(), 1)
+
+    def test_reserve(self):
+        """Callers with a reserve leave that many tokens for those without"""
+        rl = RateLimiter(RATE, CAPACITY, self.path)
+        for i in range(CAPACITY - 2):
+            self.assertTrue(rl.try_acquire(reserve=2))
+        self.assertFalse(rl.try_acquire(reserve=2))
+        self.assertTrue(rl.try_acquire())
+        self.assertTrue(rl.try_acquire())
+
+    def test_async(self):
+        rl = RateLimiter(RATE, CAPACITY, self.path)
+
+        async def run():
+            for i in range(CAPACITY + RATE):
+                async with rl:
+                    pass
+
+        st = time.time()
+        asyncio.run(run())
+        self.assertGreaterEqual(time.time() - st, 0.9)
+
+    def test_processes(self):
+        """NPROCS competing processes together only get RATE tokens per second"""
+        with Pool(NPROCS) as p:
+            counts = p.map(_drain, [self.path] * NPROCS)
+        total = sum(counts)
+        expected = CAPACITY + RATE * DURATION
+        self.assertLessEqual(total, expected + NPROCS)
+        self.assertGreaterEqual(total, 0.8 * RATE * DURATION)
+        self.assertTrue(all(c > 0 for c in counts))
+
+
+if __name__ == "__main__":
+    unittest.main()
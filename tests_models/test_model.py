@@ -8,6 +8,9 @@ import unittest
 from datetime import datetime
 
 import glicko2
+import pandas as pd
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import IntegrityError
 
 _cwd = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, f"{_cwd}/..")
@@ -74,6 +77,12 @@ class AllTests(unittest.TestCase):
         req.USE_FILES_FOR_REQS = fakeit
         req.OFFLINE = offline
 
+    @staticmethod
+    def league_war():
+        """A fresh copy of the saved league war response, free to modify"""
+        with open(f"{_cwd}/data/warTag_#2PRPJQQPR.json") as f:
+            return json.load(f)
+
     @timeit
     def test_war_league(self):
         self.fake(True, True)
@@ -82,6 +91,428 @@ class AllTests(unittest.TestCase):
         lg2 = mc.get_league_group(TEST_CLAN, save_to_db=True)
         self.assertEqual(lg.id, lg2.id)
 
+    def test_from_api(self):
+        self.assertEqual(
+            md._parse_api_time("20200729T194845.123Z"),
+            datetime.strptime("20200729T194845.123Z", md._DATE_STR_FORMAT_),
+        )
+        d = self.league_war()
+        war = md.War(**d)
+        self.assertEqual(war.end_time, datetime.strptime(d["endTime"], md._DATE_STR_FORMAT_))
+        self.assertEqual(war.state, md.WarState.from_str(d["state"]).value)
+        self.assertEqual(war.team_size, d["teamSize"])
+        wp = war.clans[0].members[0]
+        self.assertIsNotNone(wp.town_hall_level)
+        self.assertEqual(len(war.attacks), sum(len(m.get("attacks", [])) for m in d["clan"]["members"] + d["opponent"]["members"]))
+
+    def test_bulk_insert_wars(self):
+        import models.db as db
+        wdicts = []
+        for i in range(3):
+            wd = self.league_war()
+            wd["endTime"] = f"2020080{i + 1}T194845.000Z"
+            for side, other in (("clan", "opponent"), ("opponent", "clan")):
+                for m, o in zip(wd[side]["members"], wd[other]["members"]):
+                    m["attacks"] = [
+                        {"attackerTag": m["tag"], "defenderTag": o["tag"], "stars": 2, "destructionPercentage": 80, "order": 1}
+                    ]
+            wdicts.append(wd)
+        wars = md.War._bulk_insert(wdicts[:2] + [md.War(**wdicts[2])])
+        db.session.commit()
+        self.assertEqual(3, len(set(w.id for w in wars)))
+        for w in wars:
+            dbw = md.War._get_wars([w])[0]
+            self.assertEqual(dbw.id, w.id)
+            self.assertEqual(len(dbw.clans), 2)
+            self.assertEqual(len(dbw.attacks), 30)
+            for c in dbw.clans:
+                self.assertEqual(c.war_id, w.id)
+                for p in c.members:
+                    for a in p.attacks:
+                        self.assertEqual(a.war_id, w.id)
+        self.assertEqual(db.session.query(md.WarAttack).filter(md.WarAttack.war_id.is_(None)).count(), 0)
+
+    def test_war_key(self):
+        import models.db as db
+        d = self.league_war()
+        war = md.War._bulk_insert([d])[0]
+        db.session.commit()
+        self.assertEqual(war.war_key, f"{war.clan1_tag}|{war.clan2_tag}|{d['endTime'][:15]}")
+        ## the backfill in the README gives the same key
+        backfill = db.session.execute(
+            "SELECT clan1_tag || '|' || clan2_tag || '|' || strftime('%Y%m%dT%H%M%S', end_time) FROM war"
+        ).scalar()
+        self.assertEqual(backfill, war.war_key)
+        self.assertEqual(md.War.get_war(war.clan1_tag, war.clan2_tag, war.end_time).id, war.id)
+        self.assertTrue(md.War.war_exists(war.clan1_tag, war.clan2_tag, war.end_time))
+        self.assertEqual([w.id for w in md.War._get_wars([md.War(**d), md.War(**d)])], [war.id])
+        d["endTime"] = "20200101T000000.000Z"
+        self.assertEqual(md.War._get_wars([md.War(**d)]), [])
+
+    def test_war_tag_states(self):
+        import models.db as db
+        g = md.LeagueGroup(1, state="inWar", league_id=48000010, clans=[], rounds=[{"warTags": ["#2PP", "#8QQ", "#9LL"]}])
+        db.session.add(g)
+        db.session.flush()
+        r = g.rounds[0]
+        wars = []
+        for tag, end in (("#2PP", "20200101T000000.000Z"), ("#8QQ", "20990101T000000.000Z")):
+            wd = self.league_war()
+            wd.update(endTime=end, startTime=end, war_tag=tag, league_round_id=r.id)
+            wars.append(md.War(**wd))
+        for w, wt in zip(md.War._bulk_insert(wars), r.war_tags):
+            wt.war_id = w.id
+        db.session.commit()
+        try:
+            states = md.WarTag.get_states(["#2PP", "#8QQ", "#9LL", "#NOPE"])
+            self.assertEqual(sorted(states), ["#2PP", "#8QQ", "#9LL"])
+            self.assertEqual((states["#2PP"].stored_war_id, states["#2PP"].war_status), (wars[0].id, md.WarState.war_ended))
+            self.assertEqual(states["#8QQ"].war_status, md.WarState.preparation)
+            self.assertIsNone(states["#9LL"].stored_war_id)
+            self.assertTrue(md.WarTag.is_ended("#2PP"))
+            self.assertFalse(md.WarTag.is_ended("#8QQ"))
+            ## known ended tags aren't queried again
+            self.assertEqual(sorted(md.WarTag.get_states(["#2PP", "#8QQ"])), ["#8QQ"])
+        finally:
+            md._ended_war_tags.clear()
+
+    def test_league_group_status(self):
+        import models.db as db
+        from models.utils import int_to_tag
+        tags = iter(int_to_tag(i) for i in range(1000, 1100))
+        groups = []
+        for _ in range(3):
+            g = md.LeagueGroup(1, state="inWar", clans=[], rounds=[{"warTags": [next(tags) for _ in range(4)]} for _ in range(7)])
+            db.session.add(g)
+            groups.append(g)
+        db.session.flush()
+        ## the second group's last round has all 4 wars, the first only 2
+        wdicts = []
+        for i, g in enumerate(groups[:1] * 2 + groups[1:2] * 4):
+            wd = self.league_war()
+            wd.update(state="warEnded", endTime=f"2020080{i + 1}T194845.000Z", league_round_id=g.rounds[-1].id)
+            wdicts.append(wd)
+        md.War._bulk_insert(wdicts)
+        db.session.commit()
+        season = db.session.query(md.LeagueSeason).get(1)
+        self.assertEqual([g.id for g in season.iter_unfinished_groups(batch_size=2)], [g.id for g in groups])
+        self.assertEqual([g.update_status() for g in groups], [False, True, False])
+        db.session.commit()
+        self.assertTrue(groups[1].finished())
+        self.assertIsNotNone(groups[1].finished_at)
+        self.assertEqual([g.id for g in season.iter_unfinished_groups(batch_size=1)], [groups[0].id, groups[2].id])
+
+    def test_get_clans_batch(self):
+        import models.db as db
+
+        def clan(tag, name, description, level=5):
+            return {"tag": tag, "name": name, "description": description, "warLeague": {"id": 48000010}, "clanLevel": level}
+
+        mc = ModelControler(req.COCRequest(auth_token="x"))
+        args = (md.Clan, md.ClanHistory, md.ClanNameHistory, md.ClanDescriptionHistory, md.EntryType.from_clan)
+        r = mc._get_players_or_clans([clan("#2PP", "a", "d1"), clan("#8QQ", "b", "d2")], *args, save_to_db=True)
+        self.assertEqual(sorted(r), ["#2PP", "#8QQ"])
+        ## the returned rows are usable as they are
+        self.assertIsNotNone(r["#2PP"].history[0].insert_time)
+        self.assertEqual(r["#2PP"].get_current_league(), 48000010)
+        first_check = md.ClanLatest.get_history("#2PP").last_check
+        mc._get_players_or_clans([clan("#2PP", "a", "d1")], *args, save_to_db=True)
+        db.session.expunge_all()
+        ## checked again too soon, nothing is written
+        self.assertEqual(md.ClanLatest.get_history("#2PP").last_check, first_check)
+        t = md.ClanHistory.__table__
+        db.session.execute(t.update().values(last_check=datetime(2020, 1, 1)))
+        db.session.commit()
+        mc._get_players_or_clans([clan("#2PP", "a", "d1"), clan("#8QQ", "b2", "d3", 6)], *args, save_to_db=True)
+        db.session.expunge_all()
+        ## unchanged only has its check time moved, changed gets new rows and the new name
+        self.assertEqual(db.session.query(md.ClanHistory).filter(md.ClanHistory.tag == "#2PP").count(), 1)
+        self.assertGreater(md.ClanLatest.get_history("#2PP").last_check, datetime(2020, 1, 1))
+        lh = md.ClanLatest.get_history("#8QQ")
+        self.assertEqual((lh.clan_level, lh.description_id), (6, md.ClanDescriptionHistory.get_id("#8QQ", "d3")))
+        self.assertEqual(md.Clan._get_name_dict(["#2PP", "#8QQ"]), {"#2PP": "a", "#8QQ": "b2"})
+        self.assertEqual(db.session.query(md.ClanNameHistory).count(), 3)
+        self.assertEqual(md.Clan._get_current_leagues(["#2PP", "#9LL"]), {"#2PP": 48000010})
+
+        ## the returned clans are the stored ones, adding them again inserts nothing
+        r = mc._get_players_or_clans([clan("#2PP", "a", "d1"), clan("#0RR", "c", "d4")], *args, save_to_db=True)
+        self.assertEqual((r["#2PP"].war_league, r["#0RR"].names[0].name), (48000010, "c"))
+        self.assertEqual((r["#0RR"].history[0].clan_level, r["#0RR"].get_current_league()), (5, 48000010))
+        for c in r.values():
+            db.session.add(c)
+        db.session.commit()
+        self.assertEqual(db.session.query(md.ClanHistory).count(), 4)
+
+        ## a failed batch write is rolled back and the clans saved one at a time
+        def fail(*a, **kw):
+            db.session.add(md.ClanNameHistory(tag="#2PP", name="lost"))
+            raise IntegrityError("INSERT", {}, Exception("duplicate"))
+
+        mc._get_players_or_clans = fail
+        r = mc._get_many({"#8QQ": clan("#8QQ", "b3", "d3", 6), "#9LL": ValueError("404")}, True, *args[:4],
+                         entry_type=args[4], save_to_db=True)
+        self.assertIsInstance(r["#9LL"], ValueError)
+        self.assertEqual(r["#8QQ"].name, "b3")
+        self.assertEqual(md.Clan._get_name_dict(["#2PP", "#8QQ"]), {"#2PP": "a", "#8QQ": "b3"})
+
+    def test_update_clan_members_touch(self):
+        import models.db as db
+
+        def member(tag, trophies):
+            return {"tag": tag, "name": tag, "role": "member", "expLevel": 100, "league": {"id": 29000000},
+                    "trophies": trophies, "clanRank": 1, "previousClanRank": 1, "donations": 0, "donationsReceived": 0}
+
+        mc = ModelControler(req.COCRequest(auth_token="x"))
+        members = {"items": [member("#2PP", 1000), member("#8QQ", 2000)]}
+        mc.req.get_clan_members = lambda tag: members
+        mc.update_clan_members("#9LL", save_to_db=True)
+        t = md.PlayerHistory.__table__
+        db.session.execute(t.update().values(last_check=datetime(2020, 1, 1)))
+        db.session.commit()
+        members["items"][1] = member("#8QQ", 2100)
+        mc.update_clan_members("#9LL", save_to_db=True)
+        db.session.expunge_all()
+        ## the unchanged player only has its check time moved, the changed one gets a new row
+        self.assertEqual(db.session.query(md.PlayerHistory).filter(md.PlayerHistory.tag == "#2PP").count(), 1)
+        self.assertGreater(md.PlayerLatest.get_history("#2PP").last_check, datetime(2020, 1, 1))
+        self.assertEqual(md.PlayerLatest.get_history("#8QQ").trophies, 2100)
+        self.assertEqual(md.Player._get_not_exist(["#2PP", "#8QQ"]), set())
+
+    def test_int_tags(self):
+        import models.db as db
+        from models.exceptions import InvalidTagException
+        from models.utils import int_to_tag, tag_to_int
+        for tag in ("#0", "#00", "#2PP", TEST_CLAN, "#VVVVVVVVVVV"):
+            self.assertEqual(int_to_tag(tag_to_int(tag)), tag)
+        self.assertEqual(tag_to_int("2pp"), tag_to_int("#2PP"))
+        self.assertRaises(InvalidTagException, tag_to_int, "#NOPE")
+        t = db.Tag()
+        self.assertEqual(t.process_bind_param(TEST_CLAN, None), TEST_CLAN)
+        db.INT_TAGS = True
+        try:
+            n = t.process_bind_param(TEST_CLAN, None)
+            self.assertEqual((n, t.process_bind_param(n, None)), (tag_to_int(TEST_CLAN), n))
+            self.assertEqual(t.process_result_value(n, None), TEST_CLAN)
+        finally:
+            db.INT_TAGS = False
+
+    def test_war_snapshots(self):
+        import models.db as db
+        wdicts = []
+        for i in range(5):
+            wd = self.league_war()
+            wd["state"] = "warEnded"
+            wd["endTime"] = f"2020090{5 - i}T194845.000Z"
+            for m, o in zip(wd["clan"]["members"], wd["opponent"]["members"]):
+                m["attacks"] = [{"attackerTag": m["tag"], "defenderTag": o["tag"], "stars": i % 4, "destructionPercentage": 50, "order": 1}]
+            wdicts.append(wd)
+        md.War._bulk_insert(wdicts)
+        db.session.commit()
+        snaps = list(md.War.iter_snapshots(md.War.end_time > datetime(2020, 9, 1), batch_size=2, attacks=True))
+        self.assertEqual(len(snaps), 5)
+        self.assertEqual([s.end_time for s in snaps], sorted(s.end_time for s in snaps))
+        for s in snaps:
+            w = db.session.query(md.War).get(s.id)
+            self.assertEqual((s.clan1.tag, s.clan2.tag), (w.clan1.tag, w.clan2.tag))
+            self.assertEqual(s.result, w.result)
+            self.assertEqual(len(s.attacks), len(w.attacks))
+            for a in s.attacks:
+                self.assertEqual(a.attacker_th, w.get_player(a.attacker_tag).town_hall_level)
+                self.assertEqual(a.defender_th, w.get_player(a.defender_tag).town_hall_level)
+
+    def test_war_update_from(self):
+        import models.db as db
+        d = self.league_war()
+        d["state"] = "inWar"
+        for m in d["clan"]["members"] + d["opponent"]["members"]:
+            m.pop("attacks", None)
+        db.session.add(md.War(**json.loads(json.dumps(d))))
+        db.session.commit()
+        ob = db.session.query(md.War).one()
+        self.assertIsNone(ob._update_from(md.War(**json.loads(json.dumps(d)))))
+
+        m, o = d["clan"]["members"][0], d["opponent"]["members"][0]
+        m["attacks"] = [{"attackerTag": m["tag"], "defenderTag": o["tag"], "stars": 2, "destructionPercentage": 70, "order": 1}]
+        d["clan"]["stars"] += 2
+        new = md.War(**json.loads(json.dumps(d)))
+        self.assertFalse(any(ob._update_from(new).values()))
+        db.session.commit()
+        self.assertEqual(db.session.query(md.War).count(), 1)
+        self.assertEqual(db.session.query(md.WarPlayer).count(), 30)
+        a = db.session.query(md.WarAttack).one()
+        self.assertEqual((a.war_id, a.attacker_tag), (ob.id, m["tag"]))
+        self.assertEqual(ob.content_hash, new.content_hash)
+
+        m["attacks"] = []
+        sd = ob._update_from(md.War(**json.loads(json.dumps(d))))
+        self.assertEqual(sd[md.WarAttack], [a])
+
+        ## a side without members doesn't mean everyone left
+        d["clan"].pop("members")
+        d["clan"]["stars"] += 1
+        sd = ob._update_from(md.War(**json.loads(json.dumps(d))))
+        self.assertFalse(any(sd.values()))
+        self.assertEqual(len(ob.clan1.members) + len(ob.clan2.members), 30)
+
+    def test_war_log_keeps_members(self):
+        import models.db as db
+        d = self.league_war()
+        d["state"] = "inWar"
+        war = md.War(**json.loads(json.dumps(d)))
+        db.session.add(war)
+        for p in war.clan1.members:
+            a = md.WarAttack(attackerTag=p.tag, defenderTag=war.clan2.members[0].tag, stars=1, destructionPercentage=50, order=1)
+            a.war = war
+            p.attacks.append(a)
+        db.session.commit()
+        war_type = war.war_type
+
+        ## what _get_war_logs makes of the same war
+        entry = {k: d[k] for k in ("teamSize", "endTime")}
+        entry.update(state="warEnded", war_log=True, result="win")
+        for side in ("clan", "opponent"):
+            entry[side] = {k: v for k, v in d[side].items() if k != "members"}
+        entry["clan"]["stars"] += 3
+        mc = ModelControler(req.COCRequest(auth_token="x"))
+        mc._get_wars([[entry]], save_to_db=True)
+        db.session.expunge_all()
+        ob = db.session.query(md.War).one()
+        self.assertEqual(db.session.query(md.WarPlayer).count(), 30)
+        self.assertEqual(db.session.query(md.WarAttack).count(), 15)
+        self.assertEqual((ob.state, ob.war_type), (md.WarState.war_ended, war_type))
+
+    def test_war_logs_share_a_war(self):
+        import models.db as db
+        d = self.league_war()
+        entry = {k: d[k] for k in ("teamSize", "endTime")}
+        entry.update(state="warEnded", war_log=True, result="win")
+        for side in ("clan", "opponent"):
+            entry[side] = {k: v for k, v in d[side].items() if k != "members"}
+        ## the same war seen from the other clan's log
+        other = dict(entry, clan=entry["opponent"], opponent=entry["clan"], result="lose")
+        mc = ModelControler(req.COCRequest(auth_token="x"))
+        wars = mc._get_wars([[entry], [other]], save_to_db=True)
+        self.assertEqual(len(wars), 2)
+        self.assertIs(wars[0], wars[1])
+        self.assertIsNotNone(wars[0].id)
+        for w in wars:
+            db.session.add(w)
+        db.session.commit()
+        self.assertEqual(db.session.query(md.War).count(), 1)
+
+    def test_clan_load_profiles(self):
+        import models.db as db
+        db.session.add(md.Clan(tag=TEST_CLAN, name="test"))
+        for i in range(3):
+            db.session.add(md.ClanHistory(tag=TEST_CLAN, war_league=48000010 + i, last_check=datetime(2020, 1, 1 + i)))
+        db.session.commit()
+        db.session.expunge_all()
+        c = md.Clan.get(TEST_CLAN)
+        self.assertNotIn("history", c.__dict__)
+        self.assertEqual(c.war_league, 48000012)
+        c = md.Clan.get(TEST_CLAN, load="full")
+        self.assertEqual(len(c.__dict__["history"]), 3)
+        self.assertRaises(ValueError, md.Clan.get, TEST_CLAN, load="everything")
+
+    def test_latest_history(self):
+        import models.db as db
+        tag = md.fmt_tag("#2PP")
+        db.session.add(md.Player(tag=tag, name="test"))
+        for day in (2, 1, 3):
+            db.session.add(md.PlayerHistory(tag=tag, trophies=day * 100, last_check=datetime(2020, 1, day)))
+        db.session.commit()
+        self.assertEqual(db.session.query(md.PlayerLatest.trophies).filter_by(tag=tag).scalar(), 300)
+        self.assertEqual([h.trophies for h in md.Player._get_last_histories([tag])], [300])
+
+        ## checking an older entry again makes it the latest
+        h = db.session.query(md.PlayerHistory).filter_by(trophies=100).one()
+        h.last_check = datetime(2021, 1, 1, 12)
+        db.session.commit()
+        self.assertEqual(md.PlayerLatest.get_history(tag).id, h.id)
+        self.assertEqual(db.session.query(md.PlayerLatest).count(), 1)
+
+        ## an older check written in another datetime format doesn't replace it
+        sql = text("INSERT INTO player_history (tag, trophies, last_check) VALUES (:tag, 400, '2021-01-01T09:00:00')")
+        db.session.execute(sql.bindparams(bindparam("tag", type_=db.Tag())), {"tag": tag})
+        db.session.commit()
+        self.assertEqual(md.PlayerLatest.get_history(tag).id, h.id)
+
+    def test_season_clan_resolver(self):
+        import models.db as db
+        p1, p2, c1, c2 = (md.fmt_tag(t) for t in ("#2PP", "#8QQ", "#2YY", "#9LL"))
+        db.session.add_all([md.Player(tag=p1, name="one"), md.Player(tag=p2, name="two"), md.Clan(tag=c1, name="clan one")])
+        db.session.flush()
+        ## season ids 1 and 2 are seeded with the table, p1 changed clans between them
+        lc1 = md.LeagueClan(1, tag=c1)
+        lc2 = md.LeagueClan(2, tag=c2)
+        db.session.add_all([lc1, lc2])
+        db.session.flush()
+        for lc, season, tag in ((lc1, 1, p1), (lc2, 2, p1), (lc1, 1, p2)):
+            lp = md.LeaguePlayer(season, tag=tag)
+            lp.league_clan_id = lc.id
+            db.session.add(lp)
+        db.session.commit()
+        r = md.SeasonClanResolver(1)
+        self.assertEqual(r.resolve([p2, p1, "#NOPE"]), [("two", c1, "clan one"), ("one", c1, "clan one"), (None, None, None)])
+        self.assertEqual(md.SeasonClanResolver(2).resolve([p1, p2]), [("one", c2, None), ("two", None, None)])
+        self.assertEqual(md.LeaguePlayer.get_clan_names([p1, p2]), [c2, "clan one"])
+
+    def test_league_attack_df(self):
+        import models.db as db
+        d = self.league_war()
+        g = md.LeagueGroup(1, state="ended", league_id=48000010, clans=[], rounds=[{"warTags": []}] * 2)
+        db.session.add(g)
+        db.session.flush()
+        war = md.War(**d)
+        war.league_round_id = g.rounds[1].id
+        for order, (attacker, defender) in enumerate(zip(war.clan1.members[:3] + war.clan2.members[:2], war.clan2.members[:3] + war.clan1.members[:2])):
+            a = md.WarAttack(attackerTag=attacker.tag, defenderTag=defender.tag, stars=order % 4, destructionPercentage=50, order=order + 1)
+            a.war = war
+            attacker.attacks.append(a)
+        ## a defender that isn't in the war and values the api didn't give
+        a = md.WarAttack(attackerTag=war.clan1.members[5].tag, defenderTag="#2PP", stars=None, destructionPercentage=None)
+        a.war = war
+        war.clan1.members[5].attacks.append(a)
+        db.session.add(war)
+        db.session.commit()
+        season = db.session.query(md.LeagueSeason).get(1)
+        df = season.to_attack_df(md.LeagueGroup.league_id == 48000010, chunksize=7)
+        attacks = war.attacks
+        self.assertEqual(len(df), len(attacks))
+        self.assertEqual(str(df["stars"].dtype), "Int8")
+        row = df[df["defender_tag"] == "#2PP"].iloc[0]
+        self.assertEqual(row.defender_th, -1)
+        self.assertTrue(pd.isna(row.stars) and pd.isna(row.order))
+        self.assertEqual(str(df["attacker_tag"].dtype), "category")
+        row = df.sort_values("order").iloc[0]
+        a = min((a for a in attacks if a.order), key=lambda a: a.order)
+        self.assertEqual(
+            (row.attacker_tag, row.defender_tag, row.stars, row.attacker_th, row.defender_th, row.round_id, row.group_id),
+            (a.attacker_tag, a.defender_tag, a.stars, a.attacker_th, a.defender_th, 1, g.id),
+        )
+        self.assertEqual(len(season.to_attack_df(limit=1)), len(attacks))
+        self.assertTrue(season.to_attack_df(md.LeagueGroup.league_id == 0).empty)
+        self.assertTrue(db.session.query(md.LeagueSeason).get(2).to_attack_df().empty)
+
+    def test_war_tag_index(self):
+        d = self.league_war()
+        war = md.War(**d)
+        c1, c2 = war.clan1, war.clan2
+        for p in c1.members + c2.members:
+            opp = c2 if p in c1.members else c1
+            self.assertIs(war.get_player(p.tag), p)
+            self.assertIs(war.get_war_clan(p.tag, opponent=True), opp)
+            self.assertEqual(war.get_defenses(p.tag), [a for m in opp.members for a in m.attacks if a.defender_tag == p.tag])
+        self.assertIsNone(war.get_player("#NOTINWAR"))
+        self.assertRaises(md.TagNotFoundException, war.get_attacks, "#NOTINWAR")
+
+        attacker, defender = c1.members[0], c2.members[0]
+        before = len(war.get_defenses(defender.tag))
+        attacker.attacks.append(md.WarAttack(attackerTag=attacker.tag, defenderTag=defender.tag, stars=3, destructionPercentage=100, order=99))
+        self.assertEqual(len(war.get_defenses(defender.tag)), before + 1)
+        self.assertEqual(defender.best_opponent_attack.stars, 3)
+        self.assertEqual(war.get_attacks(attacker.tag)[-1].defender_th, defender.town_hall_level)
+
     @timeit
     def test_get_clan(self):
         self.fake(True, True)
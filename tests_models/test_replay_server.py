@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+import unittest
+
+import requests
+
+from models.replay_server import DirSource, ReplayServer
+
+
+class AllTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmpdir.name, "clans", "#2R9LQRLY"))
+        with open(os.path.join(self.tmpdir.name, "clans", "#2R9LQRLY.json"), "w") as f:
+            json.dump({"tag": "#2R9LQRLY"}, f)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def serve(self, **kwargs):
+        server = ReplayServer(DirSource(self.tmpdir.name), port=0, **kwargs)
+        server.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_replay(self):
+        server = self.serve(max_age=30)
+        r = requests.get(f"{server.url}/clans/%232R9LQRLY")
+        self.assertEqual(r.json(), {"tag": "#2R9LQRLY"})
+        self.assertIn("max-age=30", r.headers["Cache-Control"])
+        r = requests.get(f"{server.url}/clans/%23PYLQ")
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(r.json()["reason"], "notFound")
+
+    def test_injected(self):
+        server = self.serve(not_found_rate=1, access_denied_rate=1)
+        r = requests.get(f"{server.url}/clans/%232R9LQRLY/currentwar/leaguegroup")
+        self.assertEqual(r.json()["reason"], "notFound")
+        r = requests.get(f"{server.url}/clans/%232R9LQRLY/warlog")
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(r.json()["reason"], "accessDenied")
+
+    def test_throttle(self):
+        server = self.serve(rate=2, retry_after=1)
+        codes = [requests.get(f"{server.url}/clans/%232R9LQRLY").status_code for _ in range(4)]
+        self.assertEqual(codes[:2], [200, 200])
+        self.assertIn(429, codes[2:])
+
+    def test_maintenance(self):
+        server = self.serve(maintenance_every=60, maintenance_for=60)
+        r = requests.get(f"{server.url}/clans/%232R9LQRLY")
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r.json()["reason"], "inMaintenance")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import requests
+from requests.exceptions import HTTPError
+
+import models.req as req
+from models.exceptions import WarLogPrivateException
+
+API = req.API_URL
+
+
+class StubSession:
+    """Stands in for the shared requests session. Answers from a dict of
+    path -> (status, body), optionally after a delay, and counts the calls"""
+
+    def __init__(self, responses, delays=None):
+        self.responses = responses
+        self.delays = delays or {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get(self, url, timeout=None, headers=None, **kwargs):
+        path = url.replace("%23", "#")[len(API) :]
+        with self._lock:
+            self.calls.append(path)
+        time.sleep(self.delays.get(path, 0))
+        status, body = self.responses.get(path, (404, b'{"reason": "notFound"}'))
+        r = requests.Response()
+        r.status_code, r._content, r.url = status, body, url
+        return r
+
+
+class AllTests(unittest.TestCase):
+    FLAGS = ("USE_CACHE", "USE_FILES_FOR_REQS", "SAVE_REQUESTS", "OFFLINE", "COALESCE")
+
+    def setUp(self):
+        self.saved = {f: getattr(req, f) for f in self.FLAGS}
+        req.USE_CACHE = req.USE_FILES_FOR_REQS = req.SAVE_REQUESTS = req.OFFLINE = False
+        req.COALESCE = True
+        self.session = req._get_session()  ## also starts the executor
+        self.stub = StubSession(
+            {
+                "/clans/#2PP": (200, b'{"tag": "#2PP"}'),
+                "/clans/#8QQ": (200, b'{"tag": "#8QQ"}'),
+                "/clans/#9LL": (200, b'{"tag": "#9LL"}'),
+                "/clans/#9LL/warlog": (403, b'{"reason": "accessDenied"}'),
+            },
+            delays={"/clans/#2PP": 0.3, "/clans/#0RR": 0.2},
+        )
+        req._session = self.stub
+        self.r = req.COCRequest(auth_token="test_req")
+
+    def tearDown(self):
+        req._session = self.session
+        for f, v in self.saved.items():
+            setattr(req, f, v)
+
+    def test_many(self):
+        d = self.r.get_clans_many(["#2PP", "#8QQ", "#2PP", "#9LL"])
+        self.assertEqual(d, {t: {"tag": t} for t in ("#2PP", "#8QQ", "#9LL")})
+        ## a key asked for twice is fetched once
+        self.assertEqual(sorted(self.stub.calls), ["/clans/#2PP", "/clans/#8QQ", "/clans/#9LL"])
+
+    def test_iter_many_order(self):
+        ## yielded as they complete, not in the order asked
+        keys = [k for k, _ in self.r.iter_many(self.r.get_clan_async, ["#2PP", "#8QQ", "#9LL"])]
+        self.assertEqual(sorted(keys), ["#2PP", "#8QQ", "#9LL"])
+        self.assertEqual(keys[-1], "#2PP")
+
+    def test_many_exceptions(self):
+        d = self.r.get_clans_many(["#8QQ", "#0RR"], return_exceptions=True)
+        self.assertEqual(d["#8QQ"], {"tag": "#8QQ"})
+        self.assertIsInstance(d["#0RR"], HTTPError)
+        self.assertEqual(d["#0RR"].json, {"reason": "notFound"})
+        self.assertRaises(HTTPError, self.r.get_clans_many, ["#8QQ", "#0RR"])
+
+    def test_file_io_off_the_loop(self):
+        threads = []
+        saved = req.COCRequest._save
+        req.COCRequest._save = staticmethod(lambda url, body: threads.append(threading.current_thread().name))
+        req.SAVE_REQUESTS = True
+        try:
+            self.r.get_clans_many(["#8QQ", "#9LL"])
+        finally:
+            req.COCRequest._save = saved
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn("cocreq-loop", threads)
+
+    def _concurrently(self, tag, n):
+        async def run():
+            return await asyncio.gather(*[self.r.get_clan_async(tag) for _ in range(n)], return_exceptions=True)
+
+        return req._run(run())
+
+    def test_coalesce(self):
+        before = req.coalesced_counter.value
+        self.assertEqual(self._concurrently("#2PP", 5), [{"tag": "#2PP"}] * 5)
+        self.assertEqual(self.stub.calls, ["/clans/#2PP"])
+        self.assertEqual(req.coalesced_counter.value - before, 4)
+        ## once it has landed the next caller fetches again
+        self.r.get_clan("#2PP")
+        self.assertEqual(len(self.stub.calls), 2)
+
+    def test_coalesce_error(self):
+        res = self._concurrently("#0RR", 4)
+        self.assertEqual(self.stub.calls, ["/clans/#0RR"])
+        for e in res:
+            self.assertIsInstance(e, HTTPError)
+        self.assertNotIn(f"{API}/clans/#0RR", req._inflight)
+
+    def test_exceptions_counted_per_caller(self):
+        req.telemetry.reset()
+        self._concurrently("#0RR", 3)
+        self.assertRaises(WarLogPrivateException, self.r.get_war_log, "#9LL")
+        self.assertEqual(
+            req.telemetry.exceptions,
+            {("clan", "HTTPError"): 3, ("warlog", "WarLogPrivateException"): 1},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import json
+import unittest
+
+from models.telemetry import Histogram, Telemetry, endpoint_of
+
+API = "https://api.clashofclans.com/v1"
+
+
+class AllTests(unittest.TestCase):
+    def test_endpoint_of(self):
+        self.assertEqual(endpoint_of(f"{API}/clans/#2R9LQRLY"), "clan")
+        self.assertEqual(endpoint_of(f"{API}/clans/#2R9LQRLY/members"), "members")
+        self.assertEqual(endpoint_of(f"{API}/clans/#2R9LQRLY/warlog"), "warlog")
+        self.assertEqual(endpoint_of(f"{API}/clans/#2R9LQRLY/currentwar/leaguegroup"), "leaguegroup")
+        self.assertEqual(endpoint_of(f"{API}/clanwarleagues/wars/#2PRPJQQPR"), "leaguewar")
+        self.assertEqual(endpoint_of(f"{API}/players/#8ULL0ULU"), "player")
+
+    def test_histogram(self):
+        h = Histogram()
+        for i in range(1, 101):
+            h.observe(i / 100)
+        self.assertEqual(h.count, 100)
+        self.assertTrue(0.25 <= h.quantile(0.5) <= 0.5)
+        self.assertTrue(0.5 <= h.quantile(0.99) <= 1)
+        self.assertEqual(Histogram().quantile(0.5), 0.0)
+
+    def test_dump(self):
+        t = Telemetry()
+        url = f"{API}/clans/#2R9LQRLY"
+        for source in ("network", "cache", "cache", "coalesced"):
+            t.request(url)
+            t.source(url, source)
+        t.response(url, 200, 0.1)
+        t.waited(url, 0.5)
+        t.exception(f"{API}/clans/#2R9LQRLY/warlog", ValueError())
+        d = json.loads(t.to_json())
+        self.assertEqual(d["endpoints"]["clan"]["hit_rate"], 0.75)
+        self.assertEqual(d["endpoints"]["clan"]["statuses"], {"200": 1})
+        self.assertEqual(d["limiter_wait_seconds"], 0.5)
+        prom = t.to_prometheus()
+        self.assertIn('coc_requests_total{endpoint="clan"} 4', prom)
+        self.assertIn('coc_request_seconds_count{endpoint="clan"} 1', prom)
+        self.assertIn('coc_exceptions_total{endpoint="warlog",exception="ValueError"} 1', prom)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import time
+import unittest
+
+from requests.exceptions import HTTPError
+
+import models.req as req
+from models.token_pool import MAX_BACKOFF, Priority, TokenPool, TokenSlot
+from tests_models.test_req import StubSession
+
+
+class AllTests(unittest.TestCase):
+    def test_backing_off_slot_skipped(self):
+        a, b = TokenSlot("a", "test_pool_a"), TokenSlot("b", "test_pool_b")
+        pool = TokenPool([a, b])
+        a.throttled(30)
+        for _ in range(5):
+            self.assertIs(asyncio.run(pool.acquire(Priority.BULK)), b)
+
+    def test_all_backing_off(self):
+        a = TokenSlot("a", "test_pool_c")
+        a.throttled(0.2)
+        st = time.time()
+        self.assertIs(asyncio.run(TokenPool([a]).acquire()), a)
+        self.assertGreaterEqual(time.time() - st, 0.15)
+
+    def test_retry_after(self):
+        s = TokenSlot("a", "test_pool_d")
+        self.assertEqual(s.throttled("7"), 7)
+        self.assertAlmostEqual(s.backoff_until, time.time() + 7, delta=1)
+        ## no or a bad header, exponential backoff
+        s = TokenSlot("a", "test_pool_d")
+        self.assertEqual([s.throttled(None), s.throttled("soon"), s.throttled()], [1, 2, 4])
+        for _ in range(10):
+            s.throttled()
+        self.assertEqual(s.backoff, MAX_BACKOFF)
+        s.succeeded()
+        self.assertEqual(s.backoff, 0)
+
+    def test_attempts_exhausted(self):
+        flags = ("USE_CACHE", "USE_FILES_FOR_REQS", "SAVE_REQUESTS", "OFFLINE")
+        saved = {f: getattr(req, f) for f in flags}
+        for f in flags:
+            setattr(req, f, False)
+        session = req._get_session()
+        req._session = stub = StubSession({"/clans/#2PP": (429, b'{"reason": "requestThrottled"}')})
+        stub_get = stub.get
+
+        def get(url, **kwargs):
+            r = stub_get(url, **kwargs)
+            r.headers["Retry-After"] = "0"
+            return r
+
+        stub.get = get
+        try:
+            r = req.COCRequest(auth_token="test_pool_e")
+            with self.assertRaises(HTTPError) as cm:
+                r.get_clan("#2PP")
+            self.assertEqual(cm.exception.response.status_code, 429)
+            self.assertEqual(len(stub.calls), len(r.pool) + 2)
+        finally:
+            req._session = session
+            for f, v in saved.items():
+                setattr(req, f, v)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+"""LeagueSeason.to_attack_df: the single streamed join vs the old three queries per
+chunk of wars built into python lists
+
+    python -m tests_models.time_attack_df [nwars]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_db_path = os.path.join(tempfile.gettempdir(), "time_attack_df.sqlite")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{_db_path}")
+
+import pandas as pd
+
+import models.db as db
+from models.models import _ATTACK_DF_DTYPES, LeagueGroup, LeagueRound, LeagueSeason, War, WarAttack, WarPlayer
+from models.utils import chunks
+from tests_models.time_war_insert import make_wars
+
+LEAGUE = 48000010
+
+
+def per_chunk(query_filter):
+    lwars = (
+        db.session.query(War.id, War.team_size, LeagueRound.round, LeagueGroup.id)
+        .join(LeagueRound, War.league_round_id == LeagueRound.id)
+        .join(LeagueGroup, LeagueRound.league_group_id == LeagueGroup.id)
+        .filter(query_filter)
+        .all()
+    )
+    natks = []
+    for c in chunks(lwars, 1000):
+        wars = {x[0]: x[1:] for x in c}
+        atks = (
+            db.session.query(
+                WarAttack.war_id,
+                WarAttack.war_player_id,
+                WarAttack.attacker_tag,
+                WarAttack.defender_tag,
+                WarAttack.stars,
+                WarAttack.destruction_percentage,
+                WarAttack.order,
+            )
+            .filter(WarAttack.war_id.in_(wars.keys()))
+            .all()
+        )
+        r = db.session.query(WarPlayer.tag, WarPlayer.town_hall_level).filter(WarPlayer.id.in_([x[1] for x in atks]))
+        th_levels = dict(r.all())
+        r = db.session.query(WarPlayer.tag, WarPlayer.town_hall_level).filter(WarPlayer.tag.in_([x[3] for x in atks]))
+        th_levels.update(r.all())
+        for a in atks:
+            natks.append(list(a) + [th_levels.get(a[2], -1), th_levels.get(a[3], -1), *wars[a[0]]])
+    return pd.DataFrame(natks, columns=list(_ATTACK_DF_DTYPES))
+
+
+def main(n=2000):
+    db.Base.metadata.drop_all(bind=db.engine)
+    db.init_db()
+    g = LeagueGroup(1, league_id=LEAGUE, clans=[], rounds=[{"warTags": []}] * 7)
+    db.session.add(g)
+    db.session.flush()
+    ## 15 a side, bigger wars repeat member tags
+    wars = War._bulk_insert(make_wars(n, size=15))
+    for i, w in enumerate(wars):
+        db.session.query(War).filter(War.id == w.id).update({War.league_round_id: g.rounds[i % 7].id})
+    db.session.commit()
+    season = db.session.query(LeagueSeason).get(1)
+    query_filter = LeagueGroup.league_id == LEAGUE
+    results = {}
+    for name, run in (("per_chunk", lambda: per_chunk(query_filter)), ("join", lambda: season.to_attack_df(query_filter))):
+        db.session.expunge_all()
+        tracemalloc.start()
+        st = time.time()
+        df = run()
+        results[name] = time.time() - st
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:<10} {df.shape[0]} attacks in {results[name]:.3f}s, peak {peak / 2**20:.1f} MiB, "
+              f"frame {df.memory_usage(deep=True).sum() / 2**20:.1f} MiB")
+    print(f"speedup {results['per_chunk'] / results['join']:.1f}x")
+    db.session.remove()
+    os.remove(_db_path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,84 @@
+"""Clan.get load time as a clan's history grows, for each load profile and for the old
+behaviour of joining every relationship in one query
+
+    python -m tests_models.time_clan_load [max_history]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+_db_path = os.path.join(tempfile.gettempdir(), "time_clan_load.sqlite")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{_db_path}")
+
+from sqlalchemy.orm import joinedload
+
+import models.db as db
+from models.models import (
+    Clan,
+    ClanDescriptionHistory,
+    ClanHistory,
+    ClanNameHistory,
+    Player,
+    War,
+    _clans_players_association_table,
+    _clans_wars_association_table,
+)
+
+TAG = "#TESTCLAN"
+MEMBERS = 50
+JOINED_MAX_ROWS = 50000  ## the joined query returns history * names * descriptions * wars * members rows
+
+
+def grow(nhistory, start):
+    """Add history, name and description rows and wars until the clan has nhistory of each"""
+    t0 = datetime(2020, 1, 1)
+    e = db.engine
+    for i in range(start, nhistory):
+        when = t0 + timedelta(hours=i)
+        e.execute(ClanHistory.__table__.insert(), tag=TAG, war_league=48000010, last_check=when, insert_time=when)
+        e.execute(ClanNameHistory.__table__.insert(), tag=TAG, name=f"name {i}", last_check=when, insert_time=when)
+        e.execute(ClanDescriptionHistory.__table__.insert(), tag=TAG, description=f"description {i}", last_check=when, insert_time=when)
+        r = e.execute(War.__table__.insert(), clan1_tag=TAG, clan2_tag="#OTHER", end_time=when)
+        e.execute(_clans_wars_association_table.insert(), clan_tag=TAG, war_id=r.inserted_primary_key[0])
+
+
+def time_get(options, n=20):
+    st = time.time()
+    for _ in range(n):
+        db.session.remove()
+        c = db.session.query(Clan).options(*options).filter(Clan.tag == TAG).one()
+        c.war_league
+    return (time.time() - st) / n
+
+
+def main(max_history=1000):
+    db.Base.metadata.drop_all(bind=db.engine)
+    db.init_db()
+    db.engine.execute(Clan.__table__.insert(), tag=TAG, name="test")
+    for i in range(MEMBERS):
+        db.engine.execute(Player.__table__.insert(), tag=f"#P{i}", name=f"p{i}")
+        db.engine.execute(_clans_players_association_table.insert(), clan_tag=TAG, player_tag=f"#P{i}")
+    joined = [joinedload(getattr(Clan, r)) for r in Clan.__load_profiles__["full"]]
+    profiles = [("joined", joined)] + [(p, Clan.load_options(p)) for p in Clan.__load_profiles__]
+    print(f"{'history':>8} " + " ".join(f"{name:>12}" for name, _ in profiles), flush=True)
+    n = 0
+    for size in (2, 5, 10, 50, 100, 500, 1000, 2000):
+        if size > max_history:
+            break
+        grow(size, n)
+        n = size
+        cols = []
+        for name, opts in profiles:
+            if name == "joined" and size**4 * MEMBERS > JOINED_MAX_ROWS:
+                cols.append(f"{'-':>12}")
+            else:
+                cols.append(f"{time_get(opts) * 1000:>10.1f}ms")
+        print(f"{size:>8} " + " ".join(cols), flush=True)
+    db.session.remove()
+    os.remove(_db_path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,53 @@
+"""Parse time per endpoint for the stdlib json module and models.utils.json_loads
+
+    python -m tests_models.time_json_parse
+"""
+import copy
+import json
+import os
+import timeit
+
+from models.utils import json_loads, orjson
+
+_cwd = os.path.dirname(os.path.abspath(__file__))
+
+N = 200
+
+
+def load_bodies():
+    """Raw response bodies, as the API sends them, keyed by endpoint"""
+    files = {
+        "clan": f"{_cwd}/test_clan.json",
+        "player": f"{_cwd}/test_player.json",
+        "leaguegroup": f"{_cwd}/data/league_group.json",
+        "league war 15v15": f"{_cwd}/data/warTag_#2PRPJQQPR.json",
+    }
+    docs = {}
+    for name, floc in files.items():
+        with open(floc) as f:
+            docs[name] = json.load(f)
+
+    ## a full 30v30 league war, every member attacking once
+    war = copy.deepcopy(docs["league war 15v15"])
+    war["teamSize"] = 30
+    for side in ("clan", "opponent"):
+        members = war[side]["members"]
+        while len(members) < 30:
+            m = copy.deepcopy(members[len(members) % 15])
+            m["mapPosition"] = len(members) + 1
+            members.append(m)
+    docs["league war 30v30"] = war
+    return {name: json.dumps(d, separators=(",", ":")).encode() for name, d in docs.items()}
+
+
+def main():
+    print(f"orjson {'installed' if orjson else 'not installed'}, {N} parses each")
+    print(f"{'endpoint':<18}{'bytes':>8}{'json (us)':>12}{'json_loads (us)':>18}{'speedup':>9}")
+    for name, body in load_bodies().items():
+        t_std = timeit.timeit(lambda: json.loads(body), number=N) / N * 1e6
+        t_fast = timeit.timeit(lambda: json_loads(body), number=N) / N * 1e6
+        print(f"{name:<18}{len(body):>8}{t_std:>12.1f}{t_fast:>18.1f}{t_std / t_fast:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
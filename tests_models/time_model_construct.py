@@ -0,0 +1,65 @@
+"""Objects per second built from API dicts by the models' constructors
+
+    python -m tests_models.time_model_construct
+"""
+import copy
+import json
+import os
+import timeit
+
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite://")
+
+from models.models import ClanHistory, LeagueGroup, PlayerHistory, War
+
+_cwd = os.path.dirname(os.path.abspath(__file__))
+
+N = 200
+
+
+def _load(floc):
+    with open(floc) as f:
+        return json.load(f)
+
+
+def _war_30v30(war):
+    war = copy.deepcopy(war)
+    war["teamSize"] = 30
+    for side in ("clan", "opponent"):
+        members = war[side]["members"]
+        while len(members) < 30:
+            m = copy.deepcopy(members[len(members) % 15])
+            m["tag"] = f"{m['tag']}{len(members)}"
+            m["mapPosition"] = len(members) + 1
+            members.append(m)
+    return war
+
+
+def _count(war):
+    """Objects a war dict turns into: the war, its clans, members and attacks"""
+    members = war["clan"]["members"] + war["opponent"]["members"]
+    return 3 + len(members) + sum(len(m.get("attacks", [])) for m in members)
+
+
+def main():
+    war = _load(f"{_cwd}/data/warTag_#2PRPJQQPR.json")
+    war30 = _war_30v30(war)
+    group = _load(f"{_cwd}/data/league_group.json")
+    group_objects = 1 + sum(1 + len(c["members"]) for c in group["clans"]) + len(group["rounds"])
+    clan = _load(f"{_cwd}/test_clan.json")
+    player = _load(f"{_cwd}/test_player.json")
+    cases = [
+        ("ClanHistory", lambda: ClanHistory(**clan), 1),
+        ("PlayerHistory", lambda: PlayerHistory(**player), 1),
+        ("LeagueGroup", lambda: LeagueGroup(1, **group), group_objects),
+        ("War 15v15", lambda: War(**war), _count(war)),
+        ("War 30v30", lambda: War(**war30), _count(war30)),
+    ]
+    print(f"{'model':<15}{'objects':>9}{'ms each':>10}{'objects/s':>12}")
+    for name, make, nobjects in cases:
+        make()  # configure the mappers outside the timing
+        t = timeit.timeit(make, number=N) / N
+        print(f"{name:<15}{nobjects:>9}{t * 1000:>10.3f}{nobjects / t:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Wars per second written through the ORM unit of work vs War._bulk_insert
+
+    python -m tests_models.time_war_insert [nwars]
+"""
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+
+_db_path = os.path.join(tempfile.gettempdir(), "time_war_insert.sqlite")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{_db_path}")
+
+import models.db as db
+from models.models import War, WarAttack
+
+_cwd = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_wars(n, size=30):
+    """n ended league wars of size v size, every member attacking once"""
+    with open(f"{_cwd}/data/warTag_#2PRPJQQPR.json") as f:
+        base = json.load(f)
+    wars = []
+    for i in range(n):
+        wd = copy.deepcopy(base)
+        wd["state"] = "warEnded"
+        wd["teamSize"] = size
+        wd["endTime"] = f"2020{1 + i // 28 % 12:02d}{1 + i % 28:02d}T{i // 336 % 24:02d}4845.000Z"
+        for side in ("clan", "opponent"):
+            members = wd[side]["members"]
+            while len(members) < size:
+                m = copy.deepcopy(members[len(members) % 15])
+                m["mapPosition"] = len(members) + 1
+                members.append(m)
+        for side, other in (("clan", "opponent"), ("opponent", "clan")):
+            for m, o in zip(wd[side]["members"], wd[other]["members"]):
+                m["attacks"] = [
+                    {"attackerTag": m["tag"], "defenderTag": o["tag"], "stars": 2, "destructionPercentage": 80, "order": 1}
+                ]
+        wars.append(wd)
+    return wars
+
+
+def _reset():
+    db.session.remove()
+    db.Base.metadata.drop_all(bind=db.engine)
+    db.init_db()
+
+
+def main(n=200):
+    wdicts = make_wars(n)
+    results = {}
+    for name in ("orm", "bulk"):
+        _reset()
+        wars = [War(**wd) for wd in wdicts]
+        st = time.time()
+        if name == "orm":
+            db.session.add_all(wars)
+        else:
+            War._bulk_insert(wars)
+        db.session.commit()
+        results[name] = time.time() - st
+        nattacks = db.session.query(WarAttack).count()
+        print(f"{name:<5} {n} wars ({nattacks} attacks) in {results[name]:.3f}s, {n / results[name]:.0f} wars/s")
+    print(f"speedup {results['orm'] / results['bulk']:.1f}x")
+    db.session.remove()
+    os.remove(_db_path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,57 @@
+"""Scanning every war with its attacks: ORM War objects vs War.iter_snapshots
+
+    python -m tests_models.time_war_snapshots [nwars]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_db_path = os.path.join(tempfile.gettempdir(), "time_war_snapshots.sqlite")
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", f"sqlite:///{_db_path}")
+
+import models.db as db
+from models.models import War
+from tests_models.time_war_insert import make_wars
+
+
+def scan_orm():
+    n = 0
+    for war in War.get_all_wars():
+        for a in war.attacks:
+            n += a.stars
+    return n, len(db.session.identity_map)
+
+
+def scan_snapshots():
+    n = 0
+    for war in War.iter_snapshots(attacks=True):
+        for a in war.attacks:
+            n += a.stars
+    return n, len(db.session.identity_map)
+
+
+def main(n=500):
+    db.Base.metadata.drop_all(bind=db.engine)
+    db.init_db()
+    War._bulk_insert(make_wars(n))
+    db.session.commit()
+    results = {}
+    for name, scan in (("orm", scan_orm), ("snapshot", scan_snapshots)):
+        db.session.remove()
+        tracemalloc.start()
+        st = time.time()
+        stars, tracked = scan()
+        results[name] = time.time() - st
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:<8} {n} wars ({stars} stars) in {results[name]:.3f}s, peak {peak / 2**20:.1f} MiB, "
+              f"{tracked} objects in the session")
+    print(f"speedup {results['orm'] / results['snapshot']:.1f}x")
+    db.session.remove()
+    os.remove(_db_path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -13,8 +13,10 @@ if os.path.exists(".env"):
 
 from models.model_controler import ModelControler
 from models.req import COCRequest
+from models.token_pool import Priority
 
-mc = ModelControler()
+## final war states can't wait behind a crawl sharing our keys
+mc = ModelControler(COCRequest(priority=Priority.REALTIME))
 stopFlag = Event()
 
 class MyClanChecker(Thread):
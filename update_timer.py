@@ -10,6 +10,7 @@ if os.path.exists(".env"):
 
 from models.model_controler import ModelControler
 from models.req import COCRequest
+from models.token_pool import Priority
 
 queue = Queue()
 DONE = "__DONE__"
@@ -22,7 +23,7 @@ mc = ModelControler()
 wars = mc.get_unfinished_wars()
 
 def handle_db(queue):
-    req = COCRequest()
+    req = COCRequest(priority=Priority.REALTIME)
     while True:
         msg = queue.get()
         print("msg=", msg)
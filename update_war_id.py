@@ -1,3 +1,5 @@
+## Backfills war_attack.war_id for attacks saved before War._bulk_insert started
+## writing it. Wars inserted since then already have it.
 import collections
 import json
 import math
@@ -76,7 +76,7 @@ def run():
     mc = ModelControler()
     import models.models as md
     clan_tags = set()
-    for war in md.War.get_all_wars():
+    for war in md.War.iter_snapshots():
         c1 = Clan.get(war.clan1_tag)
         c2 = Clan.get(war.clan2_tag)
         if c1 is None: